@@ -0,0 +1,234 @@
+from __future__ import division
+import time
+import argparse
+import numpy as np
+import scipy.sparse as sp
+from preprocess import chunk_bounds
+
+#approximate nearest neighbours over the learned embeddings (latent x_ part of predict_x), in NumPy
+#IVF index: a k-means coarse quantizer splits the points into n_lists inverted lists stored contiguously,
+#a query only scans the n_probe lists with the closest centroids; queries are processed in batches and
+#every probed list is scanned once per batch with one matrix product for all the queries probing it
+
+
+#squared euclidean distances between the rows of A and B, given the squared norms of B
+def _sq_dists(A, B, B_norms=None):
+    if B_norms is None:
+        B_norms = np.einsum('ij,ij->i', B, B)
+    D = np.einsum('ij,ij->i', A, A)[:, None] - 2 * A.dot(B.T) + B_norms[None, :]
+    return np.maximum(D, 0, out=D)
+
+#index and squared distance of the nearest centroid of every row
+def _assign(X, centroids, bs=8192):
+    norms = np.einsum('ij,ij->i', centroids, centroids)
+    labels = np.empty(len(X), dtype=np.int64)
+    dists = np.empty(len(X), dtype=np.float32)
+    for start, end in chunk_bounds(len(X), bs):
+        D = _sq_dists(X[start:end], centroids, norms)
+        labels[start:end] = D.argmin(axis=1)
+        dists[start:end] = D[np.arange(end - start), labels[start:end]]
+    return labels, dists
+
+#Lloyd's k-means, empty clusters are reseeded with the points farthest from their centroid
+def kmeans(X, n_clusters, n_iter=20, seed=0):
+    rng = np.random.RandomState(seed)
+    centroids = X[rng.choice(len(X), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        labels, dists = _assign(X, centroids)
+        onehot = sp.csr_matrix((np.ones(len(X), dtype=X.dtype), (labels, np.arange(len(X)))), shape=(n_clusters, len(X)))
+        counts = np.bincount(labels, minlength=n_clusters)
+        empty = np.nonzero(counts == 0)[0]
+        centroids = np.asarray(onehot.dot(X)) / np.maximum(counts, 1)[:, None]
+        if len(empty):
+            centroids[empty] = X[np.argsort(dists)[::-1][:len(empty)]]
+    return centroids.astype(X.dtype)
+
+
+class IVFIndex(object):
+    def __init__(self, n_lists=None, n_probe=8, metric='euclidean', train_size=100000, n_iter=20, seed=0):
+        assert metric in ['euclidean', 'cosine']
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.metric = metric
+        self.train_size = train_size
+        self.n_iter = n_iter
+        self.seed = seed
+
+    def _prepare(self, X):
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        if self.metric == 'cosine':
+            X = X / np.maximum(np.linalg.norm(X, axis=1, keepdims=True), 1e-12)
+        return X
+
+    #k-means on at most train_size points, then every point goes to the list of its nearest centroid
+    def fit(self, X):
+        X = self._prepare(X)
+        if self.n_lists is None:
+            self.n_lists = max(1, int(np.sqrt(len(X))))
+        self.n_lists = min(self.n_lists, len(X))
+        rng = np.random.RandomState(self.seed)
+        sample = X[rng.choice(len(X), self.train_size, replace=False)] if len(X) > self.train_size else X
+        self.centroids = kmeans(sample, self.n_lists, self.n_iter, self.seed)
+        labels, _ = _assign(X, self.centroids)
+        #points sorted by list, list l holds data[offsets[l]:offsets[l+1]] with original row ids ids[...]
+        self.ids = np.argsort(labels, kind='mergesort')
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=self.n_lists))])
+        self.data = X[self.ids]
+        self.norms = np.einsum('ij,ij->i', self.data, self.data)
+        return self
+
+    def __len__(self):
+        return len(self.ids)
+
+    #(distances, row ids) of the k nearest indexed points of every query, sorted by distance; with fewer
+    #than k points in the probed lists the remaining ids are -1 (distance inf)
+    def search(self, Q, k, n_probe=None, bs=4096):
+        Q = self._prepare(Q)
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+        D = np.full((len(Q), k), np.inf, dtype=np.float32)
+        I = np.full((len(Q), k), -1, dtype=np.int64)
+        for start, end in chunk_bounds(len(Q), bs):
+            q = Q[start:end]
+            best_d, best_i = D[start:end], I[start:end]
+            cd = _sq_dists(q, self.centroids)
+            probes = np.argpartition(cd, n_probe - 1, axis=1)[:, :n_probe] if n_probe < self.n_lists else \
+                np.tile(np.arange(self.n_lists), (len(q), 1))
+            #queries grouped by probed list
+            lists = probes.ravel()
+            order = np.argsort(lists, kind='mergesort')
+            queries = np.repeat(np.arange(len(q)), n_probe)[order]
+            uniq, first = np.unique(lists[order], return_index=True)
+            for l, lo, hi in zip(uniq, first, np.append(first[1:], len(order))):
+                a, b = self.offsets[l], self.offsets[l + 1]
+                if a == b:
+                    continue
+                qids = queries[lo:hi]
+                d = _sq_dists(q[qids], self.data[a:b], self.norms[a:b])
+                cand_d = np.hstack([best_d[qids], d])
+                cand_i = np.hstack([best_i[qids], np.broadcast_to(self.ids[a:b], d.shape)])
+                sel = np.argpartition(cand_d, k - 1, axis=1)[:, :k]
+                rows = np.arange(len(qids))[:, None]
+                best_d[qids], best_i[qids] = cand_d[rows, sel], cand_i[rows, sel]
+            order = np.argsort(best_d, axis=1)
+            rows = np.arange(len(q))[:, None]
+            D[start:end], I[start:end] = best_d[rows, order], best_i[rows, order]
+        return np.sqrt(D), I
+
+    def save(self, path):
+        np.savez(path, centroids=self.centroids, ids=self.ids, offsets=self.offsets, data=self.data,
+            params=np.array([self.n_lists, self.n_probe]), metric=np.array(self.metric))
+
+def load_index(path):
+    with np.load(path, allow_pickle=False) as f:
+        index = IVFIndex(n_lists=int(f['params'][0]), n_probe=int(f['params'][1]), metric=str(f['metric']))
+        index.centroids, index.ids, index.offsets, index.data = f['centroids'], f['ids'], f['offsets'], f['data']
+    index.norms = np.einsum('ij,ij->i', index.data, index.data)
+    return index
+
+#brute-force kNN by blocks of queries, the reference for the recall of the index
+def exact_search(X, Q, k, metric='euclidean', bs=1024):
+    prepare = IVFIndex(metric=metric)._prepare
+    X, Q = prepare(X), prepare(Q)
+    norms = np.einsum('ij,ij->i', X, X)
+    D = np.empty((len(Q), k), dtype=np.float32)
+    I = np.empty((len(Q), k), dtype=np.int64)
+    for start, end in chunk_bounds(len(Q), bs):
+        d = _sq_dists(Q[start:end], X, norms)
+        idx = np.argpartition(d, k - 1, axis=1)[:, :k]
+        rows = np.arange(end - start)[:, None]
+        order = np.argsort(d[rows, idx], axis=1)
+        I[start:end] = idx[rows, order]
+        D[start:end] = np.sqrt(d[rows, I[start:end]])
+    return D, I
+
+#fraction of the exact k nearest neighbours found
+def recall(I, I_exact):
+    return np.mean([len(np.intersect1d(a, b)) for a, b in zip(I, I_exact)]) / I_exact.shape[1]
+
+
+#kNN label transfer: majority vote of the k nearest reference cells, votes weighted by 1/distance
+#when weighted, returns the predicted labels and the fraction of the votes for them
+def transfer_labels(index, labels, Q, k=15, n_probe=None, weighted=True):
+    classes, codes = np.unique(np.asarray(labels), return_inverse=True)
+    D, I = index.search(Q, k, n_probe)
+    valid = I >= 0
+    weights = 1. / np.maximum(D, 1e-6) if weighted else np.ones(D.shape)
+    weights[~valid] = 0
+    rows = np.repeat(np.arange(len(Q)), k)
+    votes = np.bincount(rows * len(classes) + codes[np.where(valid, I, 0)].ravel(), weights=weights.ravel(),
+        minlength=len(Q) * len(classes)).reshape(len(Q), len(classes))
+    pred = votes.argmax(axis=1)
+    return classes[pred], votes[np.arange(len(Q)), pred] / np.maximum(votes.sum(axis=1), 1e-12)
+
+#directed kNN graph of the indexed points as a (N, N) CSR matrix of distances, without self loops
+def knn_graph(index, k=15, n_probe=None, bs=4096):
+    n = len(index)
+    X = np.empty_like(index.data)
+    X[index.ids] = index.data
+    D, I = index.search(X, k + 1, n_probe, bs)
+    #drop the point itself, or the farthest neighbour when the point was not returned
+    is_self = I == np.arange(n)[:, None]
+    is_self[~is_self.any(axis=1), -1] = True
+    keep = ~is_self & (I >= 0)
+    rows = np.repeat(np.arange(n), k + 1).reshape(n, k + 1)
+    return sp.csr_matrix((D[keep], (rows[keep], I[keep])), shape=(n, n))
+
+
+#build time, then recall@k and per query latency for every n_probe against brute-force search
+def benchmark(X, k=15, n_queries=1000, n_probes=(1, 2, 4, 8, 16, 32), n_lists=None, metric='euclidean', seed=0):
+    rng = np.random.RandomState(seed)
+    Q = X[rng.choice(len(X), min(n_queries, len(X)), replace=False)]
+    start = time.time()
+    index = IVFIndex(n_lists=n_lists, metric=metric, seed=seed).fit(X)
+    print('Built index of %d points, %d lists in %.2fs' % (len(X), index.n_lists, time.time() - start))
+    start = time.time()
+    _, I_exact = exact_search(X, Q, k, metric)
+    exact_ms = 1000. * (time.time() - start) / len(Q)
+    print('%-10s %10s %14s %10s' % ('n_probe', 'recall@%d' % k, 'ms per query', 'speedup'))
+    print('%-10s %10.4f %14.4f %10.2f' % ('exact', 1., exact_ms, 1.))
+    results = []
+    for n_probe in n_probes:
+        if n_probe > index.n_lists:
+            break
+        start = time.time()
+        _, I = index.search(Q, k, n_probe)
+        ms = 1000. * (time.time() - start) / len(Q)
+        results.append({'n_probe': n_probe, 'recall': recall(I, I_exact), 'ms_per_query': ms, 'speedup': exact_ms / ms})
+        print('%-10d %10.4f %14.4f %10.2f' % (n_probe, results[-1]['recall'], ms, exact_ms / ms))
+    return results
+
+#embeddings from a .npy, a .npz (array `name` or the first one) or a results.h5 (array `name` at `step`)
+def load_embeds(path, name='data_embeds', step=None):
+    if path.endswith('.h5'):
+        from results import ResultsStore
+        store = ResultsStore(path)
+        return store.read(step if step is not None else store.steps()[-1], name)
+    if path.endswith('.npz'):
+        with np.load(path) as f:
+            return f[name] if name in f.files else f[f.files[0]]
+    return np.load(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('')
+    parser.add_argument('--embeds', type=str, required=True,help='embeddings .npy/.npz or results.h5')
+    parser.add_argument('--name', type=str, default='data_embeds',help='array name in a .npz or results.h5')
+    parser.add_argument('--step', type=int, default=None,help='evaluation step in results.h5, the last one by default')
+    parser.add_argument('--dx', type=int, default=None,help='index the first dx columns only (latent x_ without the cluster logits)')
+    parser.add_argument('--n_lists', type=int, default=None,help='number of inverted lists, sqrt(N) by default')
+    parser.add_argument('--n_probe', type=int, default=8,help='lists scanned per query')
+    parser.add_argument('--metric', type=str, default='euclidean', choices=['euclidean','cosine'])
+    parser.add_argument('--k', type=int, default=15,help='number of neighbours')
+    parser.add_argument('--out', type=str, default='',help='write the index to this .npz')
+    parser.add_argument('--bench', action='store_true',help='recall/latency against brute-force search')
+    parser.add_argument('--queries', type=int, default=1000,help='queries of the benchmark')
+    args = parser.parse_args()
+
+    X = load_embeds(args.embeds, args.name, args.step)
+    if args.dx is not None:
+        X = X[:, :args.dx]
+    if args.bench:
+        benchmark(X, args.k, args.queries, n_lists=args.n_lists, metric=args.metric)
+    if args.out:
+        IVFIndex(n_lists=args.n_lists, n_probe=args.n_probe, metric=args.metric).fit(X).save(args.out)
+        print('Index written to %s' % args.out)
@@ -0,0 +1,241 @@
+from __future__ import division
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import resource
+import argparse
+import tempfile
+import datetime
+import subprocess
+from multiprocessing import Pool, cpu_count
+import numpy as np
+import util
+
+#offline benchmark suite on synthetic data: sampler construction (time and peak RSS), get_batch,
+#scDEC.train in both scripts and the prediction paths; results are written as JSON so that runs
+#on different commits can be compared with --compare
+#synthetic count matrices are written under a temporary working directory in the datasets/ layout
+#the samplers read, all outputs of training (graph/, results/, checkpoint/) stay there as well
+
+
+#cluster structured counts: Poisson with rates driven by a Gaussian mixture in a low dimensional space
+def synthetic_counts(n_cells, n_feats, nb_classes=5, latent_dim=10, density=0.1, seed=0):
+    latent = util.Mixture_sampler_v2(nb_classes=nb_classes, N=n_cells, dim=latent_dim).X_c
+    rng = np.random.RandomState(seed)
+    loadings = rng.normal(scale=0.3, size=(latent_dim, n_feats))
+    rates = np.exp(latent.dot(loadings) / np.sqrt(latent_dim))
+    rates *= density * n_feats / rates.sum(axis=1, keepdims=True)
+    return rng.poisson(rates).astype(np.float32)
+
+#names of the datasets/ directories of the sparse ARC_Sampler and of scATAC_Sampler
+TENX_NAME = 'bench_10x'
+ATAC_NAME = 'bench_atac'
+
+#datasets/{rna,atac}_combine.npy for ARC_Sampler and their split into the time points of ARC_TS_Sampler,
+#the same cells as a 10x matrix directory for the sparse ARC_Sampler and the peaks as the sc_mat.txt of scATAC_Sampler
+def write_fixtures(root, n_cells, n_genes, n_peaks):
+    os.makedirs(os.path.join(root, 'datasets'))
+    bounds = np.linspace(0, n_cells, len(util.TS_TIME_POINTS)+1).astype(int)
+    mats = {}
+    for seed, (omic, n_feats) in enumerate([('rna', n_genes), ('atac', n_peaks)]):
+        mat = mats[omic] = synthetic_counts(n_cells, n_feats, seed=seed)
+        np.save(os.path.join(root, 'datasets/%s_combine.npy' % omic), mat)
+        for tp, start, end in zip(util.TS_TIME_POINTS, bounds[:-1], bounds[1:]):
+            np.save(os.path.join(root, 'datasets/%s_combine_%s.npy' % (omic, tp)), mat[start:end])
+    write_10x(os.path.join(root, 'datasets', TENX_NAME), mats['rna'], mats['atac'])
+    atac_dir = os.path.join(root, 'datasets', ATAC_NAME)
+    os.makedirs(atac_dir)
+    cells = np.array(['cell%d' % i for i in range(n_cells)])
+    np.savetxt(os.path.join(atac_dir, 'sc_mat.txt'), np.column_stack([['peak%d' % i for i in range(n_peaks)], mats['atac'].T.astype(int).astype(str)]),
+        fmt='%s', delimiter='\t', header='\t'.join(['peak'] + list(cells)), comments='')
+    with open(os.path.join(atac_dir, 'label.txt'), 'w') as f:
+        f.write(''.join('type%d\n' % (i % 5) for i in range(n_cells)))
+
+#filtered_feature_bc_matrix/ of a multiome run (features x cells), converted once into the CSR store
+#so that the constructors time loading the store, not the one-off conversion
+def write_10x(data_dir, rna_mat, atac_mat):
+    import scipy.sparse as sp
+    from tenx import load_10x
+    matrix_dir = os.path.join(data_dir, 'filtered_feature_bc_matrix')
+    os.makedirs(matrix_dir)
+    mat = sp.coo_matrix(np.hstack([rna_mat, atac_mat]).T)
+    with open(os.path.join(matrix_dir, 'matrix.mtx'), 'w') as f:
+        f.write('%%%%MatrixMarket matrix coordinate integer general\n%d %d %d\n' % (mat.shape[0], mat.shape[1], mat.nnz))
+        np.savetxt(f, np.column_stack([mat.row + 1, mat.col + 1, mat.data]), fmt='%d')
+    with open(os.path.join(matrix_dir, 'features.tsv'), 'w') as f:
+        for i in range(mat.shape[0]):
+            f.write('ID%d\tname%d\t%s\n' % (i, i, 'Gene Expression' if i < rna_mat.shape[1] else 'Peaks'))
+    with open(os.path.join(matrix_dir, 'barcodes.tsv'), 'w') as f:
+        f.write(''.join('cell%d\n' % i for i in range(mat.shape[1])))
+    load_10x(data_dir)
+
+def peak_rss_mb():
+    #ru_maxrss is in kilobytes on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.**2 if sys.platform == 'darwin' else 1024.)
+
+def _construct(job):
+    sampler, kwargs = job
+    rss_before = peak_rss_mb()
+    start = time.time()
+    getattr(util, sampler)(**kwargs)
+    return {'seconds': time.time() - start, 'peak_rss_mb': peak_rss_mb(), 'rss_before_mb': rss_before}
+
+#every constructor runs without the feature cache in a fresh process, so its peak RSS is its own
+def bench_constructors(n_components):
+    jobs = []
+    for incremental in [False, True]:
+        suffix = '_incremental' if incremental else ''
+        for sampler in ['ARC_Sampler', 'ARC_TS_Sampler']:
+            jobs.append((sampler + suffix, sampler, dict(n_components=n_components, cache_dir=None, incremental=incremental)))
+        jobs.append(('ARC_Sampler_sparse' + suffix, 'ARC_Sampler',
+            dict(name=TENX_NAME, n_components=n_components, cache_dir=None, incremental=incremental, sparse=True)))
+    for sparse in [False, True]:
+        jobs.append(('scATAC_Sampler%s' % ('_sparse' if sparse else ''), 'scATAC_Sampler',
+            dict(name=ATAC_NAME, dim=n_components, cache_dir=None, sparse=sparse)))
+    results = {}
+    for name, sampler, kwargs in jobs:
+        pool = Pool(1, maxtasksperchild=1)
+        results[name] = pool.apply(_construct, [(sampler, kwargs)])
+        pool.close()
+        pool.join()
+    return results
+
+def _rate(fn, n_calls):
+    fn()
+    start = time.time()
+    for _ in range(n_calls):
+        fn()
+    return n_calls / (time.time() - start)
+
+def bench_get_batch(n_components, batch_size, n_calls):
+    results = {}
+    for sampler in ['ARC_Sampler', 'ARC_TS_Sampler']:
+        for mode in [1, 2, 3]:
+            ys = getattr(util, sampler)(n_components=n_components, mode=mode, cache_dir='datasets/cache')
+            results['%s_mode%d' % (sampler, mode)] = {'batches_per_sec': _rate(lambda: ys.get_batch(batch_size), n_calls)}
+    return results
+
+#steps/sec of scDEC.train and cells/sec of predict_x/predict_y, in both scripts with and without the fused step
+def bench_train(nb_classes, x_dim, y_dim, n_cells, batch_size, nb_batches, predict_cells):
+    import importlib
+    import tensorflow as tf
+    import model
+    data = util.Mixture_sampler_v2(nb_classes=nb_classes, N=n_cells, dim=y_dim)
+    ys = util.ArraySampler(data.X_c.astype(np.float32), data.X_d.astype(np.float32))
+    y_all = data.X_c[np.arange(predict_cells) % n_cells].astype(np.float32)
+    x_all, x_onehot_all = util.Mixture_sampler(nb_classes=nb_classes, N=predict_cells, dim=x_dim, sd=1).load_all()
+    results = {}
+    for script_name in ['main_cgan', 'main_trajactory_infer']:
+        script = importlib.import_module(script_name)
+        for fused in [False, True]:
+            tf.reset_default_graph()
+            g_net, h_net, dx_net, dy_net = script.build_nets(model, x_dim, y_dim, nb_classes)
+            xs = util.Mixture_sampler(nb_classes=nb_classes, N=10000, dim=x_dim, sd=1)
+            net = script.scDEC(g_net, h_net, dx_net, dy_net, xs, ys, nb_classes, 'benchmark', util.DataPool(), batch_size,
+                10.0, 10.0, True, fused=fused)
+            start = time.time()
+            #no checkpoint is saved or evaluated within the nb_batches timed updates
+            net.train(nb_batches=nb_batches, eval_every=nb_batches+1)
+            result = {'steps_per_sec': nb_batches / (time.time() - start)}
+            start = time.time()
+            net.predict_x(y_all)
+            result['predict_x_cells_per_sec'] = predict_cells / (time.time() - start)
+            start = time.time()
+            net.predict_y(x_all, x_onehot_all)
+            result['predict_y_cells_per_sec'] = predict_cells / (time.time() - start)
+            net.sess.close()
+            results['%s%s' % (script_name, '_fused' if fused else '')] = result
+    return results
+
+#modules that have to stay cheap to import, and the heavy dependencies they must not load at import time
+LIGHT_MODULES = ['util', 'pipeline', 'inference', 'npmodel', 'clustering', 'results', 'checkpoints', 'telemetry', 'sweep', 'reference', 'ann',
+    'main_cgan', 'main_trajactory_infer']
+HEAVY_MODULES = ['tensorflow', 'sklearn', 'pandas', 'matplotlib', 'seaborn']
+IMPORT_PROBE = 'import sys, time; start = time.time(); import %s; print(time.time() - start); \
+print(" ".join(sorted(set(name.split(".")[0] for name in sys.modules) & set(%r))))'
+
+#seconds to import every module in a fresh interpreter (best of `repeat`) and the heavy modules it loaded
+def bench_imports(modules=LIGHT_MODULES, repeat=3):
+    results = {}
+    for name in modules:
+        times = []
+        for _ in range(repeat):
+            output = subprocess.check_output([sys.executable, '-c', IMPORT_PROBE % (name, HEAVY_MODULES)],
+                cwd=os.path.dirname(os.path.abspath(__file__))).decode().split('\n')
+            times.append(float(output[0]))
+        results[name] = {'seconds': min(times), 'heavy_modules': output[1].split()}
+    return results
+
+#modules over the time budget or loading a heavy dependency
+def import_violations(results, budget):
+    return sorted(name for name, result in results.items() if result['seconds'] > budget or result['heavy_modules'])
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+#ratios new/old of every number present in both result files
+def compare(old, new, prefix=''):
+    for key in sorted(new):
+        if key not in old:
+            continue
+        if isinstance(new[key], dict):
+            compare(old[key], new[key], prefix + key + '.')
+        elif isinstance(new[key], (int, float)) and old[key]:
+            print('%-70s %12.4g %12.4g %8.3fx' % (prefix + key, old[key], new[key], new[key] / old[key]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('')
+    parser.add_argument('--cells', type=int, default=5000,help='number of synthetic cells')
+    parser.add_argument('--genes', type=int, default=2000,help='number of synthetic genes')
+    parser.add_argument('--peaks', type=int, default=8000,help='number of synthetic peaks')
+    parser.add_argument('--n_components', type=int, default=10,help='PCA components per modality')
+    parser.add_argument('--K', type=int, default=3,help='number of clusters for the training benchmark')
+    parser.add_argument('--dx', type=int, default=10,help='dimension of Gaussian distribution')
+    parser.add_argument('--bs', type=int, default=64,help='batch size')
+    parser.add_argument('--nb_batches', type=int, default=200,help='training batches per configuration')
+    parser.add_argument('--calls', type=int, default=2000,help='get_batch calls per sampler')
+    parser.add_argument('--predict_cells', type=int, default=100000,help='cells for the prediction benchmark')
+    parser.add_argument('--skip_train', action='store_true',help='only benchmark the samplers, TensorFlow is not imported')
+    parser.add_argument('--imports_only', action='store_true',help='only benchmark the import times')
+    parser.add_argument('--import_budget', type=float, default=None,help='exit with an error when a light module takes longer (seconds) or loads a heavy dependency')
+    parser.add_argument('--out', type=str, default='',help='JSON file for the results')
+    parser.add_argument('--compare', type=str, default='',help='previous JSON results to compare with')
+    args = parser.parse_args()
+
+    out = os.path.abspath(args.out or 'benchmark_%s.json' % datetime.datetime.now().strftime('%Y%m%d_%H%M%S'))
+    report = {'commit': git_commit(), 'date': datetime.datetime.now().isoformat(), 'python': platform.python_version(),
+        'machine': platform.machine(), 'cpus': cpu_count(), 'args': vars(args)}
+    report['imports'] = bench_imports()
+    if not args.imports_only:
+        root = tempfile.mkdtemp(prefix='scdec_bench_')
+        cwd = os.getcwd()
+        try:
+            write_fixtures(root, args.cells, args.genes, args.peaks)
+            os.chdir(root)
+            report['constructors'] = bench_constructors(args.n_components)
+            report['get_batch'] = bench_get_batch(args.n_components, args.bs, args.calls)
+            if not args.skip_train:
+                report['train'] = bench_train(args.K, args.dx, 2*args.n_components, args.cells, args.bs, args.nb_batches, args.predict_cells)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(root, ignore_errors=True)
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=1)
+    print(json.dumps(report, indent=1))
+    print('Results written to %s' % out)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+    if args.import_budget is not None:
+        violations = import_violations(report['imports'], args.import_budget)
+        if violations:
+            print('Import budget of %.2fs exceeded or heavy dependencies loaded by: %s' % (args.import_budget, ', '.join(violations)))
+            sys.exit(1)
@@ -0,0 +1,78 @@
+from __future__ import division
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+from preprocess import LinearReducer
+
+#bump when a preprocessing change makes previously cached features stale
+CACHE_VERSION = 3
+
+
+#content-addressed cache of preprocessed features (reduced matrices, fitted reducers, labels)
+#entries are keyed by the digests of the input files plus the preprocessing parameters
+class FeatureCache(object):
+    def __init__(self, cache_dir='datasets/cache'):
+        self.cache_dir = cache_dir
+        #one memo file per input path, so concurrent jobs digesting different inputs never overwrite each other
+        self.digest_dir = os.path.join(cache_dir, 'digests')
+        if not os.path.exists(self.digest_dir):
+            os.makedirs(self.digest_dir)
+
+    #sha1 of the file content, memoized on (size, mtime) so large inputs are only read once
+    def file_digest(self, path, chunk_size=1<<22):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        memo = os.path.join(self.digest_dir, '%s.json' % hashlib.sha1(path.encode('utf-8')).hexdigest())
+        if os.path.exists(memo):
+            with open(memo) as f:
+                entry = json.load(f)
+            if entry['path'] == path and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime:
+                return entry['digest']
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(chunk_size), b''):
+                sha.update(block)
+        entry = {'path': path, 'size': st.st_size, 'mtime': st.st_mtime, 'digest': sha.hexdigest()}
+        self._atomic_write(memo, lambda f: json.dump(entry, f), mode='w')
+        return entry['digest']
+
+    def key(self, files, params):
+        sha = hashlib.sha1()
+        sha.update(json.dumps({'version': CACHE_VERSION, 'params': params}, sort_keys=True).encode('utf-8'))
+        for path in files:
+            sha.update(self.file_digest(path).encode('utf-8'))
+        return sha.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, '%s.npz' % key)
+
+    def load(self, key):
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        with np.load(path, allow_pickle=False) as data:
+            return dict((k, data[k]) for k in data.files)
+
+    def save(self, key, **arrays):
+        self._atomic_write(self.path(key), lambda f: np.savez(f, **arrays))
+
+    #write to a temporary file first so concurrent jobs never read a partial entry
+    def _atomic_write(self, path, write_fn, mode='wb'):
+        tmp = '%s.tmp%d_%d' % (path, os.getpid(), threading.current_thread().ident)
+        with open(tmp, mode) as f:
+            write_fn(f)
+        os.rename(tmp, path)
+
+
+#flatten a fitted PCA-like reducer into arrays prefixed by `prefix`
+def reducer_arrays(prefix, reducer):
+    return {'%s_components' % prefix: reducer.components_,
+            '%s_mean' % prefix: reducer.mean_,
+            '%s_explained_variance' % prefix: reducer.explained_variance_}
+
+def load_reducer(arrays, prefix):
+    return LinearReducer(components=arrays['%s_components' % prefix],
+                         mean=arrays['%s_mean' % prefix],
+                         explained_variance=arrays['%s_explained_variance' % prefix])
@@ -0,0 +1,106 @@
+from __future__ import division
+import os
+import glob
+import json
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+#off the critical path evaluation and checkpointing for scDEC.train
+#BackgroundWorker runs one job at a time in a daemon thread, CheckpointKeeper applies the retention
+#policy (the last keep_last checkpoints plus the keep_best best ones by a metric) to what was saved
+
+
+class BackgroundWorker(object):
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            fn, args = item
+            try:
+                fn(*args)
+            except Exception as e:
+                #re-raised in the training thread by the next submit/wait/close
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    #block until the submitted jobs are done
+    def wait(self):
+        self.queue.join()
+        self._check()
+
+    def submit(self, fn, *args):
+        self._check()
+        self.queue.put((fn, args))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self._check()
+
+
+class CheckpointKeeper(object):
+    def __init__(self, checkpoint_dir, keep_last=5, keep_best=1, metric=None, mode='max'):
+        assert mode in ['max', 'min']
+        self.checkpoint_dir = checkpoint_dir
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.metric = metric
+        self.mode = mode
+        self.history = []
+
+    #register a checkpoint saved under the `path` prefix, delete the ones the policy no longer keeps
+    #and record everything in checkpoints.json
+    def add(self, path, step, metrics):
+        self.history.append({'step': step, 'path': path, 'metrics': metrics, 'removed': False})
+        keep = set(item['path'] for item in self.history[-self.keep_last:]) if self.keep_last > 0 else set()
+        if self.metric is not None and self.keep_best > 0:
+            keep.update(item['path'] for item in self.ranked()[:self.keep_best])
+        for item in self.history:
+            if not item['removed'] and item['path'] not in keep:
+                for name in glob.glob(item['path'] + '.*'):
+                    os.remove(name)
+                item['removed'] = True
+        tmp_path = os.path.join(self.checkpoint_dir, 'checkpoints.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'metric': self.metric, 'mode': self.mode, 'best': self.best(), 'history': self.history}, f, indent=1)
+        os.rename(tmp_path, os.path.join(self.checkpoint_dir, 'checkpoints.json'))
+
+    #checkpoints with a value of the metric, best first
+    def ranked(self):
+        scored = [item for item in self.history if item['metrics'].get(self.metric) is not None]
+        return sorted(scored, key=lambda item: item['metrics'][self.metric], reverse=self.mode == 'max')
+
+    def best(self):
+        ranked = self.ranked() if self.metric is not None else []
+        return ranked[0]['path'] if ranked else None
+
+#checkpoint prefix to restore from a checkpoint directory: the best one recorded in checkpoints.json,
+#else the last one kept, else the latest of the TensorFlow checkpoint state
+def find_checkpoint(checkpoint_dir):
+    path = os.path.join(checkpoint_dir, 'checkpoints.json')
+    if os.path.exists(path):
+        with open(path) as f:
+            record = json.load(f)
+        kept = [item['path'] for item in record['history'] if not item['removed']]
+        if record['best'] is not None or kept:
+            return record['best'] or kept[-1]
+    import tensorflow as tf
+    return tf.train.latest_checkpoint(checkpoint_dir)
@@ -0,0 +1,135 @@
+from __future__ import division
+import numpy as np
+from scipy.special import gammaln
+
+#clustering quality from one contingency table: NMI, ARI, AMI, homogeneity, completeness, V-measure
+#and purity all derive from the (classes, clusters) count matrix, so every score costs O(N) once plus
+#O(classes x clusters); definitions follow sklearn (arithmetic mean normalization for NMI and AMI)
+
+
+#(classes, clusters) counts of the label pairs, labels can be any hashable values
+def contingency(labels_true, labels_pred):
+    classes, true_idx = np.unique(np.asarray(labels_true).ravel(), return_inverse=True)
+    clusters, pred_idx = np.unique(np.asarray(labels_pred).ravel(), return_inverse=True)
+    counts = np.bincount(true_idx.ravel() * len(clusters) + pred_idx.ravel(), minlength=len(classes) * len(clusters))
+    return counts.reshape(len(classes), len(clusters))
+
+def _entropy(counts, n):
+    p = counts[counts > 0] / n
+    return -np.sum(p * np.log(p))
+
+def _mutual_info(C, n, a, b):
+    i, j = np.nonzero(C)
+    nij = C[i, j].astype(np.float64)
+    return np.sum(nij / n * (np.log(nij * n) - np.log(a[i]) - np.log(b[j])))
+
+#expected mutual information of two random labelings with the marginals of C (hypergeometric model)
+def expected_mutual_info(C):
+    a, b = C.sum(axis=1).astype(np.float64), C.sum(axis=0).astype(np.float64)
+    n = a.sum()
+    gln_n = gammaln(n + 1)
+    emi = 0.
+    for ai in a:
+        for bj in b:
+            nij = np.arange(max(1, ai - n + bj), min(ai, bj) + 1)
+            if not len(nij):
+                continue
+            log_p = (gammaln(ai + 1) + gammaln(bj + 1) + gammaln(n - ai + 1) + gammaln(n - bj + 1) - gln_n - gammaln(nij + 1)
+                - gammaln(ai - nij + 1) - gammaln(bj - nij + 1) - gammaln(n - ai - bj + nij + 1))
+            emi += np.sum(nij / n * (np.log(n * nij) - np.log(ai) - np.log(bj)) * np.exp(log_p))
+    return emi
+
+def _comb2(x):
+    x = np.asarray(x, dtype=np.float64)
+    return np.sum(x * (x - 1) / 2.)
+
+#all scores of a contingency table, rows are the true classes and columns the clusters
+def scores_from_contingency(C, ami=True):
+    C = np.asarray(C, dtype=np.int64)
+    C = C[C.sum(axis=1) > 0][:, C.sum(axis=0) > 0]
+    n = C.sum()
+    a, b = C.sum(axis=1).astype(np.float64), C.sum(axis=0).astype(np.float64)
+    scores = {'n': int(n), 'n_classes': C.shape[0], 'n_clusters': C.shape[1]}
+    if n == 0:
+        return scores
+    scores['purity'] = C.max(axis=0).sum() / n
+    #adjusted Rand index from the pair counts
+    sum_comb, sum_a, sum_b = _comb2(C), _comb2(a), _comb2(b)
+    expected = sum_a * sum_b / _comb2(n)
+    max_index = (sum_a + sum_b) / 2.
+    scores['ari'] = 1. if max_index == expected else (sum_comb - expected) / (max_index - expected)
+    h_true, h_pred = _entropy(a, n), _entropy(b, n)
+    mi = _mutual_info(C, n, a, b)
+    if C.shape[0] == C.shape[1] == 1:
+        scores['nmi'] = 1.
+    else:
+        scores['nmi'] = mi / max((h_true + h_pred) / 2., np.finfo(np.float64).eps)
+    scores['homogeneity'] = 1. if h_true == 0 else mi / h_true
+    scores['completeness'] = 1. if h_pred == 0 else mi / h_pred
+    total = scores['homogeneity'] + scores['completeness']
+    scores['v_measure'] = 0. if total == 0 else 2. * scores['homogeneity'] * scores['completeness'] / total
+    if ami:
+        if C.shape[0] == C.shape[1] == 1:
+            scores['ami'] = 1.
+        else:
+            emi = expected_mutual_info(C)
+            denominator = (h_true + h_pred) / 2. - emi
+            denominator = min(denominator, -np.finfo(np.float64).eps) if denominator < 0 else max(denominator, np.finfo(np.float64).eps)
+            scores['ami'] = (mi - emi) / denominator
+    return scores
+
+#the scores tracked as training metrics, stored as floats (JSON) with an optional prefix
+CLUSTER_METRICS = ['nmi', 'ari', 'ami', 'homogeneity', 'completeness', 'v_measure', 'purity']
+
+def cluster_metrics(scores, prefix=''):
+    return dict((prefix + name, float(scores[name])) for name in CLUSTER_METRICS + ['n_clusters'] if name in scores)
+
+def clustering_scores(labels_true, labels_pred, ami=True):
+    return scores_from_contingency(contingency(labels_true, labels_pred), ami)
+
+#scores of the encoder's own assignments: hard labels argmax(x_onehot_) from the soft assignments
+#of predict_x, labels_true may be one-hot
+def assignment_scores(labels_true, soft=None, hard=None, ami=True):
+    labels_true = np.asarray(labels_true)
+    if len(labels_true.shape) == 2:
+        labels_true = np.argmax(labels_true, axis=1)
+    if hard is None:
+        hard = np.argmax(soft, axis=1)
+    return clustering_scores(labels_true, hard, ami)
+
+
+#contingency table accumulated over mini-batches of (true, predicted) integer labels, e.g. while
+#predicting chunk by chunk, without keeping the labels
+class StreamingContingency(object):
+    def __init__(self, n_classes=1, n_clusters=1):
+        self.table = np.zeros((n_classes, n_clusters), dtype=np.int64)
+
+    def update(self, labels_true, labels_pred):
+        labels_true = np.asarray(labels_true, dtype=np.int64).ravel()
+        labels_pred = np.asarray(labels_pred, dtype=np.int64).ravel()
+        rows = max(self.table.shape[0], labels_true.max() + 1 if len(labels_true) else 0)
+        cols = max(self.table.shape[1], labels_pred.max() + 1 if len(labels_pred) else 0)
+        if (rows, cols) != self.table.shape:
+            table = np.zeros((rows, cols), dtype=np.int64)
+            table[:self.table.shape[0], :self.table.shape[1]] = self.table
+            self.table = table
+        self.table += np.bincount(labels_true * cols + labels_pred, minlength=rows * cols).reshape(rows, cols)
+        return self
+
+    def scores(self, ami=True):
+        return scores_from_contingency(self.table, ami)
+
+
+#MiniBatchKMeans labels as a cheap baseline to full KMeans
+def kmeans_labels(X, n_clusters, minibatch=True, batch_size=1024, random_state=0):
+    if minibatch:
+        from sklearn.cluster import MiniBatchKMeans
+        km = MiniBatchKMeans(n_clusters=n_clusters, batch_size=batch_size, random_state=random_state)
+    else:
+        from sklearn.cluster import KMeans
+        km = KMeans(n_clusters=n_clusters, random_state=random_state)
+    return km.fit_predict(X)
+
+def print_scores(scores):
+    print('NMI = {}, ARI = {}, Purity = {},AMI = {}, Homogeneity = {}'.format(scores['nmi'], scores['ari'], scores['purity'],
+        scores.get('ami'), scores['homogeneity']))
@@ -0,0 +1,101 @@
+from __future__ import division
+import json
+import argparse
+import importlib
+import numpy as np
+import tensorflow as tf
+from inference import auto_chunk_size, allocate, run_chunked
+
+#lean inference artifact for a trained scDEC model
+#export_frozen rebuilds only h_net (and optionally g_net) on fresh placeholders, restores their weights
+#from a training checkpoint and folds the variables into constants; FrozenScDEC serves the result
+#without discriminators, gradient penalties, optimizer slots or output directories
+
+
+def export_frozen(checkpoint, out_path, x_dim, y_dim, nb_classes, model='model', with_generator=False,
+        h_layers=10, h_units=256, g_layers=10, g_units=512):
+    model = importlib.import_module(model)
+    graph = tf.Graph()
+    with graph.as_default():
+        h_net = model.Encoder(input_dim=y_dim,output_dim = x_dim+nb_classes,feat_dim=x_dim,name='h_net',nb_layers=h_layers,nb_units=h_units)
+        y = tf.placeholder(tf.float32, [None, y_dim], name='y')
+        x_latent_, x_onehot_ = h_net(y, reuse=False)
+        tf.identity(x_latent_, name='embeds')
+        tf.identity(x_onehot_, name='soft')
+        tf.argmax(x_onehot_, axis=1, output_type=tf.int32, name='labels')
+        outputs = ['embeds', 'soft', 'labels']
+        var_list = h_net.vars
+        if with_generator:
+            g_net = model.Generator(input_dim=x_dim,output_dim = y_dim,name='g_net',nb_layers=g_layers,nb_units=g_units,concat_every_fcl=False)
+            x = tf.placeholder(tf.float32, [None, x_dim], name='x')
+            x_onehot = tf.placeholder(tf.float32, [None, nb_classes], name='x_onehot')
+            tf.identity(g_net(tf.concat([x, x_onehot], axis=1), reuse=False), name='generated')
+            outputs.append('generated')
+            var_list = var_list + g_net.vars
+        with tf.Session(graph=graph) as sess:
+            tf.train.Saver(var_list=var_list).restore(sess, checkpoint)
+            graph_def = tf.graph_util.convert_variables_to_constants(sess, graph.as_graph_def(), outputs)
+    with tf.gfile.GFile(out_path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    with open(out_path + '.json', 'w') as f:
+        json.dump({'x_dim': x_dim, 'y_dim': y_dim, 'nb_classes': nb_classes, 'outputs': outputs, 'checkpoint': checkpoint}, f, indent=1)
+    print('Exported %s to %s' % (', '.join(outputs), out_path))
+
+
+#loads a frozen graph into its own small session, embed/cluster/generate are chunked like scDEC.predict_*
+class FrozenScDEC(object):
+    def __init__(self, path, intra_op_threads=0, inter_op_threads=0):
+        with open(path + '.json') as f:
+            meta = json.load(f)
+        self.x_dim = meta['x_dim']
+        self.y_dim = meta['y_dim']
+        self.nb_classes = meta['nb_classes']
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        get = self.graph.get_tensor_by_name
+        self.y = get('y:0')
+        self.embeds, self.soft, self.labels = get('embeds:0'), get('soft:0'), get('labels:0')
+        self.has_generator = 'generated' in meta['outputs']
+        if self.has_generator:
+            self.x, self.x_onehot, self.generated = get('x:0'), get('x_onehot:0'), get('generated:0')
+        run_config = tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads, inter_op_parallelism_threads=inter_op_threads)
+        self.sess = tf.Session(graph=self.graph, config=run_config)
+        self.row_bytes = 4*(self.x_dim + self.y_dim + 2*self.nb_classes + 1024)
+
+    #embeddings x_latent_ and soft assignments x_onehot_ = H(y)
+    def embed(self, y, bs=None):
+        assert y.shape[-1] == self.y_dim
+        outs = [allocate((y.shape[0], self.x_dim+self.nb_classes)), allocate((y.shape[0], self.nb_classes))]
+        return run_chunked(self.sess, [self.embeds, self.soft], {self.y: y}, outs, bs or auto_chunk_size(self.row_bytes))
+
+    #hard cluster labels argmax(x_onehot_)
+    def cluster(self, y, bs=None):
+        assert y.shape[-1] == self.y_dim
+        outs = [allocate((y.shape[0],), dtype=np.int32)]
+        return run_chunked(self.sess, [self.labels], {self.y: y}, outs, bs or auto_chunk_size(self.row_bytes))[0]
+
+    #y_ = G(x, x_onehot), only when exported with the generator
+    def generate(self, x, x_onehot, bs=None):
+        assert self.has_generator, 'exported without --with_generator'
+        outs = [allocate((x.shape[0], self.y_dim))]
+        return run_chunked(self.sess, [self.generated], {self.x: x, self.x_onehot: x_onehot}, outs, bs or auto_chunk_size(self.row_bytes))[0]
+
+    def close(self):
+        self.sess.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('')
+    parser.add_argument('--checkpoint', type=str, required=True,help='checkpoint prefix, e.g. checkpoint/<run>/model.ckpt-99999')
+    parser.add_argument('--out', type=str, required=True,help='path of the frozen graph (.pb), metadata goes to <out>.json')
+    parser.add_argument('--model', type=str, default='model',help='model definition')
+    parser.add_argument('--K', type=int, default=11,help='number of clusters')
+    parser.add_argument('--dx', type=int, default=10,help='dimension of Gaussian distribution')
+    parser.add_argument('--dy', type=int, default=20,help='dimension of preprocessed data')
+    parser.add_argument('--with_generator', action='store_true',help='also export g_net')
+    args = parser.parse_args()
+    export_frozen(args.checkpoint, args.out, args.dx, args.dy, args.K, model=args.model, with_generator=args.with_generator)
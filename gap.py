@@ -0,0 +1,88 @@
+from __future__ import division
+import copy
+import numpy as np
+
+#gap statistic (Tibshirani, Walther and Hastie, 2001) for choosing the number of clusters
+#gap(k) = E*[log W_k] - log W_k, where E* is the mean over uniform reference datasets
+
+
+#within-cluster dispersion W_k = sum_r D_r / (2 n_r) with squared euclidean distances,
+#computed through the centroid identity D_r / (2 n_r) = sum_{i in r} ||x_i - mean_r||^2 in O(n d)
+def dispersion(X, labels):
+    labels = np.unique(labels, return_inverse=True)[1].ravel()
+    counts = np.bincount(labels)
+    sums = np.stack([np.bincount(labels, weights=X[:, j], minlength=len(counts)) for j in range(X.shape[1])], axis=1)
+    return np.sum(np.square(X, dtype=np.float64)) - np.sum(np.sum(sums**2, axis=1) / counts)
+
+def _cluster_labels(X, k, clustering, n_init, seed):
+    if clustering is None:
+        from sklearn.cluster import KMeans
+        clustering = KMeans(n_clusters=k, n_init=n_init, random_state=seed)
+    else:
+        clustering = copy.deepcopy(clustering)
+        clustering.n_clusters = k
+    return clustering.fit_predict(X)
+
+#reference data drawn uniformly over the bounding box of the data, optionally in its principal axes
+def _reference(shape, mins, maxs, rotation, seed):
+    rng = np.random.RandomState(seed)
+    ref = rng.uniform(size=shape) * (maxs - mins) + mins
+    if rotation is not None:
+        ref = ref.dot(rotation)
+    return ref
+
+#log W_k of one reference dataset, run in a worker process
+def _reference_log_dispersion(args):
+    shape, mins, maxs, rotation, k, clustering, n_init, seed = args
+    ref = _reference(shape, mins, maxs, rotation, seed)
+    return np.log(dispersion(ref, _cluster_labels(ref, k, clustering, n_init, seed)))
+
+#gap(k) and its standard error s_k for k = k_min..k_max, the reference datasets of each k are
+#clustered in parallel by n_jobs processes; with early_stop the scan ends at the first k that
+#satisfies the 1-SE rule gap(k) >= gap(k+1) - s_{k+1}
+def gap_statistic(data, k_max=10, k_min=2, n_references=20, clustering=None, n_init=3, n_jobs=1,
+        early_stop=True, pca_reference=False, random_state=0):
+    data = np.asarray(data, dtype=np.float64)
+    if len(data.shape) == 1:
+        data = data.reshape(-1, 1)
+    rotation = None
+    X = data
+    if pca_reference:
+        #box aligned with the principal axes of the centered data
+        X = data - data.mean(axis=0)
+        _, _, rotation = np.linalg.svd(X, full_matrices=False)
+        X = X.dot(rotation.T)
+    mins, maxs = X.min(axis=0), X.max(axis=0)
+
+    pool = None
+    if n_jobs != 1:
+        from multiprocessing import Pool
+        pool = Pool(None if n_jobs < 0 else n_jobs)
+    ks, gap, sk, log_wk, log_ref = [], [], [], [], []
+    best_k = None
+    try:
+        for k in range(k_min, k_max+1):
+            tasks = [(X.shape, mins, maxs, rotation, k, clustering, n_init, random_state + k*n_references + b) for b in range(n_references)]
+            ref_logs = np.array(pool.map(_reference_log_dispersion, tasks) if pool is not None else list(map(_reference_log_dispersion, tasks)))
+            ks.append(k)
+            log_wk.append(np.log(dispersion(data, _cluster_labels(data, k, clustering, n_init, random_state))))
+            log_ref.append(np.mean(ref_logs))
+            gap.append(log_ref[-1] - log_wk[-1])
+            sk.append(np.std(ref_logs) * np.sqrt(1 + 1.0 / n_references))
+            if best_k is None and len(gap) > 1 and gap[-2] >= gap[-1] - sk[-1]:
+                best_k = ks[-2]
+                if early_stop:
+                    break
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if best_k is None:
+        best_k = ks[int(np.argmax(gap))]
+    return {'k': np.array(ks), 'gap': np.array(gap), 'sk': np.array(sk), 'log_wk': np.array(log_wk),
+            'log_ref': np.array(log_ref), 'best_k': best_k}
+
+def print_gap(result):
+    print('k\tgap\ts_k\tlog(W_k)\tE*log(W_k)')
+    for k, g, s, w, r in zip(result['k'], result['gap'], result['sk'], result['log_wk'], result['log_ref']):
+        print('%d\t%.4f\t%.4f\t%.4f\t%.4f%s' % (k, g, s, w, r, '\t<-' if k == result['best_k'] else ''))
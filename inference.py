@@ -0,0 +1,42 @@
+from __future__ import division
+import os
+import numpy as np
+
+#chunked inference helpers for scDEC.predict_x / predict_y / predict_all
+#results are float32 and written in place into preallocated or memory-mapped outputs
+
+
+#physical memory currently available, 1GB when the platform does not report it
+def available_memory():
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return 1 << 30
+
+#rows per chunk so that one chunk of inputs, activations and outputs uses a fraction of the free memory
+def auto_chunk_size(row_bytes, memory_fraction=0.05, min_size=256, max_size=1 << 18):
+    size = int(available_memory() * memory_fraction // max(row_bytes, 1))
+    return int(min(max(size, min_size), max_size))
+
+#output array: the caller's `out`, a .npy memmap at `path`, or a new array
+def allocate(shape, dtype=np.float32, out=None, path=None):
+    if out is not None:
+        assert out.shape == tuple(shape), 'output of shape %s expected, got %s' % (tuple(shape), out.shape)
+        return out
+    if path is not None:
+        return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=tuple(shape))
+    return np.empty(shape, dtype=dtype)
+
+#evaluate `fetches` chunk by chunk, feeds maps placeholders to (N, ...) arrays (possibly memory-mapped),
+#the i-th fetched value of every chunk is written into outs[i]
+def run_chunked(sess, fetches, feeds, outs, chunk_size):
+    N = outs[0].shape[0]
+    for start in range(0, N, chunk_size):
+        end = min(start + chunk_size, N)
+        results = sess.run(fetches, feed_dict=dict((k, v[start:end]) for k, v in feeds.items()))
+        for out, result in zip(outs, results):
+            out[start:end] = result
+    for out in outs:
+        if isinstance(out, np.memmap):
+            out.flush()
+    return outs
@@ -0,0 +1,22 @@
+from __future__ import division
+import importlib
+
+#module proxy imported on first attribute access: a script can name `tf` at module level while
+#`--help`, argument errors and the processes that only import it for a sampler or a helper never load TensorFlow
+
+
+class LazyModule(object):
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        return '<lazy module %r%s>' % (self._name, '' if self._module is None else ' (loaded)')
@@ -5,20 +5,24 @@ import dateutil.tz
 import datetime
 import argparse
 import importlib
-import tensorflow as tf
+from lazy import LazyModule
 import numpy as np
 import random
 import copy
 import math
 import util
-import metric
-from sklearn.cluster import KMeans
-from sklearn.metrics.cluster import normalized_mutual_info_score, adjusted_rand_score,homogeneity_score
-import pandas as pd 
+from pipeline import BatchPrefetcher, draw_iteration, check_nb_classes, choose_nb_classes
+from inference import auto_chunk_size, allocate, run_chunked
+from npmodel import export_weights, net_spec, build_nets as build_numpy_nets, NumpyScDEC
+from checkpoints import BackgroundWorker, CheckpointKeeper, find_checkpoint
+from results import ResultsStore
+from clustering import CLUSTER_METRICS, assignment_scores, cluster_metrics, kmeans_labels
+from telemetry import Telemetry
+from reference import reference_from_sampler
+from ann import IVFIndex
 
-
-tf.set_random_seed(0)
-tf.reset_default_graph()
+#TensorFlow is imported on first use, after the arguments are parsed
+tf = LazyModule('tensorflow')
 
 
 '''
@@ -35,7 +39,9 @@ Instructions: scDEC model
     Dy(.) - discriminator network in y space (observation space)
 '''
 class scDEC(object):
-    def __init__(self, g_net, h_net, dx_net, dy_net, x_sampler, y_sampler, nb_classes, data, pool, batch_size, alpha, beta, is_train):
+    def __init__(self, g_net, h_net, dx_net, dy_net, x_sampler, y_sampler, nb_classes, data, pool, batch_size, alpha, beta, is_train, fused=False, num_towers=1,
+            ratio=0.2, has_label=True, timestamp=None, intra_op_threads=0, inter_op_threads=0,
+            results_dtype='float32', legacy_results=False, kmeans_baseline=False):
         self.data = data
         self.g_net = g_net
         self.h_net = h_net
@@ -43,90 +49,33 @@ class scDEC(object):
         self.dy_net = dy_net
         self.x_sampler = x_sampler
         self.y_sampler = y_sampler
+        #fail before building the graph when K does not match the conditioning labels
+        check_nb_classes(y_sampler, nb_classes)
         self.nb_classes = nb_classes
         self.batch_size = batch_size
         self.alpha = alpha
         self.beta = beta
         self.pool = pool
+        self.ratio = ratio
+        self.has_label = has_label
         self.x_dim = self.dx_net.input_dim
         self.y_dim = self.dy_net.input_dim
 
 
-        self.x = tf.placeholder(tf.float32, [None, self.x_dim], name='x')
-        self.x_onehot = tf.placeholder(tf.float32, [None, self.nb_classes], name='x_onehot')
-        self.x_combine = tf.concat([self.x,self.x_onehot],axis=1,name='x_combine')
-
-        self.y = tf.placeholder(tf.float32, [None, self.y_dim], name='y')
-
-        self.y_ = self.g_net(self.x_combine,reuse=False)
-
-        self.x_latent_, self.x_onehot_ = self.h_net(self.y,reuse=False)#continuous + softmax + before_softmax
-        self.x_ = self.x_latent_[:,:self.x_dim]
-        self.x_logits_ = self.x_latent_[:,self.x_dim:]
-        
-        self.x_latent__, self.x_onehot__ = self.h_net(self.y_)
-        self.x__ = self.x_latent__[:,:self.x_dim]
-        self.x_logits__ = self.x_latent__[:,self.x_dim:]
-
-        self.x_combine_ = tf.concat([self.x_, self.x_onehot_],axis=1)
-        self.y__ = self.g_net(self.x_combine_)
-        
-        self.dy_ = self.dy_net(tf.concat([self.y_,self.x_onehot],axis=1), reuse=False)
-        self.dx_ = self.dx_net(self.x_, reuse=False)
-
-        self.l2_loss_x = tf.reduce_mean((self.x - self.x__)**2)
-        self.l2_loss_y = tf.reduce_mean((self.y - self.y__)**2)
-
-        #self.CE_loss_x = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits_v2(labels=self.x_onehot, logits=self.x_logits__))
-        self.CE_loss_x = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(logits=self.x_logits__,labels=self.x_onehot))
-        
-        self.g_loss_adv = -tf.reduce_mean(self.dy_)
-        self.h_loss_adv = -tf.reduce_mean(self.dx_)
-        
-
-        self.g_loss = self.g_loss_adv + self.alpha*self.l2_loss_x + self.beta*self.l2_loss_y
-        self.h_loss = self.h_loss_adv + self.alpha*self.l2_loss_x + self.beta*self.l2_loss_y
-        self.g_h_loss = self.g_loss_adv + self.h_loss_adv + self.alpha*(self.l2_loss_x + self.l2_loss_y) + self.beta*self.CE_loss_x
-       
-        self.dx = self.dx_net(self.x)
-        self.dy = self.dy_net(tf.concat([self.y,self.x_onehot],axis=1))
-
-        self.dx_loss = -tf.reduce_mean(self.dx) + tf.reduce_mean(self.dx_)
-        self.dy_loss = -tf.reduce_mean(self.dy) + tf.reduce_mean(self.dy_)
-
-        #gradient penalty for x
-        epsilon_x = tf.random_uniform([], 0.0, 1.0)
-        x_hat = epsilon_x * self.x + (1 - epsilon_x) * self.x_
-        dx_hat = self.dx_net(x_hat)
-        grad_x = tf.gradients(dx_hat, x_hat)[0] #(bs,x_dim)
-        grad_norm_x = tf.sqrt(tf.reduce_sum(tf.square(grad_x), axis=1))#(bs,)
-        self.gpx_loss = tf.reduce_mean(tf.square(grad_norm_x - 1.0))
-
-        #gradient penalty for y
-        epsilon_y = tf.random_uniform([], 0.0, 1.0)
-        y_hat = epsilon_y * self.y + (1 - epsilon_y) * self.y_
-        dy_hat = self.dy_net(tf.concat([y_hat,self.x_onehot],axis=1))
-        grad_y = tf.gradients(dy_hat, y_hat)[0] #(bs,x_dim)
-        grad_norm_y = tf.sqrt(tf.reduce_sum(tf.square(grad_y), axis=1))#(bs,)
-        self.gpy_loss = tf.reduce_mean(tf.square(grad_norm_y - 1.0))
-
-        self.d_loss = self.dx_loss + self.dy_loss + 10*(self.gpx_loss + self.gpy_loss)
-
-        self.lr = tf.placeholder(tf.float32, None, name='learning_rate')
-        self.g_optim = tf.train.AdamOptimizer(learning_rate=self.lr, beta1=0.5, beta2=0.9) \
-                .minimize(self.g_loss_adv, var_list=self.g_net.vars)
-        self.dy_optim = tf.train.AdamOptimizer(learning_rate=self.lr, beta1=0.5, beta2=0.9) \
-                .minimize(self.dy_loss+10*self.gpy_loss, var_list=self.dy_net.vars)
-
-        self.g_h_optim = tf.train.AdamOptimizer(learning_rate=self.lr, beta1=0.5, beta2=0.9) \
-                .minimize(self.g_h_loss, var_list=self.g_net.vars+self.h_net.vars)
-        #self.d_optim = tf.train.GradientDescentOptimizer(learning_rate=self.lr) \
-        #        .minimize(self.d_loss, var_list=self.dx_net.vars+self.dy_net.vars)
-        self.d_optim = tf.train.AdamOptimizer(learning_rate=self.lr, beta1=0.5, beta2=0.9) \
-                .minimize(self.d_loss, var_list=self.dx_net.vars+self.dy_net.vars)
+        self.nb_critic = 5
+        self.fused = fused
+        self.num_towers = num_towers
+        if fused:
+            #resource variables, so that reads are ordered by the control dependencies of the fused step;
+            #only the variables of this model, the root scope of the graph is left untouched
+            with tf.variable_scope(tf.get_variable_scope(), use_resource=True):
+                self.build_graph()
+        else:
+            self.build_graph()
 
         now = datetime.datetime.now(dateutil.tz.tzlocal())
-        self.timestamp = now.strftime('%Y%m%d_%H%M%S')
+        self.timestamp = timestamp or now.strftime('%Y%m%d_%H%M%S')
+        self.checkpoint_dir = 'checkpoint/{}_{}_x_dim={}_y_dim={}_alpha={}_beta={}'.format(self.timestamp,self.data,self.x_dim, self.y_dim, self.alpha, self.beta)
 
         self.g_loss_adv_summary = tf.summary.scalar('g_loss_adv',self.g_loss_adv)
         self.h_loss_adv_summary = tf.summary.scalar('h_loss_adv',self.h_loss_adv)
@@ -141,120 +90,448 @@ class scDEC(object):
         self.d_merged_summary = tf.summary.merge([self.dx_loss_summary,self.dy_loss_summary])
 
         #graph path for tensorboard visualization
-        self.graph_dir = 'graph/{}/{}_x_dim={}_y_dim={}_alpha={}_beta={}_ratio={}'.format(self.data,self.timestamp,self.x_dim, self.y_dim, self.alpha, self.beta, ratio)
+        self.graph_dir = 'graph/{}/{}_x_dim={}_y_dim={}_alpha={}_beta={}_ratio={}'.format(self.data,self.timestamp,self.x_dim, self.y_dim, self.alpha, self.beta, self.ratio)
         if not os.path.exists(self.graph_dir) and is_train:
             os.makedirs(self.graph_dir)
         
         #save path for saving predicted data
-        self.save_dir = 'results/{}/{}_x_dim={}_y_dim={}_alpha={}_beta={}_ratio={}'.format(self.data,self.timestamp,self.x_dim, self.y_dim, self.alpha, self.beta, ratio)
+        self.save_dir = 'results/{}/{}_x_dim={}_y_dim={}_alpha={}_beta={}_ratio={}'.format(self.data,self.timestamp,self.x_dim, self.y_dim, self.alpha, self.beta, self.ratio)
         if not os.path.exists(self.save_dir) and is_train:
             os.makedirs(self.save_dir)
+        #evaluation outputs, one compressed dataset per array and evaluation step
+        self.results = ResultsStore(os.path.join(self.save_dir, 'results.h5'), dtype=results_dtype)
+        self.legacy_results = legacy_results
+        self.kmeans_baseline = kmeans_baseline
 
-        self.saver = tf.train.Saver(max_to_keep=5000)
+        #train() keeps its checkpoints with self.keeper, this saver restores them and serves save()
+        self.saver = tf.train.Saver(var_list=self.checkpoint_variables(), max_to_keep=5)
 
         #run_config = tf.ConfigProto(intra_op_parallelism_threads=1,inter_op_parallelism_threads=1)
-        run_config = tf.ConfigProto()
+        run_config = tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads,inter_op_parallelism_threads=inter_op_threads)
+        if num_towers > 1:
+            #one CPU device per tower
+            run_config.device_count['CPU'] = num_towers
+            run_config.allow_soft_placement = True
         run_config.gpu_options.per_process_gpu_memory_fraction = 1.0
         run_config.gpu_options.allow_growth = True
 
         self.sess = tf.Session(config=run_config)
 
 
-    def train(self, nb_batches):
+    #placeholders, networks, losses and update ops
+    def build_graph(self):
+        self.x = tf.placeholder(tf.float32, [None, self.x_dim], name='x')
+        self.x_onehot = tf.placeholder(tf.float32, [None, self.nb_classes], name='x_onehot')
+        self.y = tf.placeholder(tf.float32, [None, self.y_dim], name='y')
+
+        #generator samples replayed from self.pool, empty unless fed
+        self.y_replay = tf.placeholder_with_default(tf.zeros([0, self.y_dim]), [None, self.y_dim], name='y_replay')
+        self.x_onehot_replay = tf.placeholder_with_default(tf.zeros([0, self.nb_classes]), [None, self.nb_classes], name='x_onehot_replay')
+
+        for name, tensor in self.build_losses(self.x, self.x_onehot, self.y, reuse=False, y_replay=self.y_replay,
+                x_onehot_replay=self.x_onehot_replay).items():
+            setattr(self, name, tensor)
+        self.x_label_ = tf.argmax(self.x_onehot_, axis=1, output_type=tf.int32, name='x_label_')
+        if self.num_towers > 1:
+            towers = self.build_towers(self.x, self.x_onehot, self.y)
+            #losses in the summaries and the quick test are averaged over the towers
+            for name in ['l2_loss_x', 'l2_loss_y', 'CE_loss_x', 'g_loss_adv', 'h_loss_adv', 'g_loss', 'h_loss', 'g_h_loss',
+                    'dx_loss', 'dy_loss', 'gpx_loss', 'gpy_loss', 'd_loss']:
+                setattr(self, name, tf.add_n([l[name] for l in towers]) / self.num_towers)
+
+        self.lr = tf.placeholder(tf.float32, None, name='learning_rate')
+        self.g_optimizer = tf.train.AdamOptimizer(learning_rate=self.lr, beta1=0.5, beta2=0.9)
+        self.dy_optimizer = tf.train.AdamOptimizer(learning_rate=self.lr, beta1=0.5, beta2=0.9)
+        if self.num_towers > 1:
+            self.g_optim = self.tower_update(self.g_optimizer, lambda l: l['g_loss_adv'], self.g_net.vars, towers)
+            self.dy_optim = self.tower_update(self.dy_optimizer, lambda l: l['dy_loss']+10*l['gpy_loss'], self.dy_net.vars, towers)
+        else:
+            self.g_optim = self.g_optimizer.minimize(self.g_loss_adv, var_list=self.g_net.vars)
+            self.dy_optim = self.dy_optimizer.minimize(self.dy_loss+10*self.gpy_loss, var_list=self.dy_net.vars)
+
+        self.g_h_optim = tf.train.AdamOptimizer(learning_rate=self.lr, beta1=0.5, beta2=0.9) \
+                .minimize(self.g_h_loss, var_list=self.g_net.vars+self.h_net.vars)
+        #self.d_optim = tf.train.GradientDescentOptimizer(learning_rate=self.lr) \
+        #        .minimize(self.d_loss, var_list=self.dx_net.vars+self.dy_net.vars)
+        self.d_optim = tf.train.AdamOptimizer(learning_rate=self.lr, beta1=0.5, beta2=0.9) \
+                .minimize(self.d_loss, var_list=self.dx_net.vars+self.dy_net.vars)
+
+        if self.fused:
+            self.build_fused_step()
+
+    #networks and losses on one batch (x, x_onehot, y), reuse=False creates the variables
+    #replayed samples (y_replay, x_onehot_replay) join the current generator samples as fakes of the critic
+    def build_losses(self, x, x_onehot, y, reuse=True, y_replay=None, x_onehot_replay=None):
+        x_combine = tf.concat([x,x_onehot],axis=1,name='x_combine')
+
+        y_ = self.g_net(x_combine,reuse=reuse)
+
+        x_latent_, x_onehot_ = self.h_net(y,reuse=reuse)#continuous + softmax + before_softmax
+        x_ = x_latent_[:,:self.x_dim]
+        x_logits_ = x_latent_[:,self.x_dim:]
+        
+        x_latent__, x_onehot__ = self.h_net(y_)
+        x__ = x_latent__[:,:self.x_dim]
+        x_logits__ = x_latent__[:,self.x_dim:]
+
+        x_combine_ = tf.concat([x_, x_onehot_],axis=1)
+        y__ = self.g_net(x_combine_)
+        
+        dy_ = self.dy_net(tf.concat([y_,x_onehot],axis=1), reuse=reuse)
+        dx_ = self.dx_net(x_, reuse=reuse)
+
+        l2_loss_x = tf.reduce_mean((x - x__)**2)
+        l2_loss_y = tf.reduce_mean((y - y__)**2)
+
+        #CE_loss_x = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits_v2(labels=x_onehot, logits=x_logits__))
+        CE_loss_x = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(logits=x_logits__,labels=x_onehot))
+        
+        g_loss_adv = -tf.reduce_mean(dy_)
+        h_loss_adv = -tf.reduce_mean(dx_)
+        
+
+        g_loss = g_loss_adv + self.alpha*l2_loss_x + self.beta*l2_loss_y
+        h_loss = h_loss_adv + self.alpha*l2_loss_x + self.beta*l2_loss_y
+        g_h_loss = g_loss_adv + h_loss_adv + self.alpha*(l2_loss_x + l2_loss_y) + self.beta*CE_loss_x
+       
+        dx = self.dx_net(x)
+        dy = self.dy_net(tf.concat([y,x_onehot],axis=1))
+
+        dx_loss = -tf.reduce_mean(dx) + tf.reduce_mean(dx_)
+        dy_fake = dy_
+        if y_replay is not None:
+            dy_fake = tf.concat([dy_, self.dy_net(tf.concat([y_replay,x_onehot_replay],axis=1))],axis=0)
+        dy_loss = -tf.reduce_mean(dy) + tf.reduce_mean(dy_fake)
+
+        #gradient penalty for x
+        epsilon_x = tf.random_uniform([], 0.0, 1.0)
+        x_hat = epsilon_x * x + (1 - epsilon_x) * x_
+        dx_hat = self.dx_net(x_hat)
+        grad_x = tf.gradients(dx_hat, x_hat)[0] #(bs,x_dim)
+        grad_norm_x = tf.sqrt(tf.reduce_sum(tf.square(grad_x), axis=1))#(bs,)
+        gpx_loss = tf.reduce_mean(tf.square(grad_norm_x - 1.0))
+
+        #gradient penalty for y
+        epsilon_y = tf.random_uniform([], 0.0, 1.0)
+        y_hat = epsilon_y * y + (1 - epsilon_y) * y_
+        dy_hat = self.dy_net(tf.concat([y_hat,x_onehot],axis=1))
+        grad_y = tf.gradients(dy_hat, y_hat)[0] #(bs,x_dim)
+        grad_norm_y = tf.sqrt(tf.reduce_sum(tf.square(grad_y), axis=1))#(bs,)
+        gpy_loss = tf.reduce_mean(tf.square(grad_norm_y - 1.0))
+
+        d_loss = dx_loss + dy_loss + 10*(gpx_loss + gpy_loss)
+
+        return dict(x_combine=x_combine, y_=y_, x_latent_=x_latent_, x_onehot_=x_onehot_, x_=x_, x_logits_=x_logits_, x_latent__=x_latent__,
+            x_onehot__=x_onehot__, x__=x__, x_logits__=x_logits__, x_combine_=x_combine_, y__=y__, dy_=dy_, dx_=dx_, l2_loss_x=l2_loss_x,
+            l2_loss_y=l2_loss_y, CE_loss_x=CE_loss_x, g_loss_adv=g_loss_adv, h_loss_adv=h_loss_adv, g_loss=g_loss, h_loss=h_loss,
+            g_h_loss=g_h_loss, dx=dx, dy=dy, dx_loss=dx_loss, dy_loss=dy_loss, gpx_loss=gpx_loss, gpy_loss=gpy_loss, d_loss=d_loss)
+
+    #data-parallel replicas of the networks and losses, one per equal shard of the batch on its own CPU device
+    def build_towers(self, x, x_onehot, y):
+        towers = []
+        shards = zip(tf.split(x, self.num_towers), tf.split(x_onehot, self.num_towers), tf.split(y, self.num_towers))
+        for i, (x_shard, x_onehot_shard, y_shard) in enumerate(shards):
+            with tf.device('/cpu:%d' % i), tf.name_scope('tower_%d' % i):
+                towers.append(self.build_losses(x_shard, x_onehot_shard, y_shard))
+        return towers
+
+    #gradients of loss_fn averaged over the towers and applied once, so every update of the
+    #critic/generator schedule sees the whole batch
+    def tower_update(self, optimizer, loss_fn, var_list, towers):
+        tower_grads = [optimizer.compute_gradients(loss_fn(l), var_list=var_list, colocate_gradients_with_ops=True) for l in towers]
+        grads = []
+        for grad_and_vars in zip(*tower_grads):
+            grad = [g for g, _ in grad_and_vars if g is not None]
+            grads.append((tf.add_n(grad) / len(grad) if grad else None, grad_and_vars[0][1]))
+        return optimizer.apply_gradients(grads)
+
+    #update op on one batch, split across the towers when num_towers > 1
+    def build_update(self, optimizer, loss_fn, var_list, x, x_onehot, y):
+        if self.num_towers > 1:
+            return self.tower_update(optimizer, loss_fn, var_list, self.build_towers(x, x_onehot, y))
+        return optimizer.minimize(loss_fn(self.build_losses(x, x_onehot, y)), var_list=var_list)
+
+    #one outer iteration as a single graph op: nb_critic critic updates then one generator update,
+    #each on its slice of the stacked (nb_critic+1, batch_size, dim) inputs and chained by control dependencies
+    def build_fused_step(self):
+        self.xs = tf.placeholder(tf.float32, [self.nb_critic+1, None, self.x_dim], name='xs')
+        self.x_onehots = tf.placeholder(tf.float32, [self.nb_critic+1, None, self.nb_classes], name='x_onehots')
+        self.ys = tf.placeholder(tf.float32, [self.nb_critic+1, None, self.y_dim], name='ys')
+        update = []
+        for i in range(self.nb_critic):
+            with tf.control_dependencies(update):
+                update = [self.build_update(self.dy_optimizer, lambda l: l['dy_loss']+10*l['gpy_loss'], self.dy_net.vars,
+                    self.xs[i], self.x_onehots[i], self.ys[i])]
+        with tf.control_dependencies(update):
+            self.fused_step = self.build_update(self.g_optimizer, lambda l: l['g_loss_adv'], self.g_net.vars,
+                self.xs[self.nb_critic], self.x_onehots[self.nb_critic], self.ys[self.nb_critic])
+
+    def train(self, nb_batches, prefetch=4, telemetry_every=100, trace_steps=None, eval_every=100, async_eval=False,
+            keep_last=5, keep_best=1, best_metric=None, replay=0., lr=2e-4, warm_start=None, reset_optimizer=False, reset_head=False):
         self.sess.run(tf.global_variables_initializer())
+        #fine-tuning continues from the weights of an existing checkpoint
+        if warm_start is not None:
+            self.warm_start(warm_start, reset_optimizer, reset_head)
+        #checkpoints are snapshotted in-graph, then saved, evaluated and pruned inline or by a background worker
+        self.build_snapshot()
+        if best_metric is None:
+            best_metric = 'nmi' if self.has_label else 'l2_loss_y'
+        self.keeper = CheckpointKeeper(self.checkpoint_dir, keep_last, keep_best, best_metric, 'min' if best_metric == 'l2_loss_y' else 'max')
+        worker = BackgroundWorker() if async_eval else None
         self.summary_writer=tf.summary.FileWriter(self.graph_dir,graph=tf.get_default_graph())
+        #time per phase, steps/sec and RSS as TensorBoard scalars and in graph_dir/telemetry.jsonl
+        telemetry = Telemetry(self.summary_writer, os.path.join(self.graph_dir, 'telemetry.jsonl'), telemetry_every, trace_steps, self.graph_dir)
         batches_per_eval = 100
+        nb_critic = self.nb_critic
+        #the towers split every batch, so the samplers draw batch_size rows per tower
+        batch_size = self.batch_size * self.num_towers
         start_time = time.time()
         weights = np.ones(self.nb_classes, dtype=np.float64) / float(self.nb_classes)
         last_weights = np.ones(self.nb_classes, dtype=np.float64) / float(self.nb_classes)
         diff_history=[]
+        #a `replay` fraction of batch_size generator samples from self.pool is added to the fakes of every critic
+        #update, the samples generated by each critic update are stored in the pool
+        nb_replay = int(round(replay * self.batch_size))
+        assert nb_replay == 0 or not (self.fused or self.num_towers > 1), 'replay needs the unfused single tower step'
+        d_fetches = [self.d_merged_summary, self.dy_optim] + ([self.y_] if nb_replay > 0 else [])
+        #batches of a whole iteration (critic steps + generator step) are drawn at once, ahead of time
+        #in a background thread when prefetch > 0
+        prefetcher = None
+        if prefetch > 0:
+            prefetcher = BatchPrefetcher(self.x_sampler, self.y_sampler, batch_size, nb_critic+1, prefetch, weights)
         for batch_idx in range(nb_batches):
-            lr = 2e-4
-            #update D
-            for _ in range(5):
-                bx, _ = self.x_sampler.train(self.batch_size,weights)
-                by, bx_onehot = self.y_sampler.get_batch(self.batch_size)
-
-                d_summary,_ = self.sess.run([self.d_merged_summary, self.dy_optim], feed_dict={self.x: bx, self.x_onehot: bx_onehot, self.y: by, self.lr:lr})
-            self.summary_writer.add_summary(d_summary,batch_idx)
-
-            bx, _ = self.x_sampler.train(self.batch_size,weights)
-            by, bx_onehot = self.y_sampler.get_batch(self.batch_size)
-
-            #update G
-            g_summary, _ = self.sess.run([self.g_merged_summary ,self.g_optim], feed_dict={self.x: bx, self.x_onehot: bx_onehot, self.y: by, self.lr:lr})
-            self.summary_writer.add_summary(g_summary,batch_idx)
+            with telemetry.phase('sampling'):
+                if prefetcher is not None:
+                    bxs, bx_onehots, bys = prefetcher.next()
+                else:
+                    bxs, bx_onehots, bys = draw_iteration(self.x_sampler, self.y_sampler, batch_size, nb_critic+1, weights)
+            with telemetry.phase('feed'):
+                bx, bx_onehot, by = bxs[nb_critic], bx_onehots[nb_critic], bys[nb_critic]
+                if self.fused:
+                    fused_feed = {self.xs: bxs, self.x_onehots: bx_onehots, self.ys: bys, self.lr:lr}
+                else:
+                    d_feeds = [{self.x: bxs[i], self.x_onehot: bx_onehots[i], self.y: bys[i], self.lr:lr} for i in range(nb_critic)]
+                g_feed = {self.x: bx, self.x_onehot: bx_onehot, self.y: by, self.lr:lr}
+            if self.fused:
+                #update D nb_critic times then G in one call, summaries only at evaluation batches
+                with telemetry.phase('fused_update'):
+                    self.sess.run(self.fused_step, feed_dict=fused_feed, **telemetry.run_kwargs(batch_idx))
+                    telemetry.save_trace(batch_idx, 'fused')
+                if batch_idx % batches_per_eval == 0:
+                    with telemetry.phase('summary'):
+                        d_summary, g_summary = self.sess.run([self.d_merged_summary, self.g_merged_summary], feed_dict={self.x: bx, self.x_onehot: bx_onehot, self.y: by})
+                        self.summary_writer.add_summary(d_summary,batch_idx)
+                        self.summary_writer.add_summary(g_summary,batch_idx)
+            else:
+                #update D
+                with telemetry.phase('critic_update'):
+                    for i in range(nb_critic):
+                        if nb_replay > 0 and len(self.pool) > 0:
+                            d_feeds[i][self.y_replay], d_feeds[i][self.x_onehot_replay] = self.pool.sample(nb_replay)
+                        d_outputs = self.sess.run(d_fetches, feed_dict=d_feeds[i], **telemetry.run_kwargs(batch_idx))
+                        d_summary = d_outputs[0]
+                        if nb_replay > 0:
+                            self.pool.add(d_outputs[2], bx_onehots[i])
+                        telemetry.save_trace(batch_idx, 'critic_%d' % i)
+                with telemetry.phase('summary'):
+                    self.summary_writer.add_summary(d_summary,batch_idx)
+
+                #update G
+                with telemetry.phase('generator_update'):
+                    g_summary, _ = self.sess.run([self.g_merged_summary ,self.g_optim], feed_dict=g_feed, **telemetry.run_kwargs(batch_idx))
+                    telemetry.save_trace(batch_idx, 'generator')
+                with telemetry.phase('summary'):
+                    self.summary_writer.add_summary(g_summary,batch_idx)
             #quick test on a random batch data
             if batch_idx % batches_per_eval == 0:
-                g_loss_adv, h_loss_adv, CE_loss, l2_loss_x, l2_loss_y, g_loss, \
-                    h_loss, g_h_loss, gpx_loss, gpy_loss = self.sess.run(
-                    [self.g_loss_adv, self.h_loss_adv, self.CE_loss_x, self.l2_loss_x, self.l2_loss_y, \
-                    self.g_loss, self.h_loss, self.g_h_loss, self.gpx_loss, self.gpy_loss],
-                    feed_dict={self.x: bx, self.x_onehot: bx_onehot, self.y: by}
-                )
-                dx_loss, dy_loss, d_loss = self.sess.run([self.dx_loss, self.dy_loss, self.d_loss], \
-                    feed_dict={self.x: bx, self.x_onehot: bx_onehot, self.y: by})
+                with telemetry.phase('loss_report'):
+                    g_loss_adv, h_loss_adv, CE_loss, l2_loss_x, l2_loss_y, g_loss, \
+                        h_loss, g_h_loss, gpx_loss, gpy_loss = self.sess.run(
+                        [self.g_loss_adv, self.h_loss_adv, self.CE_loss_x, self.l2_loss_x, self.l2_loss_y, \
+                        self.g_loss, self.h_loss, self.g_h_loss, self.gpx_loss, self.gpy_loss],
+                        feed_dict={self.x: bx, self.x_onehot: bx_onehot, self.y: by}
+                    )
+                    dx_loss, dy_loss, d_loss = self.sess.run([self.dx_loss, self.dy_loss, self.d_loss], \
+                        feed_dict={self.x: bx, self.x_onehot: bx_onehot, self.y: by})
 
                 print('Batch_idx [%d] Time [%.4f] g_loss_adv [%.4f] h_loss_adv [%.4f] CE_loss [%.4f] gpx_loss [%.4f] gpy_loss [%.4f] \
                     l2_loss_x [%.4f] l2_loss_y [%.4f] g_loss [%.4f] h_loss [%.4f] g_h_loss [%.4f] dx_loss [%.4f] dy_loss [%.4f] d_loss [%.4f]' %
                     (batch_idx, time.time() - start_time, g_loss_adv, h_loss_adv, CE_loss, gpx_loss, gpy_loss, l2_loss_x, l2_loss_y, \
                     g_loss, h_loss, g_h_loss, dx_loss, dy_loss, d_loss))                 
 
-            if (batch_idx+1) % batches_per_eval == 0:
-                self.evaluate(timestamp,batch_idx)
-                self.save(batch_idx)
+            if (batch_idx+1) % eval_every == 0:
+                with telemetry.phase('snapshot'):
+                    if worker is not None:
+                        #the previous snapshot must be saved and evaluated before it is overwritten
+                        worker.wait()
+                    self.sess.run(self.snapshot_op)
+                if worker is not None:
+                    worker.submit(self.save_and_evaluate, batch_idx)
+                else:
+                    with telemetry.phase('evaluate_checkpoint'):
+                        self.save_and_evaluate(batch_idx)
+            telemetry.step(batch_idx)
+        telemetry.report(nb_batches-1)
+        if worker is not None:
+            worker.close()
+        if prefetcher is not None:
+            prefetcher.close()
 
     def evaluate(self,timestamp,batch_idx):
-        if has_label:
+        if self.has_label:
             data_y, label_y = self.y_sampler.load_all()
         else:
             data_y, label_y = self.y_sampler.load_all()
         data_x, _ = self.x_sampler.train(data_y.shape[0])
         data_y_ = self.predict_y(data_x, label_y)
-        np.save('{}/data_pre_{}.npy'.format(self.save_dir, batch_idx),data_y_)    
+        self.write_results(batch_idx, dict(data_pre=data_y_))
+
+
+    #variables a checkpoint needs: the network weights and the Adam state of the optimizers train() runs,
+    #not the slots of the update ops built but never run
+    def checkpoint_variables(self):
+        variables, names = [], set()
+        for var in tf.trainable_variables() + tf.model_variables() + sum([opt.variables() for opt in [self.dy_optimizer, self.g_optimizer]], []):
+            if var.op.name not in names:
+                names.add(var.op.name)
+                variables.append(var)
+        return variables
+
+    #in-graph copies of the checkpoint variables: one session call takes a consistent snapshot, which can then be
+    #saved and evaluated while training keeps updating the variables
+    def build_snapshot(self):
+        model_vars = self.checkpoint_variables()
+        self.snapshot_names = [var.op.name for var in model_vars]
+        self.shadow_vars = [tf.Variable(tf.zeros(var.shape, var.dtype.base_dtype), trainable=False, collections=[], name='shadow_%d' % i)
+            for i, var in enumerate(model_vars)]
+        self.snapshot_op = tf.group(*[shadow.assign(var) for shadow, var in zip(self.shadow_vars, model_vars)])
+        #saved under the original names, so the checkpoints are restored by self.saver as usual
+        self.snapshot_saver = tf.train.Saver(var_list=dict(zip(self.snapshot_names, self.shadow_vars)), max_to_keep=None)
+        self.sess.run(tf.variables_initializer(self.shadow_vars))
+
+    #checkpoint and evaluation of the last snapshot, then the retention policy of self.keeper
+    def save_and_evaluate(self, batch_idx):
+        if not os.path.exists(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+        path = self.snapshot_saver.save(self.sess, os.path.join(self.checkpoint_dir, 'model.ckpt'), global_step=batch_idx, write_meta_graph=False)
+        values = dict(zip(self.snapshot_names, self.sess.run(self.shadow_vars)))
+        self.keeper.add(path, batch_idx, self.evaluate_snapshot(values, batch_idx))
+
+    #evaluate() on snapshot values with the NumPy networks, returns the metrics used to rank checkpoints
+    def evaluate_snapshot(self, values, batch_idx):
+        net = NumpyScDEC(build_numpy_nets(values, [net_spec(self.g_net), net_spec(self.h_net)]))
+        data_y, label_y = self.y_sampler.load_all()
+        data_x, _ = self.x_sampler.train(data_y.shape[0])
+        data_y_ = net.predict_y(data_x, label_y)
+        data_x_, data_x_onehot_, labels_ = net.predict_all(data_y)
+        #reconstruction error of y__ = G(H(y)) and agreement of the clusters with the labels
+        metrics = {'l2_loss_y': float(np.mean((data_y - net.predict_y(data_x_[:,:self.x_dim], data_x_onehot_))**2))}
+        if self.has_label:
+            #all clustering scores from one contingency table of the hard assignments argmax(x_onehot_)
+            metrics.update(cluster_metrics(assignment_scores(label_y, hard=labels_)))
+            if self.kmeans_baseline:
+                baseline = kmeans_labels(data_x_[:,:self.x_dim], self.nb_classes, minibatch=True)
+                metrics.update(cluster_metrics(assignment_scores(label_y, hard=baseline), prefix='kmeans_'))
+        print('Evaluated batch_idx [%d] %s' % (batch_idx, ' '.join('%s [%.4f]' % item for item in sorted(metrics.items()))))
+        self.write_results(batch_idx, dict(data_pre=data_y_, labels=labels_), metrics)
+        return metrics
+
+    #outputs of one evaluation, appended to save_dir/results.h5 or written as the legacy .npy/.npz files
+    def write_results(self, batch_idx, arrays, metrics=None):
+        if self.legacy_results:
+            np.save('{}/data_pre_{}.npy'.format(self.save_dir, batch_idx),arrays['data_pre'])
+        else:
+            self.results.write(batch_idx, metrics, **arrays)
 
+    #bytes per row of a prediction chunk: inputs, a few live hidden layers and outputs in float32
+    def row_bytes(self):
+        return 4*(self.x_dim + self.y_dim + 2*self.nb_classes + 4*max(self.g_net.nb_units, self.h_net.nb_units))
 
-    #predict with y_=G(x)
-    def predict_y(self, x, x_onehot, bs=256):
+    #predict with y_=G(x), chunk size bs is derived from the free memory when not given
+    def predict_y(self, x, x_onehot, bs=None, out=None):
         assert x.shape[-1] == self.x_dim
-        N = x.shape[0]
-        y_pred = np.zeros(shape=(N, self.y_dim)) 
-        for b in range(int(np.ceil(N*1.0 / bs))):
-            if (b+1)*bs > N:
-               ind = np.arange(b*bs, N)
-            else:
-               ind = np.arange(b*bs, (b+1)*bs)
-            batch_x = x[ind, :]
-            batch_x_onehot = x_onehot[ind, :]
-            batch_y_ = self.sess.run(self.y_, feed_dict={self.x:batch_x, self.x_onehot:batch_x_onehot})
-            y_pred[ind, :] = batch_y_
+        bs = bs or auto_chunk_size(self.row_bytes())
+        y_pred = allocate((x.shape[0], self.y_dim), out=out)
+        run_chunked(self.sess, [self.y_], {self.x: x, self.x_onehot: x_onehot}, [y_pred], bs)
         return y_pred
     
     #predict with x_=H(y)
-    def predict_x(self,y,bs=256):
+    def predict_x(self, y, bs=None, out=None, out_onehot=None):
         assert y.shape[-1] == self.y_dim
-        N = y.shape[0]
-        x_pred = np.zeros(shape=(N, self.x_dim+self.nb_classes)) 
-        x_onehot = np.zeros(shape=(N, self.nb_classes)) 
-        for b in range(int(np.ceil(N*1.0 / bs))):
-            if (b+1)*bs > N:
-               ind = np.arange(b*bs, N)
-            else:
-               ind = np.arange(b*bs, (b+1)*bs)
-            batch_y = y[ind, :]
-            batch_x_,batch_x_onehot_ = self.sess.run([self.x_latent_, self.x_onehot_], feed_dict={self.y:batch_y})
-            x_pred[ind, :] = batch_x_
-            x_onehot[ind, :] = batch_x_onehot_
+        bs = bs or auto_chunk_size(self.row_bytes())
+        x_pred = allocate((y.shape[0], self.x_dim+self.nb_classes), out=out)
+        x_onehot = allocate((y.shape[0], self.nb_classes), out=out_onehot)
+        run_chunked(self.sess, [self.x_latent_, self.x_onehot_], {self.y: y}, [x_pred, x_onehot], bs)
         return x_pred, x_onehot
 
+    #embeddings, soft assignments and hard cluster labels of H(y) in a single pass over y,
+    #written to embeds.npy, soft.npy and labels.npy memmaps in out_dir when given
+    def predict_all(self, y, bs=None, out_dir=None):
+        assert y.shape[-1] == self.y_dim
+        N = y.shape[0]
+        bs = bs or auto_chunk_size(self.row_bytes())
+        path = lambda name: os.path.join(out_dir, name) if out_dir is not None else None
+        if out_dir is not None and not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        embeds = allocate((N, self.x_dim+self.nb_classes), path=path('embeds.npy'))
+        soft = allocate((N, self.nb_classes), path=path('soft.npy'))
+        labels = allocate((N,), dtype=np.int32, path=path('labels.npy'))
+        run_chunked(self.sess, [self.x_latent_, self.x_onehot_, self.x_label_], {self.y: y}, [embeds, soft, labels], bs)
+        return embeds, soft, labels
+
+    #weights of all four networks as an .npz for the NumPy backend in npmodel.py
+    def export_npz(self, path):
+        export_weights(self.sess, [self.g_net, self.h_net, self.dx_net, self.dy_net], path)
+
+    #IVF index over the latent part x_ of the embeddings of all cells, saved next to the checkpoints
+    def build_index(self, path=None, **kwargs):
+        data_y, _ = self.y_sampler.load_all()
+        data_x_, _ = self.predict_x(data_y)
+        index = IVFIndex(**kwargs).fit(data_x_[:,:self.x_dim])
+        if path is None:
+            if not os.path.exists(self.checkpoint_dir):
+                os.makedirs(self.checkpoint_dir)
+            path = os.path.join(self.checkpoint_dir, 'ann_index.npz')
+        index.save(path)
+        print('ANN index of %d cells in %d lists written to %s' % (len(index), index.n_lists, path))
+        return index
 
     def save(self,batch_idx):
 
-        checkpoint_dir = 'checkpoint/{}_{}_x_dim={}_y_dim={}_alpha={}_beta={}'.format(self.timestamp,self.data,self.x_dim, self.y_dim, self.alpha, self.beta)
-        if not os.path.exists(checkpoint_dir):
-            os.makedirs(checkpoint_dir)
-
-        self.saver.save(self.sess, os.path.join(checkpoint_dir, 'model.ckpt'),global_step=batch_idx)
+        if not os.path.exists(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+
+        self.saver.save(self.sess, os.path.join(self.checkpoint_dir, 'model.ckpt'),global_step=batch_idx)
+
+    #restore the variables of a checkpoint (prefix or directory) by name after the initialization; the ones sized by
+    #nb_classes (h_net output, g_net and dy_net inputs) get their overlapping block when --K changed, so the latent
+    #part and the first clusters carry over; reset_optimizer keeps the fresh Adam state and reset_head
+    #re-initializes the output layer of h_net
+    def warm_start(self, checkpoint, reset_optimizer=False, reset_head=False):
+        if os.path.isdir(checkpoint):
+            checkpoint = find_checkpoint(checkpoint)
+        reader = tf.train.NewCheckpointReader(checkpoint)
+        shapes = reader.get_variable_to_shape_map()
+        net_vars = set(tf.trainable_variables() + tf.model_variables())
+        restore, partial, nb_fresh = {}, [], 0
+        for var in tf.global_variables():
+            name, shape = var.op.name, var.shape.as_list()
+            is_head = name.startswith(self.h_net.name + '/') and shape[-1] == self.x_dim + self.nb_classes
+            if name not in shapes or (reset_optimizer and var not in net_vars) or (reset_head and is_head) \
+                    or len(shapes[name]) != len(shape):
+                nb_fresh += 1
+            elif shapes[name] == shape:
+                restore[name] = var
+            else:
+                partial.append(var)
+        if restore:
+            tf.train.Saver(var_list=restore).restore(self.sess, checkpoint)
+        for var in partial:
+            value, old = self.sess.run(var), reader.get_tensor(var.op.name)
+            overlap = tuple(slice(0, min(a, b)) for a, b in zip(value.shape, old.shape))
+            value[overlap] = old[overlap]
+            var.load(value, self.sess)
+        print('Warm start from %s: %d variables restored, %d partially, %d initialized' % (checkpoint, len(restore), len(partial), nb_fresh))
 
     def load(self, pre_trained = False, timestamp='',batch_idx=999):
 
@@ -271,11 +548,20 @@ class scDEC(object):
                 self.saver.restore(self.sess, os.path.join(checkpoint_dir, 'model.ckpt-%d'%batch_idx))
                 print('Restored model weights.')
 
+#networks of the scDEC model with the default architecture
+def build_nets(model, x_dim, y_dim, nb_classes):
+    g_net = model.Generator(input_dim=x_dim,output_dim = y_dim,name='g_net',nb_layers=10,nb_units=512,concat_every_fcl=False)
+    h_net = model.Encoder(input_dim=y_dim,output_dim = x_dim+nb_classes,feat_dim=x_dim,name='h_net',nb_layers=10,nb_units=256)
+    dx_net = model.Discriminator(input_dim=x_dim,name='dx_net',nb_layers=2,nb_units=256)
+    dy_net = model.Discriminator_cond(input_dim=y_dim,name='dy_net',nb_layers=2,nb_units=256)
+    return g_net, h_net, dx_net, dy_net
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser('')
     parser.add_argument('--data', type=str, default='Splenocyte',help='name of dataset')
     parser.add_argument('--model', type=str, default='model',help='model definition')
-    parser.add_argument('--K', type=int, default=11,help='number of clusters')
+    parser.add_argument('--K', type=int, default=11,help='number of clusters, equal to the number of label columns; 0 to choose it with the gap statistic (unlabelled samplers only)')
+    parser.add_argument('--K_max', type=int, default=20,help='largest number of clusters tried by the gap statistic')
     parser.add_argument('--dx', type=int, default=10,help='dimension of Gaussian distribution')
     parser.add_argument('--dy', type=int, default=20,help='dimension of preprocessed data')
     parser.add_argument('--bs', type=int, default=64,help='batch size')
@@ -288,8 +574,37 @@ if __name__ == '__main__':
     parser.add_argument('--train', type=bool, default=False,help='whether train from scratch')
     parser.add_argument('--no_label', action='store_true',help='whether the dataset has label')
     parser.add_argument('--mode', type=int, default=1,help='mode for 10x paired data')
+    parser.add_argument('--prefetch', type=int, default=4,help='number of training iterations prepared ahead in a background thread, 0 to disable')
+    parser.add_argument('--fused', action='store_true',help='run the critic and generator updates of an iteration in a single session call')
+    parser.add_argument('--towers', type=int, default=1,help='data-parallel replicas, each on a batch of --bs samples, gradients are averaged')
+    parser.add_argument('--intra_op', type=int, default=0,help='threads inside one op, 0 lets TensorFlow decide')
+    parser.add_argument('--inter_op', type=int, default=0,help='ops run in parallel, 0 lets TensorFlow decide')
+    parser.add_argument('--telemetry_every', type=int, default=100,help='batches between two telemetry reports')
+    parser.add_argument('--trace_steps', type=int, nargs=2, default=None,help='trace the session calls of batches [start, end) into timeline files')
+    parser.add_argument('--eval_every', type=int, default=100,help='batches between two evaluations and checkpoints')
+    parser.add_argument('--async_eval', action='store_true',help='save and evaluate weight snapshots in a background thread')
+    parser.add_argument('--keep_last', type=int, default=5,help='number of most recent checkpoints kept')
+    parser.add_argument('--keep_best', type=int, default=1,help='number of best checkpoints kept')
+    parser.add_argument('--best_metric', type=str, default=None, choices=CLUSTER_METRICS+['l2_loss_y'],help='metric ranking checkpoints, nmi with labels and l2_loss_y otherwise')
+    parser.add_argument('--results_dtype', type=str, default='float32', choices=['float32','float16'],help='precision of the stored evaluation outputs')
+    parser.add_argument('--legacy_results', action='store_true',help='write evaluation outputs as separate .npy/.npz files instead of results.h5')
+    parser.add_argument('--kmeans_baseline', action='store_true',help='also score MiniBatchKMeans on the embedding at every evaluation')
+    parser.add_argument('--replay', type=float, default=0.,help='replayed generator samples added to the critic fakes, as a fraction of the batch size')
+    parser.add_argument('--pool_size', type=int, default=5000,help='capacity of the replay pool in samples')
+    parser.add_argument('--export_reference', type=str, default='',help='write the fitted feature masks, scale and PCA to this .npz for reference.py')
+    parser.add_argument('--build_index', action='store_true',help='build an ANN index over the embeddings of all cells in the checkpoint directory')
+    parser.add_argument('--n_lists', type=int, default=None,help='inverted lists of the ANN index, sqrt(#cells) by default')
+    parser.add_argument('--lr', type=float, default=2e-4,help='learning rate')
+    parser.add_argument('--finetune', type=str, default='',help='fine-tune from this checkpoint prefix or checkpoint directory instead of training from scratch')
+    parser.add_argument('--finetune_batches', type=int, default=5000,help='number of fine-tuning batches')
+    parser.add_argument('--finetune_lr', type=float, default=1e-4,help='learning rate of the fine-tuning')
+    parser.add_argument('--reset_optimizer', action='store_true',help='fine-tune with a fresh optimizer state')
+    parser.add_argument('--reset_head', action='store_true',help='re-initialize the cluster head of h_net when fine-tuning')
+    parser.add_argument('--export_npz', type=str, default='',help='write the network weights to this .npz for npmodel.py')
     
     args = parser.parse_args()
+    tf.set_random_seed(0)
+    tf.reset_default_graph()
     data = args.data
     model = importlib.import_module(args.model)
     nb_classes = args.K
@@ -302,23 +617,34 @@ if __name__ == '__main__':
     ratio = args.ratio
     low = args.low
     timestamp = args.timestamp
-    is_train = args.train
+    is_train = args.train or args.finetune != ''
     has_label = not args.no_label
 
-    g_net = model.Generator(input_dim=x_dim,output_dim = y_dim,name='g_net',nb_layers=10,nb_units=512,concat_every_fcl=False)
-    h_net = model.Encoder(input_dim=y_dim,output_dim = x_dim+nb_classes,feat_dim=x_dim,name='h_net',nb_layers=10,nb_units=256)
-    dx_net = model.Discriminator(input_dim=x_dim,name='dx_net',nb_layers=2,nb_units=256)
-    dy_net = model.Discriminator_cond(input_dim=y_dim,name='dy_net',nb_layers=2,nb_units=256)
-    pool = util.DataPool(10)
-
-    xs = util.Mixture_sampler(nb_classes=nb_classes,N=10000,dim=x_dim,sd=1)
     mode = args.mode
     ys = util.ARC_TS_Sampler(name=data,n_components=int(y_dim/2),mode=mode)
+    try:
+        nb_classes = choose_nb_classes(ys, nb_classes, k_max=args.K_max)
+    except ValueError as error:
+        parser.error(str(error))
+
+    g_net, h_net, dx_net, dy_net = build_nets(model, x_dim, y_dim, nb_classes)
+    pool = util.DataPool(args.pool_size)
+
+    xs = util.Mixture_sampler(nb_classes=nb_classes,N=10000,dim=x_dim,sd=1)
 
-    model = scDEC(g_net, h_net, dx_net, dy_net, xs, ys, nb_classes, data, pool, batch_size, alpha, beta, is_train)
+    model = scDEC(g_net, h_net, dx_net, dy_net, xs, ys, nb_classes, data, pool, batch_size, alpha, beta, is_train, fused=args.fused, num_towers=args.towers,
+        ratio=ratio, has_label=has_label, intra_op_threads=args.intra_op, inter_op_threads=args.inter_op,
+        results_dtype=args.results_dtype, legacy_results=args.legacy_results,
+        kmeans_baseline=args.kmeans_baseline)
 
-    if args.train:
-        model.train(nb_batches=nb_batches)
+    if is_train:
+        if args.finetune:
+            nb_batches, lr = args.finetune_batches, args.finetune_lr
+        else:
+            lr = args.lr
+        model.train(nb_batches=nb_batches, prefetch=args.prefetch, telemetry_every=args.telemetry_every, trace_steps=args.trace_steps,
+            eval_every=args.eval_every, async_eval=args.async_eval, keep_last=args.keep_last, keep_best=args.keep_best, best_metric=args.best_metric,
+            replay=args.replay, lr=lr, warm_start=args.finetune or None, reset_optimizer=args.reset_optimizer, reset_head=args.reset_head)
     else:
         print('Attempting to Restore Model ...')
         if timestamp == '':
@@ -327,6 +653,9 @@ if __name__ == '__main__':
         else:
             model.load(pre_trained=False, timestamp = timestamp, batch_idx = nb_batches-1)
         model.evaluate(timestamp,nb_batches-1)
-        
-            
-            
+    if args.export_npz:
+        model.export_npz(args.export_npz)
+    if args.build_index:
+        model.build_index(n_lists=args.n_lists)
+    if args.export_reference:
+        reference_from_sampler(ys).save(args.export_reference)
@@ -0,0 +1,222 @@
+from __future__ import division
+import json
+import time
+import argparse
+import numpy as np
+
+#NumPy (float32, BLAS) forward passes of the fully connected networks in model.py, so trained
+#h_net/g_net can score cells without importing TensorFlow or opening a session
+#weights come from export_weights(), an .npz keyed by the TF variable names plus the constructor
+#arguments of every network
+
+
+def leaky_relu(x, alpha=0.2):
+    return np.maximum(x, alpha * x, out=x)
+
+def softmax(logits):
+    e = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return e / e.sum(axis=1, keepdims=True)
+
+def affine(x, W, b):
+    out = x.dot(W)
+    out += b
+    return out
+
+#tcl.batch_norm as used by the discriminators: training mode (batch statistics), center only, epsilon 1e-3
+def batch_norm(x, beta, epsilon=1e-3):
+    x -= x.mean(axis=0)
+    x /= np.sqrt(x.var(axis=0) + epsilon)
+    x += beta
+    return x
+
+#parameters of the layer scopes `prefix`, `prefix_1`, `prefix_2`, ... of a network, in creation order
+def _scopes(arrays, name, prefix, leaves):
+    params = []
+    while True:
+        scope = '%s/%s%s' % (name, prefix, '_%d' % len(params) if params else '')
+        if scope + '/' + leaves[0] not in arrays:
+            return params
+        params.append(tuple(arrays[scope + '/' + leaf] for leaf in leaves))
+
+
+class Generator(object):
+    def __init__(self, arrays, name, input_dim, concat_every_fcl=True, **kwargs):
+        self.name = name
+        self.input_dim = input_dim
+        self.concat_every_fcl = concat_every_fcl
+        self.dense = _scopes(arrays, name, 'fully_connected', ['weights', 'biases'])
+
+    def __call__(self, z):
+        z = np.asarray(z, dtype=np.float32)
+        y = z[:, self.input_dim:]
+        fc = z
+        for W, b in self.dense[:-1]:
+            fc = leaky_relu(affine(fc, W, b))
+            if self.concat_every_fcl:
+                fc = np.concatenate([fc, y], axis=1)
+        return affine(fc, *self.dense[-1])
+
+
+class Encoder(object):
+    def __init__(self, arrays, name, feat_dim, **kwargs):
+        self.name = name
+        self.feat_dim = feat_dim
+        self.dense = _scopes(arrays, name, 'fully_connected', ['weights', 'biases'])
+
+    def __call__(self, x):
+        fc = np.asarray(x, dtype=np.float32)
+        for W, b in self.dense[:-1]:
+            fc = leaky_relu(affine(fc, W, b))
+        output = affine(fc, *self.dense[-1])
+        return output, softmax(output[:, self.feat_dim:])
+
+
+#batch statistics make the critic output depend on the whole batch, score a batch in one call
+class Discriminator_cond(object):
+    def __init__(self, arrays, name, input_dim, concat_every_fcl=True, **kwargs):
+        self.name = name
+        self.input_dim = input_dim
+        self.concat_every_fcl = concat_every_fcl
+        self.dense = _scopes(arrays, name, 'fully_connected', ['weights', 'biases'])
+        self.norms = _scopes(arrays, name, 'BatchNorm', ['beta'])
+
+    def __call__(self, z):
+        z = np.asarray(z, dtype=np.float32)
+        y = z[:, self.input_dim:]
+        fc = leaky_relu(affine(z, *self.dense[0]))
+        for (W, b), (beta,) in zip(self.dense[1:-1], self.norms):
+            if self.concat_every_fcl:
+                fc = np.concatenate([fc, y], axis=1)
+            fc = np.tanh(batch_norm(affine(fc, W, b), beta))
+        if self.concat_every_fcl:
+            fc = np.concatenate([fc, y], axis=1)
+        return affine(fc, *self.dense[-1])
+
+
+class Discriminator(Discriminator_cond):
+    def __init__(self, arrays, name, input_dim, **kwargs):
+        super(Discriminator, self).__init__(arrays, name, input_dim, concat_every_fcl=False)
+
+
+NETWORKS = {'Generator': Generator, 'Encoder': Encoder, 'Discriminator': Discriminator, 'Discriminator_cond': Discriminator_cond}
+
+#constructor arguments of a model.py network and its class name
+def net_spec(net):
+    spec = dict(net.__dict__)
+    spec['class'] = type(net).__name__
+    return spec
+
+#dump the trainable variables (no optimizer slots or moving statistics) of model.py networks to an .npz
+def export_weights(sess, nets, path):
+    import tensorflow as tf
+    trainable = set(var.op.name for var in tf.trainable_variables())
+    arrays, specs = {}, []
+    for net in nets:
+        variables = [var for var in net.vars if var.op.name in trainable]
+        for var, value in zip(variables, sess.run(variables)):
+            arrays[var.op.name] = value.astype(np.float32)
+        specs.append(net_spec(net))
+    arrays['__specs__'] = np.array(json.dumps(specs))
+    np.savez(path, **arrays)
+    print('Exported %s to %s' % (', '.join(spec['name'] for spec in specs), path))
+
+#{name: NumPy network} for every network stored in an .npz written by export_weights
+def load_weights(path):
+    with np.load(path) as f:
+        arrays = dict((key, f[key]) for key in f.files)
+    return build_nets(arrays, json.loads(str(arrays.pop('__specs__'))))
+
+#{name: NumPy network} from arrays keyed by the TF variable names and the specs of the networks
+def build_nets(arrays, specs):
+    nets = {}
+    for spec in specs:
+        spec = dict(spec)
+        nets[spec['name']] = NETWORKS[spec.pop('class')](arrays, **spec)
+    return nets
+
+
+#drop-in for the prediction methods of scDEC on top of the NumPy networks,
+#from an .npz written by export_weights or a dict given by build_nets
+class NumpyScDEC(object):
+    def __init__(self, nets, g_name='g_net', h_name='h_net'):
+        if not isinstance(nets, dict):
+            nets = load_weights(nets)
+        self.g_net = nets.get(g_name)
+        self.h_net = nets[h_name]
+
+    def predict_y(self, x, x_onehot, bs=10000):
+        return np.concatenate([self.g_net(np.hstack([x[i:i+bs], x_onehot[i:i+bs]])) for i in range(0, len(x), bs)], axis=0)
+
+    def predict_x(self, y, bs=10000):
+        outputs = [self.h_net(y[i:i+bs]) for i in range(0, len(y), bs)]
+        return np.concatenate([item[0] for item in outputs], axis=0), np.concatenate([item[1] for item in outputs], axis=0)
+
+    def predict_all(self, y, bs=10000):
+        embeds, soft = self.predict_x(y, bs)
+        return embeds, soft, soft.argmax(axis=1).astype(np.int32)
+
+
+def _median_time(fn, repeats):
+    fn()
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    return np.median(times)
+
+#latency and throughput of the NumPy networks against a TF session running the same weights,
+#the TF graph is rebuilt from the stored constructor arguments and loaded from the .npz
+def benchmark(path, names=('h_net', 'g_net'), batch_sizes=(1, 64, 1024, 16384), repeats=20, model='model'):
+    import importlib
+    import tensorflow as tf
+    model = importlib.import_module(model)
+    start = time.time()
+    nets = load_weights(path)
+    np_load = time.time() - start
+    with np.load(path) as f:
+        specs = json.loads(str(f['__specs__']))
+    start = time.time()
+    graph = tf.Graph()
+    tf_nets, inputs, outputs = {}, {}, {}
+    with graph.as_default():
+        for spec in specs:
+            if spec['name'] not in names:
+                continue
+            kwargs = dict(spec)
+            tf_nets[spec['name']] = getattr(model, kwargs.pop('class'))(**kwargs)
+            in_dim = nets[spec['name']].dense[0][0].shape[0]
+            inputs[spec['name']] = tf.placeholder(tf.float32, [None, in_dim])
+            outputs[spec['name']] = tf_nets[spec['name']](inputs[spec['name']], reuse=False)
+        sess = tf.Session(graph=graph)
+        with np.load(path) as f:
+            for var in tf.trainable_variables():
+                var.load(f[var.op.name], sess)
+    tf_load = time.time() - start
+    print('setup\tnumpy %.3fs\ttf %.3fs' % (np_load, tf_load))
+    print('net\tbatch\tnumpy ms\ttf ms\tnumpy rows/s\ttf rows/s\tmax abs diff')
+    rng = np.random.RandomState(0)
+    for name in names:
+        if name not in outputs:
+            continue
+        for bs in batch_sizes:
+            data = rng.normal(size=(bs, inputs[name].shape[1].value)).astype(np.float32)
+            np_fn = lambda: nets[name](data)
+            tf_fn = lambda: sess.run(outputs[name], feed_dict={inputs[name]: data})
+            np_time = _median_time(np_fn, repeats)
+            tf_time = _median_time(tf_fn, repeats)
+            np_out, tf_out = np_fn(), tf_fn()
+            if isinstance(np_out, tuple):
+                np_out, tf_out = np_out[0], tf_out[0]
+            print('%s\t%d\t%.3f\t%.3f\t%.0f\t%.0f\t%.2e' % (name, bs, 1000*np_time, 1000*tf_time,
+                bs/np_time, bs/tf_time, np.max(np.abs(np_out - tf_out))))
+    sess.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('')
+    parser.add_argument('--npz', type=str, required=True,help='weights written by export_weights (main_*.py --export_npz)')
+    parser.add_argument('--model', type=str, default='model',help='model definition')
+    parser.add_argument('--repeats', type=int, default=20,help='timed runs per batch size')
+    args = parser.parse_args()
+    benchmark(args.npz, repeats=args.repeats, model=args.model)
@@ -0,0 +1,99 @@
+from __future__ import division
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import numpy as np
+
+#input pipeline for scDEC.train
+#one outer iteration = nb_steps batches (the critic steps followed by the generator step),
+#drawn from the samplers in a single vectorized call and stacked as (nb_steps, batch_size, dim)
+
+
+#number of label columns of the y sampler, None when it has no labels
+def label_width(y_sampler):
+    data = y_sampler.load_all()
+    if not isinstance(data, tuple) or len(data) < 2:
+        return None
+    return np.shape(data[1])[1]
+
+#the labels of the y sampler (time points) condition g_net and dy_net as x_onehot, so the model
+#must have one class per label column
+def check_nb_classes(y_sampler, nb_classes):
+    width = label_width(y_sampler)
+    if width is not None and width != nb_classes:
+        raise ValueError('K=%d but the y sampler has %d label columns, which condition the networks: use K=%d'
+            % (nb_classes, width, width))
+
+#K given on the command line, or chosen by the gap statistic when 0; the gap statistic can only
+#choose K when no labels fix it
+def choose_nb_classes(y_sampler, nb_classes, k_max=20, n_jobs=-1):
+    if nb_classes == 0:
+        width = label_width(y_sampler)
+        if width is not None:
+            raise ValueError('K=0 chooses K with the gap statistic, but the %d label columns of the y sampler condition '
+                'the networks and fix K=%d' % (width, width))
+        from gap import gap_statistic, print_gap
+        data = y_sampler.load_all()
+        result = gap_statistic(data[0] if isinstance(data, tuple) else data, k_max=k_max, n_jobs=n_jobs)
+        print_gap(result)
+        nb_classes = result['best_k']
+        print('Number of clusters chosen by the gap statistic: %d' % nb_classes)
+    check_nb_classes(y_sampler, nb_classes)
+    return nb_classes
+
+def draw_iteration(x_sampler, y_sampler, batch_size, nb_steps=6, weights=None):
+    n = batch_size * nb_steps
+    bx, _ = x_sampler.train(n, weights)
+    by, bx_onehot = y_sampler.get_batch(n)
+    return (np.asarray(bx, dtype=np.float32).reshape(nb_steps, batch_size, -1),
+            np.asarray(bx_onehot, dtype=np.float32).reshape(nb_steps, batch_size, -1),
+            np.asarray(by, dtype=np.float32).reshape(nb_steps, batch_size, -1))
+
+
+#background thread keeping a bounded queue of iterations ahead of the training loop,
+#so the session never waits on NumPy
+class BatchPrefetcher(object):
+    def __init__(self, x_sampler, y_sampler, batch_size, nb_steps=6, capacity=4, weights=None):
+        self.x_sampler = x_sampler
+        self.y_sampler = y_sampler
+        self.batch_size = batch_size
+        self.nb_steps = nb_steps
+        self.weights = weights
+        self.queue = queue.Queue(maxsize=capacity)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            try:
+                item = draw_iteration(self.x_sampler, self.y_sampler, self.batch_size, self.nb_steps, self.weights)
+            except Exception as e:
+                #re-raised in the training thread by next()
+                item = e
+            while not self.stop_event.is_set():
+                try:
+                    self.queue.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if isinstance(item, Exception):
+                return
+
+    def next(self):
+        item = self.queue.get()
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    __next__ = next
+
+    def __iter__(self):
+        return self
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
@@ -0,0 +1,224 @@
+from __future__ import division
+import numpy as np
+import scipy.sparse as sp
+
+#preprocessing helpers shared by the samplers in util.py
+#all matrices are (cells, feats), either dense np.ndarray or scipy CSR
+
+
+#library-size normalization, each cell is scaled to sum up to `scale`
+def normalize_total(X, scale=10000, dtype=np.float32):
+    lib_size = np.asarray(X.sum(axis=1), dtype=np.float64).ravel()
+    lib_size[lib_size == 0] = 1.
+    factors = (scale / lib_size).astype(dtype)
+    if sp.issparse(X):
+        X = sp.csr_matrix(X, dtype=dtype, copy=True)
+        #scale the stored values row by row, no dense temporaries
+        X.data *= np.repeat(factors, np.diff(X.indptr))
+        return X
+    return np.asarray(X, dtype=dtype) * factors[:, None]
+
+#log(x+1) with the given base, only touches the stored values of a sparse matrix
+def log_transform(X, base=10):
+    if sp.issparse(X):
+        np.log1p(X.data, out=X.data)
+        if base is not None:
+            X.data /= np.log(base)
+        return X
+    X = np.log1p(X)
+    if base is not None:
+        X /= np.log(base)
+    return X
+
+#min-max scaling of the columns of a CSR matrix without densifying: returns X / (max - min) and the
+#shift min / (max - min) still to subtract per column (non-zero for features present in every cell);
+#PCA centers the shift away, so the scaled matrix gives the same projections as MinMaxScaler output
+def minmax_scale_sparse(X):
+    X = sp.csr_matrix(X, dtype=np.float64)
+    col_min = X.min(axis=0).toarray().ravel()
+    col_range = X.max(axis=0).toarray().ravel() - col_min
+    col_range[col_range == 0] = 1.
+    return X.dot(sp.diags(1. / col_range)).tocsr(), col_min / col_range
+
+#X.dot(W) - 1*mean.dot(W), i.e. the product with the implicitly centered X
+def _centered_dot(X, mean, W):
+    return np.asarray(X.dot(W)) - mean.dot(W)[None, :]
+
+#(X - 1*mean).T.dot(Q) without forming the centered X
+def _centered_rdot(X, mean, Q):
+    return np.asarray(X.T.dot(Q)) - np.outer(mean, Q.sum(axis=0))
+
+
+#projection onto fitted principal axes, same transform as sklearn PCA (no whitening)
+class LinearReducer(object):
+    def __init__(self, components=None, mean=None, explained_variance=None):
+        self.components_ = components
+        self.mean_ = mean
+        self.explained_variance_ = explained_variance
+
+    @property
+    def n_components_(self):
+        return self.components_.shape[0]
+
+    def transform(self, X):
+        return _centered_dot(X, self.mean_, self.components_.T)
+
+    def fit_transform(self, X):
+        return self.fit(X).transform(X)
+
+
+#randomized PCA (Halko et al.) that works on CSR input, the data is centered
+#implicitly so memory scales with the non-zeros rather than cells x feats
+class RandomizedPCA(LinearReducer):
+    def __init__(self, n_components, n_oversamples=10, n_iter=4, random_state=None):
+        super(RandomizedPCA, self).__init__()
+        self.n_components = n_components
+        self.n_oversamples = n_oversamples
+        self.n_iter = n_iter
+        self.random_state = random_state
+
+    def fit(self, X):
+        n, d = X.shape
+        k = min(self.n_components + self.n_oversamples, n, d)
+        mean = np.asarray(X.mean(axis=0), dtype=np.float64).ravel()
+        rng = np.random.RandomState(self.random_state)
+        #range finder with power iterations, re-orthonormalized at every step
+        Q = _centered_dot(X, mean, rng.normal(size=(d, k)))
+        Q, _ = np.linalg.qr(Q)
+        for _ in range(self.n_iter):
+            Q, _ = np.linalg.qr(_centered_rdot(X, mean, Q))
+            Q, _ = np.linalg.qr(_centered_dot(X, mean, Q))
+        B = _centered_rdot(X, mean, Q).T #(k, d)
+        _, s, Vt = np.linalg.svd(B, full_matrices=False)
+        #deterministic signs: largest loading of each axis is positive
+        signs = np.sign(Vt[np.arange(Vt.shape[0]), np.argmax(np.abs(Vt), axis=1)])
+        signs[signs == 0] = 1.
+        Vt *= signs[:, None]
+        self.mean_ = mean
+        self.components_ = Vt[:self.n_components]
+        self.singular_values_ = s[:self.n_components]
+        self.explained_variance_ = self.singular_values_**2 / (n - 1)
+        if sp.issparse(X):
+            sq_sum = np.sum(np.square(X.data, dtype=np.float64))
+        else:
+            sq_sum = np.sum(np.square(X, dtype=np.float64))
+        total_var = (sq_sum - n * mean.dot(mean)) / (n - 1)
+        self.explained_variance_ratio_ = self.explained_variance_ / total_var
+        return self
+
+
+#TF-IDF of a (peaks, cells) count matrix: counts over the cell total times log(1 + cells / peak total)
+#implemented as broadcasting (dense) or diagonal scaling (CSR), no tiled temporaries
+def tfidf(X):
+    cell_sum = np.asarray(X.sum(axis=0), dtype=np.float64).ravel()
+    peak_sum = np.asarray(X.sum(axis=1), dtype=np.float64).ravel()
+    cell_sum[cell_sum == 0] = 1.
+    peak_sum[peak_sum == 0] = 1.
+    idf = np.log(1 + 1.0 * X.shape[1] / peak_sum)
+    if sp.issparse(X):
+        return sp.diags(idf).dot(sp.csr_matrix(X, dtype=np.float64)).dot(sp.diags(1.0 / cell_sum)).tocsr()
+    X = np.multiply(X, 1.0 / cell_sum[None, :])
+    X *= idf[:, None]
+    return X
+
+#streaming reader for the tab separated (peaks, cells) sc_mat.txt, builds CSR block by block
+def read_sc_mat(path, chunk_size=10000, dtype=np.float32):
+    import pandas as pd
+    blocks, peaks = [], []
+    reader = pd.read_csv(path, sep='\t', header=0, index_col=[0], chunksize=chunk_size)
+    for chunk in reader:
+        blocks.append(sp.csr_matrix(chunk.values.astype(dtype)))
+        peaks.extend(chunk.index)
+        cells = chunk.columns
+    return sp.vstack(blocks, format='csr'), np.array(peaks), np.array(cells)
+
+
+#out-of-core helpers: X is a dense array, a np.memmap, a CSR matrix (possibly memory-mapped, see tenx.py)
+#or a list of those stacked along the cells; blocks of cells are read from disk one at a time
+
+def _as_list(X):
+    return list(X) if isinstance(X, (list, tuple)) else [X]
+
+def _row_slice(mats, start, end):
+    pieces, offset = [], 0
+    for mat in mats:
+        n = mat.shape[0]
+        if offset < end and offset + n > start:
+            pieces.append(mat[max(start - offset, 0):min(end - offset, n)])
+        offset += n
+    if len(pieces) == 1:
+        return pieces[0]
+    if sp.issparse(pieces[0]):
+        return sp.vstack(pieces, format='csr')
+    return np.concatenate(pieces, axis=0)
+
+#[start, end) bounds of the cell blocks, a short last block is merged into the previous one
+def chunk_bounds(n, chunk_size=10000, min_size=1):
+    bounds = list(range(0, n, chunk_size)) + [n]
+    if len(bounds) > 2 and bounds[-1] - bounds[-2] < min_size:
+        del bounds[-2]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def iter_chunks(X, chunk_size=10000, min_size=1):
+    mats = _as_list(X)
+    for start, end in chunk_bounds(sum(mat.shape[0] for mat in mats), chunk_size, min_size):
+        yield start, end, _row_slice(mats, start, end)
+
+#number of cells with a non-zero value for every feature
+def count_nonzero_cols(X, chunk_size=10000):
+    counts = None
+    for _, _, block in iter_chunks(X, chunk_size):
+        block_counts = np.asarray((block > 0).sum(axis=0)).ravel()
+        counts = block_counts if counts is None else counts + block_counts
+    return counts
+
+#same rule as ARC_Sampler.filter_feats: min_c < #cells < max_c
+def select_columns(counts, min_c=0, max_c=None):
+    select = counts > min_c
+    if max_c is not None:
+        select *= counts < max_c
+    return select
+
+#column selection, library-size normalization and log10(x+1) of one block of cells, as a dense array
+def _prepare_block(block, scale, cols):
+    if cols is not None:
+        block = block[:, cols]
+    block = log_transform(normalize_total(block, scale), base=10)
+    return block.toarray() if sp.issparse(block) else block
+
+#IncrementalPCA fitted block by block, only one normalized block is held in memory at a time
+def fit_incremental_pca(X, n_components, scale=10000, cols=None, chunk_size=10000):
+    from sklearn.decomposition import IncrementalPCA
+    reducer = IncrementalPCA(n_components=n_components)
+    for _, _, block in iter_chunks(X, chunk_size, min_size=n_components):
+        reducer.partial_fit(_prepare_block(block, scale, cols))
+    return reducer
+
+#apply a fitted reducer block by block, n_jobs threads share the work (BLAS releases the GIL)
+def transform_chunked(reducer, X, scale=10000, cols=None, chunk_size=10000, n_jobs=1):
+    from multiprocessing.pool import ThreadPool
+    mats = _as_list(X)
+    n = sum(mat.shape[0] for mat in mats)
+    out = np.empty((n, reducer.n_components_))
+    def work(bounds):
+        start, end = bounds
+        out[start:end] = reducer.transform(_prepare_block(_row_slice(mats, start, end), scale, cols))
+    bounds = chunk_bounds(n, chunk_size)
+    if n_jobs == 1:
+        for item in bounds:
+            work(item)
+    else:
+        pool = ThreadPool(n_jobs)
+        pool.map(work, bounds)
+        pool.close()
+        pool.join()
+    return out
+
+#feature filter, IncrementalPCA fit and transform over cell blocks streamed from disk
+#returns the fitted reducer, the reduced (cells, n_components) matrix and the feature mask
+def reduce_incremental(X, n_components, scale=10000, min_c=0, max_c=None, filter_feat=True, chunk_size=10000, n_jobs=1):
+    cols = None
+    if filter_feat:
+        cols = select_columns(count_nonzero_cols(X, chunk_size), min_c, max_c)
+    reducer = fit_incremental_pca(X, n_components, scale, cols, chunk_size)
+    return reducer, transform_chunked(reducer, X, scale, cols, chunk_size, n_jobs), cols
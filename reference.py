@@ -0,0 +1,185 @@
+from __future__ import division
+import json
+import time
+import argparse
+import numpy as np
+import scipy.sparse as sp
+from preprocess import normalize_total, log_transform, chunk_bounds
+from cache import reducer_arrays, load_reducer
+
+#reference mapping: the preprocessing fitted by an ARC sampler (feature masks, library-size scale and
+#PCA of every modality) is stored next to the trained model, new cells are then projected through it and
+#the encoder h_net to get their embeddings and cluster labels, in one pass over blocks of cells and
+#without refitting anything
+
+#modalities of the joint features for the sampler modes, in their order in the feature matrix
+MODALITIES = {1: ['rna'], 2: ['atac'], 3: ['rna', 'atac']}
+#sampler attributes of the filter mask, the feature names and the unique 10x feature ids
+OMIC_ATTRS = {'rna': ('gene_select', 'genes', 'gene_ids'), 'atac': ('locus_select', 'peaks', 'peak_ids')}
+
+
+#columns of a query matrix in the order of the reference features: an index array, or a
+#(query feats, reference feats) 0/1 matrix when some reference features are missing (zero filled);
+#a key present several times on either side is ambiguous (gene symbols repeat), match on the ids instead
+def column_map(query_features, ref_features):
+    query_features, ref_features = np.asarray(query_features), np.asarray(ref_features)
+    for side, keys in [('query', query_features), ('reference', ref_features)]:
+        uniq, counts = np.unique(keys, return_counts=True)
+        dups = uniq[(counts > 1) & np.isin(uniq, query_features) & np.isin(uniq, ref_features)]
+        if len(dups):
+            raise ValueError('%d features are duplicated in the %s (e.g. %s), they cannot be matched by name'
+                % (len(dups), side, ', '.join(dups[:5])))
+    position = dict((name, i) for i, name in enumerate(query_features))
+    idx = np.array([position.get(name, -1) for name in ref_features], dtype=np.int64)
+    found = idx >= 0
+    if found.all():
+        return idx, 0
+    select = sp.csr_matrix((np.ones(found.sum(), dtype=np.float32), (idx[found], np.nonzero(found)[0])),
+        shape=(len(query_features), len(ref_features)))
+    return select, int((~found).sum())
+
+def apply_columns(block, cols):
+    if cols is None:
+        return block
+    if sp.issparse(cols):
+        return sp.csr_matrix(block).dot(cols)
+    return block[:, cols]
+
+
+class Reference(object):
+    def __init__(self, mode, scale, reducers, selects=None, features=None, ids=None):
+        self.mode = mode
+        self.scale = scale
+        self.reducers = reducers
+        self.selects = selects or {}
+        self.features = features or {}
+        self.ids = ids or {}
+
+    @property
+    def dim(self):
+        return sum(self.reducers[omic].n_components_ for omic in MODALITIES[self.mode])
+
+    def save(self, path):
+        arrays = {'__meta__': np.array(json.dumps({'mode': self.mode, 'scale': self.scale}))}
+        for omic, reducer in self.reducers.items():
+            arrays.update(reducer_arrays(omic, reducer))
+            if self.selects.get(omic) is not None:
+                arrays['%s_select' % omic] = self.selects[omic]
+            if self.features.get(omic) is not None:
+                arrays['%s_features' % omic] = np.asarray(self.features[omic]).astype(np.str_)
+            if self.ids.get(omic) is not None:
+                arrays['%s_ids' % omic] = np.asarray(self.ids[omic]).astype(np.str_)
+        np.savez(path, **arrays)
+
+    #per modality column selection of the query matrices: matched by 10x feature id when both sides have
+    #them, by name when both sides have names, the filter mask of the reference otherwise (the query then
+    #has the reference's raw layout)
+    def columns(self, mats, features=None, ids=None):
+        cols = {}
+        for omic in MODALITIES[self.mode]:
+            n_feats = self.reducers[omic].components_.shape[1]
+            #unique ids first, names otherwise
+            keys = [(query[omic], ref[omic]) for query, ref in [(ids, self.ids), (features, self.features)]
+                if query is not None and query.get(omic) is not None and ref.get(omic) is not None]
+            if keys:
+                cols[omic], n_missing = column_map(*keys[0])
+                if n_missing:
+                    print('%d of %d reference %s features are missing in the query, filled with zeros' % (n_missing, n_feats, omic))
+            elif self.selects.get(omic) is not None:
+                assert mats[omic].shape[1] == len(self.selects[omic]), 'unnamed %s features do not match the reference layout' % omic
+                cols[omic] = self.selects[omic]
+            else:
+                assert mats[omic].shape[1] == n_feats, 'unnamed %s features do not match the reference layout' % omic
+                cols[omic] = None
+        return cols
+
+    #reduced features of a block of cells, same layout as the sampler's feats
+    def transform_block(self, blocks, cols, out=None):
+        if out is None:
+            out = np.empty((blocks[MODALITIES[self.mode][0]].shape[0], self.dim), dtype=np.float32)
+        offset = 0
+        for omic in MODALITIES[self.mode]:
+            block = log_transform(normalize_total(apply_columns(blocks[omic], cols[omic]), self.scale), base=10)
+            block = block.toarray() if sp.issparse(block) else block
+            n_components = self.reducers[omic].n_components_
+            out[:, offset:offset+n_components] = self.reducers[omic].transform(block)
+            offset += n_components
+        return out
+
+    def transform(self, mats, features=None, chunk_size=10000, ids=None):
+        cols = self.columns(mats, features, ids)
+        n_cells = mats[MODALITIES[self.mode][0]].shape[0]
+        feats = np.empty((n_cells, self.dim), dtype=np.float32)
+        for start, end in chunk_bounds(n_cells, chunk_size):
+            self.transform_block(dict((omic, mats[omic][start:end]) for omic in cols), cols, out=feats[start:end])
+        return feats
+
+    #embeddings, soft assignments and cluster labels of new cells with a trained encoder (npmodel.NumpyScDEC
+    #or a scDEC, anything with predict_x), preprocessing and encoding run block by block
+    def map(self, net, mats, features=None, chunk_size=10000, ids=None):
+        cols = self.columns(mats, features, ids)
+        n_cells = mats[MODALITIES[self.mode][0]].shape[0]
+        feats = np.empty((min(chunk_size, n_cells), self.dim), dtype=np.float32)
+        embeds = soft = labels = None
+        for start, end in chunk_bounds(n_cells, chunk_size):
+            block_feats = self.transform_block(dict((omic, mats[omic][start:end]) for omic in cols), cols, out=feats[:end-start])
+            block_embeds, block_soft = net.predict_x(block_feats)
+            if embeds is None:
+                embeds = np.empty((n_cells, block_embeds.shape[1]), dtype=np.float32)
+                soft = np.empty((n_cells, block_soft.shape[1]), dtype=np.float32)
+                labels = np.empty(n_cells, dtype=np.int32)
+            embeds[start:end], soft[start:end] = block_embeds, block_soft
+            labels[start:end] = block_soft.argmax(axis=1)
+        return embeds, soft, labels
+
+
+#reference of a fitted ARC_Sampler/ARC_TS_Sampler
+def reference_from_sampler(sampler):
+    assert getattr(sampler, 'rna_reducer', None) is not None, 'the sampler has no fitted reducers (legacy features?)'
+    reducers, selects, features, ids = {}, {}, {}, {}
+    for omic, (select, names, feature_ids) in OMIC_ATTRS.items():
+        reducers[omic] = getattr(sampler, '%s_reducer' % omic)
+        selects[omic] = getattr(sampler, select, None)
+        features[omic] = getattr(sampler, names, None)
+        ids[omic] = getattr(sampler, feature_ids, None)
+    return Reference(sampler.mode, sampler.scale, reducers, selects, features, ids)
+
+def load_reference(path):
+    with np.load(path, allow_pickle=False) as f:
+        arrays = dict((k, f[k]) for k in f.files)
+    meta = json.loads(str(arrays['__meta__']))
+    reducers, selects, features, ids = {}, {}, {}, {}
+    for omic in OMIC_ATTRS:
+        if '%s_components' % omic in arrays:
+            reducers[omic] = load_reducer(arrays, omic)
+            selects[omic] = arrays.get('%s_select' % omic)
+            features[omic] = arrays.get('%s_features' % omic)
+            ids[omic] = arrays.get('%s_ids' % omic)
+    return Reference(meta['mode'], meta['scale'], reducers, selects, features, ids)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('')
+    parser.add_argument('--reference', type=str, required=True,help='reference .npz written with --export_reference')
+    parser.add_argument('--weights', type=str, required=True,help='network weights .npz written with --export_npz')
+    parser.add_argument('--data', type=str, default='',help='10x dataset directory of the new cells, features matched by 10x id')
+    parser.add_argument('--rna', type=str, default='',help='dense (cells, genes) .npy of the new cells in the reference layout')
+    parser.add_argument('--atac', type=str, default='',help='dense (cells, peaks) .npy of the new cells in the reference layout')
+    parser.add_argument('--chunk_size', type=int, default=10000,help='cells per block')
+    parser.add_argument('--out', type=str, default='query.npz',help='output .npz with embeds, soft, labels (and barcodes)')
+    args = parser.parse_args()
+
+    from npmodel import NumpyScDEC
+    start = time.time()
+    reference = load_reference(args.reference)
+    net = NumpyScDEC(args.weights)
+    outputs = {}
+    if args.data:
+        from tenx import load_10x
+        mats, features, outputs['barcodes'], ids = load_10x(args.data, return_ids=True)
+    else:
+        mats = dict((omic, np.load(path, mmap_mode='r')) for omic, path in [('rna', args.rna), ('atac', args.atac)] if path)
+        features = ids = None
+    outputs['embeds'], outputs['soft'], outputs['labels'] = reference.map(net, mats, features, args.chunk_size, ids)
+    np.savez(args.out, **outputs)
+    print('Mapped %d cells in %.2fs to %s' % (len(outputs['labels']), time.time() - start, args.out))
@@ -0,0 +1,75 @@
+from __future__ import division
+import os
+import json
+import numpy as np
+
+#per-run store for the outputs of scDEC evaluations: one HDF5 file, one dataset per (name, step),
+#stored chunked and compressed in float32 (or float16), plus an index step -> metrics and dataset names
+#the file is opened for every write, so it can be read between evaluations and survives a crash of the run
+
+
+class ResultsStore(object):
+    def __init__(self, path, dtype=np.float32, compression='gzip', compression_opts=4, chunk_rows=4096):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.compression = compression
+        self.compression_opts = compression_opts if compression == 'gzip' else None
+        self.chunk_rows = chunk_rows
+
+    def _file(self, mode):
+        import h5py
+        return h5py.File(self.path, mode)
+
+    #append the arrays of one evaluation step, labels and other integer arrays keep their dtype
+    def write(self, step, metrics=None, **arrays):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with self._file('a') as f:
+            for name, array in arrays.items():
+                array = np.asarray(array)
+                dtype = self.dtype if np.issubdtype(array.dtype, np.floating) else array.dtype
+                key = '%s/%d' % (name, step)
+                if key in f:
+                    del f[key]
+                chunks = None
+                if self.compression is not None and array.size:
+                    chunks = (min(self.chunk_rows, array.shape[0]),) + array.shape[1:]
+                f.create_dataset(key, data=array.astype(dtype), chunks=chunks, compression=self.compression,
+                    compression_opts=self.compression_opts, shuffle=chunks is not None)
+            index = json.loads(f.attrs.get('index', '{}'))
+            index[str(step)] = {'metrics': metrics or {}, 'arrays': sorted(arrays)}
+            f.attrs['index'] = json.dumps(index, sort_keys=True)
+
+    #{step: {'metrics': {...}, 'arrays': [...]}}
+    def index(self):
+        if not os.path.exists(self.path):
+            return {}
+        with self._file('r') as f:
+            return dict((int(step), item) for step, item in json.loads(f.attrs.get('index', '{}')).items())
+
+    def steps(self):
+        return sorted(self.index())
+
+    #metric values over the steps, e.g. for a learning curve
+    def curve(self, metric):
+        index = self.index()
+        steps = [step for step in sorted(index) if metric in index[step]['metrics']]
+        return np.array(steps), np.array([index[step]['metrics'][metric] for step in steps])
+
+    #rows of one stored array, only the chunks covering `rows` are read and decompressed
+    def read(self, step, name, rows=slice(None)):
+        with self._file('r') as f:
+            return f['%s/%d' % (name, step)][rows]
+
+    #lazy access to one stored array: a read-only np.memmap for uncompressed contiguous datasets (file None),
+    #the h5py dataset sliced on demand otherwise, its file must stay open while in use
+    def open(self, step, name):
+        f = self._file('r')
+        dataset = f['%s/%d' % (name, step)]
+        offset = dataset.id.get_offset()
+        if dataset.chunks is None and offset is not None:
+            array = np.memmap(self.path, mode='r', dtype=dataset.dtype, shape=dataset.shape, offset=offset)
+            f.close()
+            return array, None
+        return dataset, f
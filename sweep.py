@@ -0,0 +1,137 @@
+from __future__ import division
+import os
+import time
+import shutil
+import tempfile
+import argparse
+import itertools
+import datetime
+import dateutil.tz
+import numpy as np
+from multiprocessing import Pool
+import util
+from pipeline import check_nb_classes
+
+#hyperparameter sweep: the sampler data is preprocessed once and written as .npy files to shared memory
+#(/dev/shm when available), every configuration trains in a worker process that memory-maps them,
+#so N concurrent runs share one copy of the data; TensorFlow is only imported inside the workers
+
+PARAMS = ['K', 'dx', 'alpha', 'beta', 'ratio']
+
+
+#write feats and labels where the workers can map them, returns their paths and the temporary directory
+def share_data(feats, labels, shm_dir=None):
+    if shm_dir is None and os.path.isdir('/dev/shm'):
+        shm_dir = '/dev/shm'
+    tmp_dir = tempfile.mkdtemp(prefix='scdec_sweep_', dir=shm_dir)
+    paths = {}
+    for name, array in [('feats', feats), ('labels', labels)]:
+        paths[name] = os.path.join(tmp_dir, name + '.npy')
+        np.save(paths[name], np.ascontiguousarray(array, dtype=np.float32))
+    return paths, tmp_dir
+
+#train one configuration in a fresh worker process and return its row of the results table
+def run_one(job):
+    idx, config, settings = job
+    import importlib
+    import tensorflow as tf
+    from sklearn.metrics.cluster import normalized_mutual_info_score, adjusted_rand_score
+    script = importlib.import_module(settings['script'])
+    model = importlib.import_module(settings['model'])
+    tf.reset_default_graph()
+    tf.set_random_seed(settings['seed'] + idx)
+    np.random.seed(settings['seed'] + idx)
+
+    feats = np.load(settings['feats'], mmap_mode='r')
+    labels = np.load(settings['labels'], mmap_mode='r')
+    ys = util.ArraySampler(feats, labels)
+    nb_classes, x_dim, y_dim = config['K'], config['dx'], feats.shape[1]
+    check_nb_classes(ys, nb_classes)
+    g_net, h_net, dx_net, dy_net = script.build_nets(model, x_dim, y_dim, nb_classes)
+    xs = util.Mixture_sampler(nb_classes=nb_classes,N=10000,dim=x_dim,sd=1)
+    net = script.scDEC(g_net, h_net, dx_net, dy_net, xs, ys, nb_classes, settings['data'], util.DataPool(), settings['bs'],
+        config['alpha'], config['beta'], True, ratio=config['ratio'], has_label=settings['has_label'],
+        timestamp='%s_run%03d' % (settings['timestamp'], idx),
+        intra_op_threads=settings['intra_op'], inter_op_threads=settings['inter_op'])
+
+    start_time = time.time()
+    net.train(nb_batches=settings['nb_batches'], prefetch=settings['prefetch'])
+    train_time = time.time() - start_time
+
+    row = dict(config)
+    row.update(run=idx, train_time=train_time, batches_per_sec=settings['nb_batches'] / train_time)
+    #final losses on a fresh batch
+    bx, _ = xs.train(settings['bs'])
+    by, bx_onehot = ys.get_batch(settings['bs'])
+    names = ['g_loss_adv', 'h_loss_adv', 'CE_loss_x', 'l2_loss_x', 'l2_loss_y', 'dx_loss', 'dy_loss', 'd_loss']
+    values = net.sess.run([getattr(net, name) for name in names], feed_dict={net.x: bx, net.x_onehot: bx_onehot, net.y: by})
+    row.update(zip(names, values))
+    if settings['has_label']:
+        _, _, pred = net.predict_all(feats)
+        true = np.argmax(labels, axis=1)
+        row.update(NMI=normalized_mutual_info_score(true, pred), ARI=adjusted_rand_score(true, pred))
+    row['save_dir'] = net.save_dir
+    net.sess.close()
+    return row
+
+#grid of all combinations of the values given for PARAMS
+def grid(values):
+    return [dict(zip(PARAMS, combo)) for combo in itertools.product(*[values[name] for name in PARAMS])]
+
+#run every configuration with n_jobs concurrent workers, each restarted after one run so that
+#TensorFlow graphs and sessions never accumulate, and collect the results in one table
+def run_sweep(configs, feats, labels, settings, n_jobs=4, shm_dir=None):
+    import pandas as pd
+    #the labels condition the networks, every K must match their width (checked before any worker starts)
+    ys = util.ArraySampler(feats, labels)
+    for config in configs:
+        check_nb_classes(ys, config['K'])
+    paths, tmp_dir = share_data(feats, labels, shm_dir)
+    settings = dict(settings, **paths)
+    try:
+        pool = Pool(n_jobs, maxtasksperchild=1)
+        rows = []
+        for row in pool.imap_unordered(run_one, [(idx, config, settings) for idx, config in enumerate(configs)]):
+            print('Finished run %d: %s' % (row['run'], ', '.join('%s=%s' % (name, row[name]) for name in PARAMS)))
+            rows.append(row)
+        pool.close()
+        pool.join()
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return pd.DataFrame(rows).sort_values('run').reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('')
+    parser.add_argument('--script', type=str, default='main_cgan',help='training script defining scDEC, main_cgan or main_trajactory_infer')
+    parser.add_argument('--data', type=str, default='Splenocyte',help='name of dataset')
+    parser.add_argument('--model', type=str, default='model',help='model definition')
+    parser.add_argument('--mode', type=int, default=1,help='mode for 10x paired data')
+    parser.add_argument('--dy', type=int, default=20,help='dimension of preprocessed data')
+    parser.add_argument('--K', type=int, nargs='+', default=[3],help='numbers of clusters, must equal the number of time points (label columns)')
+    parser.add_argument('--dx', type=int, nargs='+', default=[10],help='dimensions of Gaussian distribution')
+    parser.add_argument('--alpha', type=float, nargs='+', default=[10.0],help='coefficients of loss term')
+    parser.add_argument('--beta', type=float, nargs='+', default=[10.0],help='coefficients of loss term')
+    parser.add_argument('--ratio', type=float, nargs='+', default=[0.2],help='parameters in updating Caltegory distribution')
+    parser.add_argument('--bs', type=int, default=64,help='batch size')
+    parser.add_argument('--nb_batches', type=int, default=10000,help='training batches per run')
+    parser.add_argument('--jobs', type=int, default=4,help='runs trained concurrently')
+    parser.add_argument('--intra_op', type=int, default=1,help='threads inside one op, per run')
+    parser.add_argument('--inter_op', type=int, default=1,help='ops run in parallel, per run')
+    parser.add_argument('--prefetch', type=int, default=0,help='iterations prepared ahead in a background thread, per run')
+    parser.add_argument('--no_label', action='store_true',help='whether the dataset has label')
+    parser.add_argument('--shm_dir', type=str, default=None,help='directory for the shared data, /dev/shm by default')
+    parser.add_argument('--out', type=str, default='',help='csv file for the results table')
+    args = parser.parse_args()
+
+    ys = util.ARC_TS_Sampler(name=args.data,n_components=int(args.dy/2),mode=args.mode)
+    feats, labels = ys.load_all()
+    timestamp = datetime.datetime.now(dateutil.tz.tzlocal()).strftime('%Y%m%d_%H%M%S')
+    settings = dict(script=args.script, model=args.model, data=args.data, bs=args.bs, nb_batches=args.nb_batches,
+        prefetch=args.prefetch, intra_op=args.intra_op, inter_op=args.inter_op, has_label=not args.no_label,
+        timestamp=timestamp, seed=0)
+    configs = grid(vars(args))
+    print('Sweeping %d configurations with %d jobs' % (len(configs), args.jobs))
+    results = run_sweep(configs, feats, labels, settings, n_jobs=args.jobs, shm_dir=args.shm_dir)
+    print(results.to_string())
+    results.to_csv(args.out or 'sweep_%s_%s.csv' % (args.data, timestamp), index=False)
@@ -0,0 +1,89 @@
+from __future__ import division
+import os
+import json
+import time
+import resource
+from contextlib import contextmanager
+
+#per-phase timing and memory instrumentation of scDEC.train
+#phases are timed with `with telemetry.phase(name):`, every `every` steps the mean milliseconds
+#per step of each phase, steps/sec and RSS are written as TensorBoard scalars next to the loss
+#summaries and appended as one line to a JSONL log; sess.run calls inside a chosen window of steps
+#can also be traced (RunMetadata) and dumped as chrome://tracing timelines
+
+
+#resident set size in MB, from /proc when available and the peak RSS otherwise
+def rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024.**2
+    except (IOError, OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+class Telemetry(object):
+    def __init__(self, summary_writer=None, log_path=None, every=100, trace_steps=None, trace_dir=None):
+        self.summary_writer = summary_writer
+        self.log_path = log_path
+        self.every = every
+        self.trace_steps = trace_steps
+        self.trace_dir = trace_dir
+        self.run_metadata = None
+        self.reset()
+
+    def reset(self):
+        self.totals = {}
+        self.steps = 0
+        self.start_time = time.time()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.totals[name] = self.totals.get(name, 0.) + time.time() - start
+
+    #end of one training step, reports every `every` steps
+    def step(self, batch_idx):
+        self.steps += 1
+        if self.steps >= self.every:
+            self.report(batch_idx)
+
+    def report(self, batch_idx):
+        if self.steps == 0:
+            return
+        elapsed = time.time() - self.start_time
+        record = dict(('%s_ms' % name, 1000. * total / self.steps) for name, total in self.totals.items())
+        record.update(step=batch_idx, steps_per_sec=self.steps / elapsed, rss_mb=rss_mb(),
+            other_ms=1000. * (elapsed - sum(self.totals.values())) / self.steps)
+        if self.summary_writer is not None:
+            import tensorflow as tf
+            values = [tf.Summary.Value(tag='telemetry/%s' % key, simple_value=value) for key, value in sorted(record.items()) if key != 'step']
+            self.summary_writer.add_summary(tf.Summary(value=values), batch_idx)
+        if self.log_path is not None:
+            with open(self.log_path, 'a') as f:
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+        self.reset()
+
+    def tracing(self, batch_idx):
+        return self.trace_steps is not None and self.trace_steps[0] <= batch_idx < self.trace_steps[1]
+
+    #extra sess.run arguments: full tracing inside the trace window, nothing otherwise
+    def run_kwargs(self, batch_idx):
+        if not self.tracing(batch_idx):
+            return {}
+        import tensorflow as tf
+        self.run_metadata = tf.RunMetadata()
+        return dict(options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), run_metadata=self.run_metadata)
+
+    #timeline of the last traced sess.run, also attached to the TensorBoard graph
+    def save_trace(self, batch_idx, name):
+        if self.run_metadata is None:
+            return
+        from tensorflow.python.client import timeline
+        tag = 'step_%d_%s' % (batch_idx, name)
+        with open(os.path.join(self.trace_dir, 'timeline_%s.json' % tag), 'w') as f:
+            f.write(timeline.Timeline(self.run_metadata.step_stats).generate_chrome_trace_format())
+        if self.summary_writer is not None:
+            self.summary_writer.add_run_metadata(self.run_metadata, tag, batch_idx)
+        self.run_metadata = None
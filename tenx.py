@@ -0,0 +1,230 @@
+from __future__ import division
+import os
+import json
+import gzip
+import numpy as np
+import scipy.sparse as sp
+
+#loader for 10x Genomics feature-barcode matrices (ARC multiome)
+#the matrix is converted once, in chunks, into an on-disk binary CSR per modality
+#(cells, feats) whose indptr/indices/data arrays are memory-mapped by later runs
+
+#10x feature type -> modality name used by the samplers
+MODALITIES = {'Gene Expression': 'rna', 'Peaks': 'atac'}
+
+
+def _open(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt')
+    return open(path)
+
+def _find(dir_name, base):
+    for path in [os.path.join(dir_name, base), os.path.join(dir_name, base + '.gz')]:
+        if os.path.exists(path):
+            return path
+    return None
+
+#feature ids (unique, e.g. Ensembl gene ids), names (gene symbols can repeat) and types from
+#features.tsv[.gz], read a single time
+def read_features(feat_file):
+    ids, names, types = [], [], []
+    with _open(feat_file) as f:
+        for line in f:
+            items = line.rstrip('\n').split('\t')
+            ids.append(items[0])
+            names.append(items[1])
+            types.append(items[2])
+    return np.array(ids), np.array(names), np.array(types)
+
+def read_barcodes(barcode_file):
+    with _open(barcode_file) as f:
+        return np.array([line.strip() for line in f])
+
+#per feature modality id and column index inside its modality
+def _feature_layout(types):
+    mods = [MODALITIES.get(t, t.lower().replace(' ', '_')) for t in types]
+    uniq_mods = sorted(set(mods), key=mods.index)
+    mod_id = np.array([uniq_mods.index(m) for m in mods], dtype=np.int64)
+    local_col = np.zeros(len(mods), dtype=np.int64)
+    for i in range(len(uniq_mods)):
+        local_col[mod_id == i] = np.arange(np.sum(mod_id == i))
+    return uniq_mods, mod_id, local_col
+
+#preallocate the on-disk arrays of one modality from its per cell non-zero counts
+def _create_csr(store_dir, mod, counts, n_cols):
+    mod_dir = os.path.join(store_dir, mod)
+    if not os.path.exists(mod_dir):
+        os.makedirs(mod_dir)
+    indptr = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    nnz = int(indptr[-1])
+    idx_dtype = np.int32 if max(nnz, n_cols) < np.iinfo(np.int32).max else np.int64
+    np.save(os.path.join(mod_dir, 'indptr.npy'), indptr)
+    indices = np.lib.format.open_memmap(os.path.join(mod_dir, 'indices.npy'), mode='w+', dtype=idx_dtype, shape=(nnz,))
+    data = np.lib.format.open_memmap(os.path.join(mod_dir, 'data.npy'), mode='w+', dtype=np.float32, shape=(nnz,))
+    return indptr, indices, data
+
+def _write_meta(store_dir, n_cells, uniq_mods, mod_id, ids, names, barcodes):
+    np.save(os.path.join(store_dir, 'barcodes.npy'), barcodes)
+    shapes = {}
+    for i, mod in enumerate(uniq_mods):
+        np.save(os.path.join(store_dir, mod, 'features.npy'), names[mod_id == i])
+        np.save(os.path.join(store_dir, mod, 'ids.npy'), ids[mod_id == i])
+        shapes[mod] = [n_cells, int(np.sum(mod_id == i))]
+    with open(os.path.join(store_dir, 'meta.json'), 'w') as f:
+        json.dump({'shapes': shapes}, f, indent=1)
+
+#Matrix Market header: comment lines then "rows cols nnz"
+def _mtx_header(mtx_file):
+    skip = 0
+    with _open(mtx_file) as f:
+        for line in f:
+            skip += 1
+            if not line.startswith('%'):
+                n_rows, n_cols, nnz = [int(item) for item in line.split()]
+                return skip, n_rows, n_cols, nnz
+
+def _iter_mtx(mtx_file, skip, chunk_size):
+    import pandas as pd
+    reader = pd.read_csv(mtx_file, sep=' ', header=None, skiprows=skip, chunksize=chunk_size,
+        dtype={0: np.int64, 1: np.int64, 2: np.float32}, compression='infer')
+    for chunk in reader:
+        #1-based (feature, cell, value) triplets
+        yield chunk[0].values - 1, chunk[1].values - 1, chunk[2].values
+
+#sort the indices of the rows that are not sorted yet, by blocks of cells (a cell's entries can be split
+#across chunks of the text matrix, or unsorted in the source file)
+def _sort_rows(indptr, indices, data, chunk_cells=10000):
+    n_cells = len(indptr) - 1
+    for c0 in range(0, n_cells, chunk_cells):
+        c1 = min(c0 + chunk_cells, n_cells)
+        a, b = indptr[c0], indptr[c1]
+        block = np.asarray(indices[a:b])
+        #a decrease inside a row marks it unsorted, decreases at row starts do not count
+        starts = indptr[c0:c1] - a
+        descents = np.nonzero(np.diff(block) < 0)[0] + 1
+        descents = descents[~np.isin(descents, starts)]
+        rows = np.unique(np.searchsorted(starts, descents, side='right') - 1)
+        for row in rows + c0:
+            lo, hi = indptr[row], indptr[row+1]
+            order = np.argsort(indices[lo:hi], kind='stable')
+            indices[lo:hi] = indices[lo:hi][order]
+            data[lo:hi] = data[lo:hi][order]
+
+#two passes over the (gzipped) text matrix: count non-zeros per cell, then scatter into the CSR arrays
+def convert_mtx(matrix_dir, store_dir, chunk_size=10000000):
+    mtx_file = _find(matrix_dir, 'matrix.mtx')
+    ids, names, types = read_features(_find(matrix_dir, 'features.tsv'))
+    barcodes = read_barcodes(_find(matrix_dir, 'barcodes.tsv'))
+    skip, n_feats, n_cells, nnz = _mtx_header(mtx_file)
+    assert n_feats == len(names) and n_cells == len(barcodes)
+    uniq_mods, mod_id, local_col = _feature_layout(types)
+
+    counts = np.zeros((len(uniq_mods), n_cells), dtype=np.int64)
+    for feats, cells, _ in _iter_mtx(mtx_file, skip, chunk_size):
+        counts += np.bincount(mod_id[feats] * n_cells + cells, minlength=len(uniq_mods) * n_cells).reshape(len(uniq_mods), n_cells)
+
+    arrays = [_create_csr(store_dir, mod, counts[i], np.sum(mod_id == i)) for i, mod in enumerate(uniq_mods)]
+    cursors = [indptr[:-1].copy() for indptr, _, _ in arrays]
+    for feats, cells, values in _iter_mtx(mtx_file, skip, chunk_size):
+        mods = mod_id[feats]
+        for i, (_, indices, data) in enumerate(arrays):
+            sel = np.where(mods == i)[0]
+            #group the entries by cell and sort them by feature inside a group (the file order is arbitrary),
+            #the rank inside a group is the offset after the cell cursor
+            sel = sel[np.lexsort((feats[sel], cells[sel]))]
+            c = cells[sel]
+            uniq_c, starts, c_counts = np.unique(c, return_index=True, return_counts=True)
+            pos = cursors[i][c] + np.arange(len(c)) - np.repeat(starts, c_counts)
+            cursors[i][uniq_c] += c_counts
+            indices[pos] = local_col[feats[sel]]
+            data[pos] = values[sel]
+    for indptr, indices, data in arrays:
+        _sort_rows(indptr, indices, data)
+        indices.flush()
+        data.flush()
+    _write_meta(store_dir, n_cells, uniq_mods, mod_id, ids, names, barcodes)
+    print('Converted %s (%d cells, %d non-zeros) into %s' % (mtx_file, n_cells, nnz, store_dir))
+
+#10x HDF5 stores the transposed matrix as CSC, i.e. already CSR over cells, copy it by blocks of cells
+def convert_h5(h5_file, store_dir, chunk_cells=10000):
+    import h5py
+    with h5py.File(h5_file, 'r') as f:
+        mat = f['matrix']
+        ids = np.array([item.decode() for item in mat['features/id'][:]])
+        names = np.array([item.decode() for item in mat['features/name'][:]])
+        types = [item.decode() for item in mat['features/feature_type'][:]]
+        barcodes = np.array([item.decode() for item in mat['barcodes'][:]])
+        src_indptr = mat['indptr'][:]
+        n_cells = len(src_indptr) - 1
+        uniq_mods, mod_id, local_col = _feature_layout(types)
+
+        counts = np.zeros((len(uniq_mods), n_cells), dtype=np.int64)
+        for c0 in range(0, n_cells, chunk_cells):
+            c1 = min(c0 + chunk_cells, n_cells)
+            mods = mod_id[mat['indices'][src_indptr[c0]:src_indptr[c1]]]
+            cells = np.repeat(np.arange(c0, c1), np.diff(src_indptr[c0:c1+1]))
+            counts += np.bincount(mods * n_cells + cells, minlength=len(uniq_mods) * n_cells).reshape(len(uniq_mods), n_cells)
+
+        arrays = [_create_csr(store_dir, mod, counts[i], np.sum(mod_id == i)) for i, mod in enumerate(uniq_mods)]
+        for c0 in range(0, n_cells, chunk_cells):
+            c1 = min(c0 + chunk_cells, n_cells)
+            feats = mat['indices'][src_indptr[c0]:src_indptr[c1]]
+            values = mat['data'][src_indptr[c0]:src_indptr[c1]]
+            mods = mod_id[feats]
+            for i, (indptr, indices, data) in enumerate(arrays):
+                #entries stay grouped by cell, so each modality block is contiguous
+                sel = mods == i
+                indices[indptr[c0]:indptr[c1]] = local_col[feats[sel]]
+                data[indptr[c0]:indptr[c1]] = values[sel]
+        for indptr, indices, data in arrays:
+            _sort_rows(indptr, indices, data)
+            indices.flush()
+            data.flush()
+    _write_meta(store_dir, n_cells, uniq_mods, mod_id, ids, names, barcodes)
+    print('Converted %s (%d cells) into %s' % (h5_file, n_cells, store_dir))
+
+#open a converted store in O(1): every modality is a CSR matrix backed by memory-mapped arrays
+#with return_ids, the unique feature ids of every modality are returned last
+def open_store(store_dir, return_ids=False):
+    with open(os.path.join(store_dir, 'meta.json')) as f:
+        meta = json.load(f)
+    mats, features, ids = {}, {}, {}
+    for mod, shape in meta['shapes'].items():
+        mod_dir = os.path.join(store_dir, mod)
+        data = np.load(os.path.join(mod_dir, 'data.npy'), mmap_mode='r')
+        indices = np.load(os.path.join(mod_dir, 'indices.npy'), mmap_mode='r')
+        indptr = np.load(os.path.join(mod_dir, 'indptr.npy'), mmap_mode='r')
+        mats[mod] = sp.csr_matrix((data, indices, indptr), shape=tuple(shape), copy=False)
+        #the converters write sorted, duplicate-free rows; without the flags scipy would sort the read-only arrays in place
+        mats[mod].has_sorted_indices = True
+        mats[mod].has_canonical_format = True
+        features[mod] = np.load(os.path.join(mod_dir, 'features.npy'))
+        if return_ids:
+            #stores converted before the ids were kept only have the names
+            id_file = os.path.join(mod_dir, 'ids.npy')
+            ids[mod] = np.load(id_file) if os.path.exists(id_file) else None
+    barcodes = np.load(os.path.join(store_dir, 'barcodes.npy'))
+    if return_ids:
+        return mats, features, barcodes, ids
+    return mats, features, barcodes
+
+#convert datasets/<name>/filtered_feature_bc_matrix{.h5,/} on first use, then open the binary store
+def load_10x(data_dir, store_dir=None, return_ids=False):
+    if store_dir is None:
+        store_dir = os.path.join(data_dir, 'csr_store')
+    if not os.path.exists(os.path.join(store_dir, 'meta.json')):
+        h5_file = os.path.join(data_dir, 'filtered_feature_bc_matrix.h5')
+        if os.path.exists(h5_file):
+            convert_h5(h5_file, store_dir)
+        else:
+            convert_mtx(os.path.join(data_dir, 'filtered_feature_bc_matrix'), store_dir)
+    return open_store(store_dir, return_ids)
+
+#source files of a 10x dataset, used to key caches of derived features
+def input_files(data_dir):
+    h5_file = os.path.join(data_dir, 'filtered_feature_bc_matrix.h5')
+    if os.path.exists(h5_file):
+        return [h5_file]
+    matrix_dir = os.path.join(data_dir, 'filtered_feature_bc_matrix')
+    return [_find(matrix_dir, base) for base in ['matrix.mtx', 'features.tsv', 'barcodes.tsv']]
@@ -0,0 +1,38 @@
+from __future__ import division
+import numpy as np
+from ann import IVFIndex, exact_search, recall, load_index, transfer_labels
+
+
+def clustered(n=3000, dim=8, seed=0):
+    rng = np.random.RandomState(seed)
+    labels = rng.randint(0, 10, n)
+    centers = rng.normal(scale=5, size=(10, dim))
+    return (centers[labels] + rng.normal(size=(n, dim))).astype(np.float32), labels
+
+def test_exact_search_matches_brute_force():
+    X, _ = clustered(500)
+    D, I = exact_search(X, X[:20], k=5)
+    d = np.sqrt(((X[:20, None, :] - X[None, :, :])**2).sum(axis=2))
+    np.testing.assert_array_equal(I[:, 0], np.arange(20))
+    #float32 norm expansion: near-zero distances lose precision under the square root
+    np.testing.assert_allclose(D, np.sort(d, axis=1)[:, :5], atol=2e-2)
+
+def test_ivf_recall(tmpdir):
+    X, _ = clustered()
+    Q = X[:200] + 0.1
+    _, I_exact = exact_search(X, Q, k=10)
+    index = IVFIndex(n_lists=30, n_probe=8).fit(X)
+    _, I = index.search(Q, k=10)
+    assert recall(I, I_exact) > 0.95
+    #probing every list is exact
+    _, I_all = index.search(Q, k=10, n_probe=30)
+    assert recall(I_all, I_exact) == 1.
+    path = str(tmpdir.join('index.npz'))
+    index.save(path)
+    np.testing.assert_array_equal(load_index(path).search(Q, k=10)[1], I)
+
+def test_transfer_labels():
+    X, labels = clustered()
+    index = IVFIndex(n_lists=30).fit(X[:2500])
+    predicted = transfer_labels(index, labels[:2500], X[2500:], k=15)[0]
+    assert np.mean(predicted == labels[2500:]) > 0.95
@@ -0,0 +1,82 @@
+from __future__ import division
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+from cache import FeatureCache, reducer_arrays, load_reducer
+from preprocess import RandomizedPCA
+
+
+def test_cache_miss_then_hit(tmpdir):
+    cache = FeatureCache(str(tmpdir.join('cache')))
+    data_file = tmpdir.join('sc_mat.txt')
+    data_file.write('a\tb\n1\t2\n')
+    key = cache.key([str(data_file)], {'dim': 20})
+    assert cache.load(key) is None
+    X = np.arange(12, dtype=np.float32).reshape(4, 3)
+    cache.save(key, X=X)
+    np.testing.assert_array_equal(cache.load(key)['X'], X)
+    assert cache.key([str(data_file)], {'dim': 20}) == key
+
+#a change of the parameters or of the input content gives a new key
+def test_cache_key_invalidation(tmpdir):
+    cache = FeatureCache(str(tmpdir.join('cache')))
+    data_file = tmpdir.join('sc_mat.txt')
+    data_file.write('a\tb\n1\t2\n')
+    key = cache.key([str(data_file)], {'dim': 20})
+    assert cache.key([str(data_file)], {'dim': 10}) != key
+    data_file.write('a\tb\n1\t3\n')
+    data_file.setmtime(data_file.mtime() + 10)
+    assert cache.key([str(data_file)], {'dim': 20}) != key
+
+def test_cached_reducer_transform(tmpdir):
+    X = np.random.RandomState(0).rand(30, 8)
+    reducer = RandomizedPCA(n_components=3, random_state=0).fit(X)
+    cache = FeatureCache(str(tmpdir))
+    cache.save('entry', **reducer_arrays('pca', reducer))
+    np.testing.assert_allclose(load_reducer(cache.load('entry'), 'pca').transform(X), reducer.transform(X))
+
+
+#entries written before the samplers kept the 10x feature ids must not be reused
+def test_entry_without_ids_is_not_reused(tmpdir, monkeypatch):
+    import glob
+    import cache
+    import util
+    from test_tenx import write_mtx
+    monkeypatch.chdir(str(tmpdir))
+    write_mtx('datasets/toy/filtered_feature_bc_matrix')
+    kwargs = dict(name='toy', n_components=3, mode=3, sparse=True, cache_dir='cache')
+    #an entry of the previous cache version, without the ids
+    monkeypatch.setattr(cache, 'CACHE_VERSION', 2)
+    util.ARC_Sampler(**kwargs)
+    path, = glob.glob('cache/*.npz')
+    with np.load(path) as f:
+        arrays = dict((k, f[k]) for k in f.files if not k.endswith('_ids'))
+    np.savez(path, **arrays)
+    assert util.ARC_Sampler(**kwargs).gene_ids is None
+    monkeypatch.setattr(cache, 'CACHE_VERSION', 3)
+    sampler = util.ARC_Sampler(**kwargs)
+    assert sampler.gene_ids is not None and sampler.peak_ids is not None
+    assert len(glob.glob('cache/*.npz')) == 2
+
+#jobs digesting different inputs at the same time keep the memo of every input
+def test_concurrent_digests_are_all_kept(tmpdir):
+    cache = FeatureCache(str(tmpdir.join('cache')))
+    paths = []
+    for i in range(40):
+        data_file = tmpdir.join('input%d.txt' % i)
+        data_file.write('cell\t%d\n' % i * (i + 1))
+        paths.append(str(data_file))
+    threads = [threading.Thread(target=lambda part: [cache.file_digest(path) for path in part], args=(paths[i::8],)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    memos = os.listdir(cache.digest_dir)
+    assert len(memos) == len(paths) and not any('.tmp' in name for name in memos)
+    for name in memos:
+        with open(os.path.join(cache.digest_dir, name)) as f:
+            entry = json.load(f)
+        with open(entry['path'], 'rb') as f:
+            assert entry['digest'] == hashlib.sha1(f.read()).hexdigest()
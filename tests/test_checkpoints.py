@@ -0,0 +1,84 @@
+from __future__ import division
+import os
+import json
+import threading
+import pytest
+from checkpoints import BackgroundWorker, CheckpointKeeper, find_checkpoint
+
+
+#a checkpoint prefix with the files a tf.train.Saver writes for it
+def write_checkpoint(checkpoint_dir, step):
+    path = os.path.join(str(checkpoint_dir), 'model.ckpt-%d' % step)
+    for suffix in ['.index', '.data-00000-of-00001']:
+        open(path + suffix, 'w').close()
+    return path
+
+
+def kept_steps(checkpoint_dir):
+    return sorted(int(name.split('-')[1].split('.')[0]) for name in os.listdir(str(checkpoint_dir)) if name.endswith('.index'))
+
+
+#the last keep_last checkpoints plus the keep_best best ones survive, the others are deleted
+def test_keeper_keeps_last_and_best(tmpdir):
+    keeper = CheckpointKeeper(str(tmpdir), keep_last=2, keep_best=1, metric='nmi', mode='max')
+    for step, nmi in enumerate([0.2, 0.9, 0.4, 0.3, 0.5]):
+        keeper.add(write_checkpoint(tmpdir, step), step, {'nmi': nmi})
+    assert kept_steps(tmpdir) == [1, 3, 4]
+    with open(str(tmpdir.join('checkpoints.json'))) as f:
+        record = json.load(f)
+    assert record['best'].endswith('model.ckpt-1')
+    assert [item['removed'] for item in record['history']] == [True, False, True, False, False]
+    assert find_checkpoint(str(tmpdir)) == record['best']
+
+
+#mode='min' ranks the lowest value first, checkpoints without the metric are never the best
+def test_keeper_min_mode_and_missing_metric(tmpdir):
+    keeper = CheckpointKeeper(str(tmpdir), keep_last=1, keep_best=2, metric='l2_loss_y', mode='min')
+    for step, metrics in enumerate([{'l2_loss_y': 3.}, {}, {'l2_loss_y': 1.}, {'l2_loss_y': 2.}, {'l2_loss_y': 5.}]):
+        keeper.add(write_checkpoint(tmpdir, step), step, metrics)
+    assert kept_steps(tmpdir) == [2, 3, 4]
+    assert keeper.best().endswith('model.ckpt-2')
+
+
+#without a metric only the last keep_last checkpoints are kept, and the last one is restored
+def test_keeper_keep_last_only(tmpdir):
+    keeper = CheckpointKeeper(str(tmpdir), keep_last=1, keep_best=1)
+    for step in range(3):
+        keeper.add(write_checkpoint(tmpdir, step), step, {'nmi': 1.})
+    assert kept_steps(tmpdir) == [2]
+    assert keeper.best() is None
+    assert find_checkpoint(str(tmpdir)).endswith('model.ckpt-2')
+
+
+#jobs run in order in the worker thread, wait() blocks until they are done
+def test_worker_runs_jobs_in_order():
+    worker = BackgroundWorker()
+    done, threads = [], []
+    for i in range(3):
+        worker.submit(lambda i: (done.append(i), threads.append(threading.current_thread())), i)
+    worker.wait()
+    assert done == [0, 1, 2]
+    assert threading.current_thread() not in threads
+    worker.close()
+    assert not worker.thread.is_alive()
+
+
+def fail(message):
+    raise RuntimeError(message)
+
+
+#an exception of a job is re-raised once in the caller thread by the next wait, submit or close
+def test_worker_propagates_errors():
+    worker = BackgroundWorker()
+    worker.submit(fail, 'wait')
+    with pytest.raises(RuntimeError, match='wait'):
+        worker.wait()
+    worker.wait()
+    worker.submit(fail, 'submit')
+    worker.queue.join()
+    with pytest.raises(RuntimeError, match='submit'):
+        worker.submit(lambda: None)
+    worker.submit(fail, 'close')
+    with pytest.raises(RuntimeError, match='close'):
+        worker.close()
+    assert not worker.thread.is_alive()
@@ -0,0 +1,42 @@
+from __future__ import division
+import numpy as np
+import pytest
+from sklearn import metrics
+from clustering import clustering_scores, assignment_scores, StreamingContingency
+
+
+def labelings(seed):
+    rng = np.random.RandomState(seed)
+    labels_true = rng.randint(0, 5, 500)
+    #noisy copy with a different number of clusters
+    labels_pred = np.where(rng.rand(500) < 0.7, labels_true * 7 % 6, rng.randint(0, 6, 500))
+    return labels_true, labels_pred
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_scores_match_sklearn(seed):
+    labels_true, labels_pred = labelings(seed)
+    scores = clustering_scores(labels_true, labels_pred)
+    homogeneity, completeness, v_measure = metrics.homogeneity_completeness_v_measure(labels_true, labels_pred)
+    expected = dict(nmi=metrics.normalized_mutual_info_score(labels_true, labels_pred),
+        ari=metrics.adjusted_rand_score(labels_true, labels_pred),
+        ami=metrics.adjusted_mutual_info_score(labels_true, labels_pred),
+        homogeneity=homogeneity, completeness=completeness, v_measure=v_measure)
+    for name, value in expected.items():
+        assert abs(scores[name] - value) < 1e-10, name
+    C = metrics.cluster.contingency_matrix(labels_true, labels_pred)
+    assert abs(scores['purity'] - C.max(axis=0).sum() / C.sum()) < 1e-12
+
+def test_degenerate_labelings():
+    scores = clustering_scores([0, 0, 1, 1], [0, 0, 0, 0])
+    assert scores['ari'] == metrics.adjusted_rand_score([0, 0, 1, 1], [0, 0, 0, 0])
+    assert clustering_scores([1, 1], [2, 2])['nmi'] == 1.
+
+def test_one_hot_and_streaming():
+    labels_true, labels_pred = labelings(2)
+    scores = clustering_scores(labels_true, labels_pred)
+    soft = np.eye(6)[labels_pred] * 0.9 + 0.01
+    assert assignment_scores(np.eye(5)[labels_true], soft=soft)['nmi'] == scores['nmi']
+    stream = StreamingContingency()
+    for start in range(0, 500, 128):
+        stream.update(labels_true[start:start+128], labels_pred[start:start+128])
+    assert abs(stream.scores()['ami'] - scores['ami']) < 1e-12
@@ -0,0 +1,80 @@
+from __future__ import division
+import numpy as np
+from util import DataPool
+
+
+def rows(start, n):
+    return np.arange(start, start + n, dtype=np.float32)[:, None] * np.ones((1, 2), dtype=np.float32)
+
+
+#once full, ring replacement overwrites the oldest rows in order
+def test_ring_overwrites_oldest_rows():
+    pool = DataPool(capacity=6, replace='ring')
+    pool.add(rows(0, 4))
+    pool.add(rows(4, 4))
+    assert len(pool) == 6
+    assert pool.head == 2
+    np.testing.assert_array_equal(pool.arrays[0][:, 0], [6, 7, 2, 3, 4, 5])
+
+
+#random replacement fills as a ring, then writes at random rows without growing
+def test_random_keeps_capacity():
+    pool = DataPool(capacity=6, replace='random', seed=1)
+    pool.add(rows(0, 6))
+    head = pool.head
+    for start in range(6, 30, 3):
+        pool.add(rows(start, 3))
+    assert len(pool) == 6
+    assert pool.head == head
+    stored = pool.arrays[0][:, 0]
+    assert stored.max() >= 6
+    assert len(np.unique(stored)) == 6
+
+
+#an add larger than the remaining capacity wraps to the start, one larger than the capacity
+#keeps its last `capacity` rows
+def test_add_wraps_around():
+    pool = DataPool(capacity=5, replace='random')
+    pool.add(rows(0, 3))
+    pool.add(rows(3, 4))
+    assert len(pool) == 5
+    assert pool.head == 2
+    np.testing.assert_array_equal(pool.arrays[0][:, 0], [5, 6, 2, 3, 4])
+    pool = DataPool(capacity=5, replace='ring')
+    pool.add(rows(0, 8))
+    assert len(pool) == 5
+    np.testing.assert_array_equal(np.sort(pool.arrays[0][:, 0]), [3, 4, 5, 6, 7])
+
+
+#rows of the stored arrays stay paired and sample() reuses its output arrays for each n
+def test_sample_reuses_output_buffer():
+    pool = DataPool(capacity=8)
+    pool.add(rows(0, 8), np.arange(8))
+    first = pool.sample(4)
+    ids = first[1].copy()
+    second = pool.sample(4)
+    assert all(a is b for a, b in zip(first, second))
+    np.testing.assert_array_equal(second[0][:, 0], second[1])
+    assert pool.sample(3)[0].shape == (3, 2)
+    out = [np.empty((4, 2), dtype=np.float32), np.empty(4, dtype=ids.dtype)]
+    assert pool.sample(4, out=out) is out
+    assert set(out[1]) <= set(range(8))
+
+
+#the legacy call returns its input until the pool is full, then a stored copy half of the time
+def test_call_legacy_interface():
+    pool = DataPool(capacity=4, seed=0)
+    data = [rows(0, 2), np.arange(2)]
+    assert pool(data) is data
+    assert pool([rows(2, 2), np.arange(2, 4)])[1].tolist() == [2, 3]
+    assert len(pool) == 4
+    replayed = 0
+    for i in range(20):
+        data = [rows(10 + 2 * i, 2), np.arange(10 + 2 * i, 12 + 2 * i)]
+        result = pool(data)
+        if result is not data:
+            replayed += 1
+            assert all(r.base is None for r in result)
+            np.testing.assert_array_equal(result[0][:, 0], result[1])
+    assert 0 < replayed < 20
+    assert len(pool) == 4
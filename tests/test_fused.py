@@ -0,0 +1,105 @@
+from __future__ import division
+import importlib
+import numpy as np
+import pytest
+import util
+from pipeline import draw_iteration
+
+#critic and generator update ops of the sequential schedule in each script
+SCHEDULES = {'main_cgan': ('dy_optim', 'g_optim'), 'main_trajactory_infer': ('d_optim', 'g_h_optim')}
+
+
+#one fused step equals nb_critic critic updates then one generator update on the same batches
+@pytest.mark.parametrize('script', sorted(SCHEDULES))
+def test_fused_step_matches_sequential_updates(script, tmpdir, monkeypatch):
+    tf = pytest.importorskip('tensorflow')
+    if not hasattr(tf, 'contrib'):
+        pytest.skip('model.py needs TensorFlow 1.x (tf.contrib)')
+    import model
+    module = importlib.import_module(script)
+    monkeypatch.chdir(str(tmpdir))
+    #fixed interpolation of the gradient penalties, the two schedules draw it from different ops
+    monkeypatch.setattr(tf, 'random_uniform', lambda *args, **kwargs: tf.constant(0.5))
+    tf.reset_default_graph()
+    tf.set_random_seed(0)
+    rng = np.random.RandomState(0)
+    ys = util.ArraySampler(rng.rand(64, 10).astype(np.float32), np.eye(3)[rng.randint(0, 3, 64)])
+    xs = util.Mixture_sampler(nb_classes=3, N=100, dim=4, sd=1)
+    g_net, h_net, dx_net, dy_net = module.build_nets(model, 4, 10, 3)
+    net = module.scDEC(g_net, h_net, dx_net, dy_net, xs, ys, 3, 'toy', util.DataPool(), 16, 10., 10., False, fused=True)
+    #the resource variables are scoped to the model
+    assert not tf.get_variable_scope().use_resource
+    net.sess.run(tf.global_variables_initializer())
+    variables = tf.global_variables()
+    initial = net.sess.run(variables)
+    bxs, bx_onehots, bys = draw_iteration(xs, ys, 16, net.nb_critic + 1)
+    lr = 1e-3
+
+    net.sess.run(net.fused_step, feed_dict={net.xs: bxs, net.x_onehots: bx_onehots, net.ys: bys, net.lr: lr})
+    fused = net.sess.run(variables)
+
+    for var, value in zip(variables, initial):
+        var.load(value, net.sess)
+    critic, generator = [getattr(net, name) for name in SCHEDULES[script]]
+    for i in range(net.nb_critic + 1):
+        net.sess.run(critic if i < net.nb_critic else generator,
+            feed_dict={net.x: bxs[i], net.x_onehot: bx_onehots[i], net.y: bys[i], net.lr: lr})
+    sequential = net.sess.run(variables)
+    net.sess.close()
+    for var, a, b in zip(variables, fused, sequential):
+        np.testing.assert_allclose(a, b, rtol=1e-4, atol=1e-6, err_msg=var.op.name)
+
+
+#with replay, every critic update stores its generator samples in the pool, and later updates
+#feed a replay fraction of the batch from it
+@pytest.mark.parametrize('script', sorted(SCHEDULES))
+def test_train_replay_fills_pool(script, tmpdir, monkeypatch):
+    tf = pytest.importorskip('tensorflow')
+    if not hasattr(tf, 'contrib'):
+        pytest.skip('model.py needs TensorFlow 1.x (tf.contrib)')
+    import model
+    module = importlib.import_module(script)
+    monkeypatch.chdir(str(tmpdir))
+    tf.reset_default_graph()
+    rng = np.random.RandomState(0)
+    ys = util.ArraySampler(rng.rand(64, 10).astype(np.float32), np.eye(3)[rng.randint(0, 3, 64)])
+    xs = util.Mixture_sampler(nb_classes=3, N=100, dim=4, sd=1)
+    g_net, h_net, dx_net, dy_net = module.build_nets(model, 4, 10, 3)
+    pool = util.DataPool(capacity=1000)
+    net = module.scDEC(g_net, h_net, dx_net, dy_net, xs, ys, 3, 'toy', pool, 16, 10., 10., False)
+    sampled = []
+    sample = pool.sample
+    monkeypatch.setattr(pool, 'sample', lambda n, out=None: sampled.append(n) or sample(n, out))
+    #eval_every above nb_batches: no checkpoint is written
+    net.train(nb_batches=2, prefetch=0, eval_every=10, replay=0.5)
+    net.sess.close()
+    assert len(pool) == 2 * net.nb_critic * 16
+    assert sampled == [8] * (2 * net.nb_critic - 1)
+    assert pool.arrays[0].shape[1:] == (10,) and pool.arrays[1].shape[1:] == (3,)
+
+
+#checkpoints hold the network weights and the Adam state of the optimizers the schedule runs only
+@pytest.mark.parametrize('script', sorted(SCHEDULES))
+def test_checkpoint_variables(script, tmpdir, monkeypatch):
+    tf = pytest.importorskip('tensorflow')
+    if not hasattr(tf, 'contrib'):
+        pytest.skip('model.py needs TensorFlow 1.x (tf.contrib)')
+    import model
+    module = importlib.import_module(script)
+    monkeypatch.chdir(str(tmpdir))
+    tf.reset_default_graph()
+    rng = np.random.RandomState(0)
+    ys = util.ArraySampler(rng.rand(64, 10).astype(np.float32), np.eye(3)[rng.randint(0, 3, 64)])
+    xs = util.Mixture_sampler(nb_classes=3, N=100, dim=4, sd=1)
+    g_net, h_net, dx_net, dy_net = module.build_nets(model, 4, 10, 3)
+    net = module.scDEC(g_net, h_net, dx_net, dy_net, xs, ys, 3, 'toy', util.DataPool(), 16, 10., 10., False)
+    net.sess.run(tf.global_variables_initializer())
+    net.build_snapshot()
+    net.sess.close()
+    names = set(net.snapshot_names)
+    assert set(var.op.name for var in tf.trainable_variables()) <= names
+    used = set(var.op.name for var in tf.global_variables() if 'Adam' in var.op.name) & names
+    assert used and not any(name.startswith('shadow_') for name in names)
+    #the slots of the update ops built but never run are left out
+    unused = [name for name in (set(var.op.name for var in tf.global_variables()) - names) if not name.startswith('shadow_')]
+    assert unused and all('Adam' in name or 'beta' in name for name in unused)
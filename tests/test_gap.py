@@ -0,0 +1,24 @@
+from __future__ import division
+import numpy as np
+from sklearn.metrics import pairwise_distances
+from gap import dispersion, gap_statistic
+
+
+def blobs(n_clusters=3, n=60, seed=0):
+    rng = np.random.RandomState(seed)
+    centers = rng.uniform(-10, 10, (n_clusters, 2))
+    labels = rng.randint(0, n_clusters, n)
+    return centers[labels] + rng.normal(scale=0.5, size=(n, 2)), labels
+
+#W_k = sum_r D_r / (2 n_r), D_r the sum of the pairwise squared distances inside cluster r
+def test_dispersion_matches_pairwise_definition():
+    X, labels = blobs()
+    expected = sum(np.sum(pairwise_distances(X[labels == c]) ** 2) / (2. * np.sum(labels == c)) for c in np.unique(labels))
+    np.testing.assert_allclose(dispersion(X, labels), expected, rtol=1e-10)
+
+def test_gap_statistic_finds_blobs():
+    X, _ = blobs(n_clusters=3, n=150)
+    result = gap_statistic(X, k_max=6, n_references=5, early_stop=False)
+    assert result['best_k'] == 3
+    assert list(result['k']) == [2, 3, 4, 5, 6]
+    np.testing.assert_allclose(result['gap'], result['log_ref'] - result['log_wk'])
@@ -0,0 +1,97 @@
+from __future__ import division
+import importlib
+import numpy as np
+import pytest
+import inference
+from inference import allocate, auto_chunk_size, run_chunked
+
+
+#session stand-in: fetches are NumPy functions of the feed dict, the chunk sizes fed are recorded
+class NumpySession(object):
+    def __init__(self):
+        self.chunks = []
+
+    def run(self, fetches, feed_dict):
+        self.chunks.append(len(list(feed_dict.values())[0]))
+        return [fetch(feed_dict) for fetch in fetches]
+
+class Net(object):
+    nb_units = 16
+
+#the attributes of scDEC used by predict_*, with H and G replaced by fixed random maps
+class StandIn(object):
+    x_dim, y_dim, nb_classes = 3, 8, 4
+
+    def __init__(self):
+        rng = np.random.RandomState(0)
+        self.sess = NumpySession()
+        self.g_net = self.h_net = Net()
+        w_h = rng.normal(size=(self.y_dim, self.x_dim + self.nb_classes))
+        w_g = rng.normal(size=(self.x_dim + self.nb_classes, self.y_dim))
+        self.y, self.x, self.x_onehot = 'y', 'x', 'x_onehot'
+        self.x_latent_ = lambda feed: np.tanh(feed['y'].dot(w_h))
+        self.x_onehot_ = lambda feed: softmax(feed['y'].dot(w_h)[:, self.x_dim:])
+        self.x_label_ = lambda feed: np.argmax(feed['y'].dot(w_h)[:, self.x_dim:], axis=1)
+        self.y_ = lambda feed: np.hstack([feed['x'], feed['x_onehot']]).dot(w_g)
+
+def softmax(logits):
+    e = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return e / e.sum(axis=1, keepdims=True)
+
+
+#predict_x, predict_y and predict_all in chunks (last one partial) equal one unchunked pass
+@pytest.mark.parametrize('script', ['main_cgan', 'main_trajactory_infer'])
+def test_chunked_predict_matches_one_pass(script, tmpdir):
+    scDEC = importlib.import_module(script).scDEC
+    net = StandIn()
+    net.row_bytes = lambda: scDEC.row_bytes(net)
+    rng = np.random.RandomState(1)
+    y = rng.normal(size=(103, net.y_dim))
+    x, x_onehot = rng.normal(size=(103, net.x_dim)), np.eye(net.nb_classes)[rng.randint(0, net.nb_classes, 103)]
+
+    x_pred, onehot = scDEC.predict_x(net, y, bs=103)
+    assert net.sess.chunks == [103]
+    net.sess.chunks = []
+    x_chunked, onehot_chunked = scDEC.predict_x(net, y, bs=10)
+    assert net.sess.chunks == [10] * 10 + [3]
+    assert x_chunked.dtype == np.float32
+    np.testing.assert_array_equal(x_chunked, x_pred)
+    np.testing.assert_array_equal(onehot_chunked, onehot)
+
+    y_pred = scDEC.predict_y(net, x, x_onehot, bs=103)
+    out = np.zeros((103, net.y_dim), dtype=np.float32)
+    assert scDEC.predict_y(net, x, x_onehot, bs=7, out=out) is out
+    np.testing.assert_array_equal(out, y_pred)
+    #the chunk size is derived from the free memory when not given
+    np.testing.assert_array_equal(scDEC.predict_y(net, x, x_onehot), y_pred)
+
+    embeds, soft, labels = scDEC.predict_all(net, y, bs=25, out_dir=str(tmpdir.join('out')))
+    np.testing.assert_array_equal(embeds, x_pred)
+    np.testing.assert_array_equal(soft, onehot)
+    np.testing.assert_array_equal(labels, onehot.argmax(axis=1))
+    np.testing.assert_array_equal(np.load(str(tmpdir.join('out', 'labels.npy'))), labels)
+
+
+#the chunk size is a fraction of the free memory, clipped to [min_size, max_size]
+def test_auto_chunk_size_bounds(monkeypatch):
+    monkeypatch.setattr(inference, 'available_memory', lambda: 1 << 20)
+    assert auto_chunk_size(1024, memory_fraction=0.5) == 512
+    assert auto_chunk_size(1 << 20) == 256
+    assert auto_chunk_size(1 << 20, min_size=1) == 1
+    assert auto_chunk_size(0, memory_fraction=1.) == 1 << 18
+    monkeypatch.setattr(inference, 'available_memory', lambda: 1 << 40)
+    assert auto_chunk_size(4, max_size=1000) == 1000
+    assert 256 <= auto_chunk_size(1 << 12) <= 1 << 18
+    assert isinstance(auto_chunk_size(4), int)
+
+def test_allocate(tmpdir):
+    out = np.empty((5, 2), dtype=np.float32)
+    assert allocate((5, 2), out=out) is out
+    with pytest.raises(AssertionError):
+        allocate((4, 2), out=out)
+    mapped = allocate((5, 2), dtype=np.int32, path=str(tmpdir.join('a.npy')))
+    assert isinstance(mapped, np.memmap) and mapped.dtype == np.int32
+    mapped[:] = 3
+    run_chunked(NumpySession(), [lambda feed: feed['v'] * 2], {'v': np.arange(10).reshape(5, 2)}, [mapped], 2)
+    np.testing.assert_array_equal(np.load(str(tmpdir.join('a.npy'))), np.arange(10).reshape(5, 2) * 2)
+    assert allocate((3,)).shape == (3,) and allocate((3,)).dtype == np.float32
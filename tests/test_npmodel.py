@@ -0,0 +1,79 @@
+from __future__ import division
+import numpy as np
+import pytest
+from npmodel import NumpyScDEC, build_nets, load_weights
+
+
+def lrelu(x):
+    return np.maximum(x, 0.2 * x)
+
+#random weights under the TF variable names of model.Encoder/Generator with nb_layers=2
+def random_weights(x_dim=4, nb_classes=3, y_dim=10, units=16, seed=0):
+    rng = np.random.RandomState(seed)
+    arrays = {}
+    def dense(scope, n_in, n_out):
+        arrays[scope + '/weights'] = rng.normal(size=(n_in, n_out)).astype(np.float32)
+        arrays[scope + '/biases'] = rng.normal(size=n_out).astype(np.float32)
+    dense('h_net/fully_connected', y_dim, units)
+    dense('h_net/fully_connected_1', units, units)
+    dense('h_net/fully_connected_2', units, x_dim + nb_classes)
+    dense('g_net/fully_connected', x_dim + nb_classes, units)
+    dense('g_net/fully_connected_1', units + nb_classes, units)
+    dense('g_net/fully_connected_2', units + nb_classes, y_dim)
+    specs = [dict(name='h_net', feat_dim=x_dim, input_dim=y_dim, output_dim=x_dim + nb_classes, nb_layers=2, nb_units=units, **{'class': 'Encoder'}),
+        dict(name='g_net', input_dim=x_dim, output_dim=y_dim, nb_layers=2, nb_units=units, concat_every_fcl=True, **{'class': 'Generator'})]
+    return arrays, specs
+
+#the layer sequence of model.py written out for two hidden layers
+def test_forward_matches_model_definition():
+    arrays, specs = random_weights()
+    net = NumpyScDEC(build_nets(arrays, specs))
+    rng = np.random.RandomState(1)
+    y = rng.normal(size=(25, 10)).astype(np.float32)
+    W = lambda scope: (arrays[scope + '/weights'], arrays[scope + '/biases'])
+    h = lrelu(y.dot(W('h_net/fully_connected')[0]) + W('h_net/fully_connected')[1])
+    h = lrelu(h.dot(W('h_net/fully_connected_1')[0]) + W('h_net/fully_connected_1')[1])
+    out = h.dot(W('h_net/fully_connected_2')[0]) + W('h_net/fully_connected_2')[1]
+    logits = out[:, 4:]
+    soft = np.exp(logits) / np.exp(logits).sum(axis=1, keepdims=True)
+    embeds, soft_, labels = net.predict_all(y, bs=7)
+    np.testing.assert_allclose(embeds, out, rtol=1e-5, atol=1e-5)
+    np.testing.assert_allclose(soft_, soft, rtol=1e-5, atol=1e-6)
+    np.testing.assert_array_equal(labels, soft.argmax(axis=1))
+
+    x, onehot = rng.normal(size=(25, 4)).astype(np.float32), np.eye(3, dtype=np.float32)[rng.randint(0, 3, 25)]
+    g = lrelu(np.hstack([x, onehot]).dot(W('g_net/fully_connected')[0]) + W('g_net/fully_connected')[1])
+    g = lrelu(np.hstack([g, onehot]).dot(W('g_net/fully_connected_1')[0]) + W('g_net/fully_connected_1')[1])
+    g = np.hstack([g, onehot]).dot(W('g_net/fully_connected_2')[0]) + W('g_net/fully_connected_2')[1]
+    np.testing.assert_allclose(net.predict_y(x, onehot, bs=7), g, rtol=1e-4, atol=1e-4)
+
+#same outputs as the TF1 graph of model.py on weights written by export_weights
+def test_forward_matches_tensorflow(tmpdir):
+    tf = pytest.importorskip('tensorflow')
+    if not hasattr(tf, 'contrib'):
+        pytest.skip('model.py needs TensorFlow 1.x (tf.contrib)')
+    import model
+    from npmodel import export_weights
+    x_dim, nb_classes, y_dim = 4, 3, 10
+    graph = tf.Graph()
+    with graph.as_default():
+        g_net = model.Generator(input_dim=x_dim, output_dim=y_dim, name='g_net', nb_layers=2, nb_units=16)
+        h_net = model.Encoder(input_dim=y_dim, output_dim=x_dim + nb_classes, feat_dim=x_dim, name='h_net', nb_layers=2, nb_units=16)
+        x = tf.placeholder(tf.float32, [None, x_dim + nb_classes])
+        y = tf.placeholder(tf.float32, [None, y_dim])
+        y_ = g_net(x, reuse=False)
+        embeds_, soft_ = h_net(y, reuse=False)
+        sess = tf.Session(graph=graph)
+        sess.run(tf.global_variables_initializer())
+        path = str(tmpdir.join('weights.npz'))
+        export_weights(sess, [g_net, h_net], path)
+        rng = np.random.RandomState(0)
+        bx = np.hstack([rng.normal(size=(50, x_dim)), np.eye(nb_classes)[rng.randint(0, nb_classes, 50)]]).astype(np.float32)
+        by = rng.normal(size=(50, y_dim)).astype(np.float32)
+        tf_y, tf_embeds, tf_soft = sess.run([y_, embeds_, soft_], feed_dict={x: bx, y: by})
+        sess.close()
+    net = NumpyScDEC(load_weights(path))
+    embeds, soft = net.predict_x(by)
+    np.testing.assert_allclose(embeds, tf_embeds, atol=1e-5)
+    np.testing.assert_allclose(soft, tf_soft, atol=1e-5)
+    np.testing.assert_allclose(net.predict_y(bx[:, :x_dim], bx[:, x_dim:]), tf_y, atol=1e-5)
@@ -0,0 +1,90 @@
+from __future__ import division
+import time
+import numpy as np
+import pytest
+import util
+from pipeline import draw_iteration, check_nb_classes, choose_nb_classes, BatchPrefetcher
+
+
+#labelled y sampler whose first feature is the label index, so rows and one-hots can be matched
+def labelled_sampler(n=200, n_labels=3, seed=0):
+    rng = np.random.RandomState(seed)
+    labels = rng.randint(0, n_labels, n)
+    feats = rng.rand(n, 20).astype(np.float32)
+    feats[:, 0] = labels
+    return util.ArraySampler(feats, np.eye(n_labels)[labels])
+
+#the one-hots fed as x_onehot are the labels of the y rows of the same batch
+def test_draw_iteration_conditions_on_labels():
+    ys = labelled_sampler()
+    xs = util.Mixture_sampler(nb_classes=3, N=100, dim=10, sd=1)
+    bxs, bx_onehots, bys = draw_iteration(xs, ys, batch_size=8, nb_steps=6)
+    assert bxs.shape == (6, 8, 10) and bys.shape == (6, 8, 20) and bx_onehots.shape == (6, 8, 3)
+    np.testing.assert_array_equal(bx_onehots.argmax(axis=2), bys[:, :, 0])
+
+def test_check_nb_classes():
+    ys = labelled_sampler()
+    check_nb_classes(ys, 3)
+    with pytest.raises(ValueError):
+        check_nb_classes(ys, 5)
+
+#unlabelled sampler as ARC_Sampler: load_all returns the features only
+class FeatsSampler(object):
+    def __init__(self, feats):
+        self.feats = feats
+
+    def load_all(self):
+        return self.feats
+
+def test_choose_nb_classes_with_gap_statistic():
+    rng = np.random.RandomState(0)
+    centers = np.array([[0, 0], [10, 0], [0, 10]])
+    feats = centers[rng.randint(0, 3, 150)] + rng.normal(scale=0.5, size=(150, 2))
+    assert choose_nb_classes(FeatsSampler(feats), 0, k_max=6, n_jobs=1) == 3
+    assert choose_nb_classes(FeatsSampler(feats), 7) == 7
+
+#labels fix K, the gap statistic cannot choose it
+def test_choose_nb_classes_with_labels():
+    ys = labelled_sampler()
+    assert choose_nb_classes(ys, 3) == 3
+    with pytest.raises(ValueError):
+        choose_nb_classes(ys, 0)
+    with pytest.raises(ValueError):
+        choose_nb_classes(ys, 5)
+
+#x sampler failing on its `fail_at`-th call
+class FailingSampler(object):
+    def __init__(self, fail_at):
+        self.sampler = util.Mixture_sampler(nb_classes=3, N=100, dim=10, sd=1)
+        self.fail_at = fail_at
+        self.calls = 0
+
+    def train(self, batch_size, weights=None):
+        self.calls += 1
+        if self.calls == self.fail_at:
+            raise RuntimeError('sampler failed')
+        return self.sampler.train(batch_size, weights)
+
+#the iterations drawn before the failure are returned, then next() re-raises it in the caller thread
+def test_prefetcher_reraises_sampler_error():
+    prefetcher = BatchPrefetcher(FailingSampler(3), labelled_sampler(), batch_size=8, nb_steps=6, capacity=4)
+    for _ in range(2):
+        bxs, bx_onehots, bys = prefetcher.next()
+        assert bxs.shape == (6, 8, 10)
+    with pytest.raises(RuntimeError, match='sampler failed'):
+        prefetcher.next()
+    prefetcher.close()
+    assert not prefetcher.thread.is_alive()
+
+#close() stops the thread blocked on a full queue
+def test_prefetcher_close_with_full_queue():
+    prefetcher = BatchPrefetcher(util.Mixture_sampler(nb_classes=3, N=100, dim=10, sd=1), labelled_sampler(),
+        batch_size=8, nb_steps=6, capacity=2)
+    for _ in range(100):
+        if prefetcher.queue.full():
+            break
+        time.sleep(0.01)
+    assert prefetcher.queue.full()
+    prefetcher.close()
+    assert not prefetcher.thread.is_alive()
+    assert prefetcher.next()[0].shape == (6, 8, 10)
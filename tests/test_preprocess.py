@@ -0,0 +1,93 @@
+from __future__ import division
+import os
+import numpy as np
+import scipy.sparse as sp
+from sklearn.decomposition import PCA, IncrementalPCA
+from sklearn.preprocessing import MinMaxScaler
+import util
+from preprocess import RandomizedPCA, tfidf, minmax_scale_sparse, normalize_total, log_transform, reduce_incremental
+
+
+#principal axes are defined up to their sign
+def assert_same_projections(A, B, atol=1e-5):
+    signs = np.sign(np.sum(A * B, axis=0))
+    np.testing.assert_allclose(A, B * signs[None, :], atol=atol)
+
+def counts(n_cells=80, n_feats=30, seed=0):
+    rng = np.random.RandomState(seed)
+    X = rng.poisson(0.4, (n_cells, n_feats)).astype(np.float64)
+    #a feature present in every cell
+    X[:, 0] += 1
+    return X
+
+#TF-IDF as in the baseline scATAC_Sampler, with np.tile
+def tfidf_baseline(X):
+    X = X.copy()
+    X[:, X.sum(axis=0) == 0] = 1e-12
+    idf = np.log(1 + 1.0 * X.shape[1] / np.sum(X, axis=1))
+    X_idf = X / np.tile(np.sum(X, axis=0), (X.shape[0], 1))
+    return X_idf * np.tile(idf, (X.shape[1], 1)).T
+
+def test_tfidf_matches_baseline():
+    X = counts().T #(peaks, cells)
+    np.testing.assert_allclose(tfidf(X), tfidf_baseline(X), rtol=1e-10)
+    np.testing.assert_allclose(tfidf(sp.csr_matrix(X)).toarray(), tfidf_baseline(X), rtol=1e-10)
+
+#library-size normalization and log10(x+1) as in the dense ARC_Sampler path
+def test_normalize_log_matches_dense_formula():
+    X = counts()
+    expected = np.log10((X.T * 10000 / np.sum(X, axis=1)).T + 1)
+    np.testing.assert_allclose(log_transform(normalize_total(X, dtype=np.float64)), expected, rtol=1e-12)
+    sparse = log_transform(normalize_total(sp.csr_matrix(X), dtype=np.float64))
+    assert sp.issparse(sparse)
+    np.testing.assert_allclose(sparse.toarray(), expected, rtol=1e-12)
+
+def test_randomized_pca_matches_sklearn():
+    #counts with a few cell types, so the leading axes are well separated
+    rng = np.random.RandomState(0)
+    rates = np.exp(rng.normal(size=(6, 40)))[rng.randint(0, 6, 200)]
+    X = log_transform(normalize_total(rng.poisson(rates), dtype=np.float64))
+    pca = PCA(n_components=5).fit(X)
+    for data in [X, sp.csr_matrix(X)]:
+        reducer = RandomizedPCA(n_components=5, n_iter=7, random_state=0).fit(data)
+        np.testing.assert_allclose(reducer.explained_variance_, pca.explained_variance_, rtol=1e-4)
+        np.testing.assert_allclose(reducer.mean_, pca.mean_, rtol=1e-6)
+        assert_same_projections(reducer.transform(data), pca.transform(X), atol=1e-3)
+
+def test_minmax_scale_sparse():
+    X = counts()
+    scaled, shift = minmax_scale_sparse(sp.csr_matrix(X))
+    assert shift[0] > 0
+    np.testing.assert_allclose(scaled.toarray() - shift[None, :], MinMaxScaler().fit_transform(X), atol=1e-12)
+
+#the sparse and dense scATAC_Sampler paths give the same features, with a peak open in every cell
+def test_scatac_sparse_matches_dense(tmpdir, monkeypatch):
+    X = counts(60, 12).T #(peaks, cells), all peaks pass the filter
+    os.makedirs(str(tmpdir.join('datasets', 'toy')))
+    with open(str(tmpdir.join('datasets', 'toy', 'sc_mat.txt')), 'w') as f:
+        f.write('\t'.join(['peak'] + ['cell%d' % i for i in range(X.shape[1])]) + '\n')
+        for i, row in enumerate(X):
+            f.write('\t'.join(['chr1_%d' % i] + ['%d' % v for v in row]) + '\n')
+    monkeypatch.chdir(str(tmpdir))
+    dense = util.scATAC_Sampler('toy', dim=5, low=0.03, has_label=False, cache_dir=None, sparse=False)
+    sparse = util.scATAC_Sampler('toy', dim=5, low=0.03, has_label=False, cache_dir=None, sparse=True)
+    assert dense.X.shape == sparse.X.shape == (60, 5)
+    assert_same_projections(sparse.X, dense.X, atol=1e-6)
+
+#out-of-core IncrementalPCA over blocks (also split across several matrices) against PCA in memory
+def test_reduce_incremental_matches_pca():
+    rng = np.random.RandomState(1)
+    rates = np.exp(rng.normal(size=(5, 30)))[rng.randint(0, 5, 300)]
+    X = rng.poisson(rates).astype(np.float32)
+    X[:, 3] = 0
+    reducer, feats, cols = reduce_incremental(sp.csr_matrix(X), 4, min_c=0, chunk_size=64)
+    assert not cols[3] and cols.sum() == 29
+    dense = log_transform(normalize_total(X[:, cols]), base=10)
+    #same fit as sklearn's IncrementalPCA with the whole matrix in memory, close to the exact PCA
+    expected = IncrementalPCA(n_components=4, batch_size=64).fit(dense)
+    assert_same_projections(feats, expected.transform(dense), atol=1e-4)
+    pca = PCA(n_components=4).fit(dense)
+    np.testing.assert_allclose(reducer.explained_variance_, pca.explained_variance_, rtol=5e-2)
+    #same features from a list of blocks and with several threads
+    _, split_feats, _ = reduce_incremental([sp.csr_matrix(X[:100]), sp.csr_matrix(X[100:])], 4, chunk_size=64, n_jobs=2)
+    np.testing.assert_allclose(split_feats, feats, atol=1e-5)
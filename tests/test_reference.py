@@ -0,0 +1,38 @@
+from __future__ import division
+import numpy as np
+import pytest
+from preprocess import RandomizedPCA, normalize_total, log_transform
+from reference import Reference, column_map, load_reference
+
+
+def test_column_map_reorders_and_fills():
+    idx, n_missing = column_map(['a', 'b', 'c'], ['c', 'a'])
+    assert n_missing == 0 and list(idx) == [2, 0]
+    select, n_missing = column_map(['a', 'b'], ['b', 'z'])
+    assert n_missing == 1
+    np.testing.assert_array_equal(select.toarray(), [[0, 0], [1, 0]])
+
+def test_column_map_rejects_duplicated_names():
+    with pytest.raises(ValueError):
+        column_map(['a', 'b', 'a'], ['a', 'b'])
+    with pytest.raises(ValueError):
+        column_map(['a', 'b'], ['b', 'b'])
+    #duplicates that are not matched do not matter
+    idx, _ = column_map(['a', 'x', 'x'], ['a'])
+    assert list(idx) == [0]
+
+#gene symbols repeat, the reference matches the query on the 10x ids
+def test_transform_matches_on_ids(tmpdir):
+    rng = np.random.RandomState(0)
+    X = rng.poisson(1., (50, 6)).astype(np.float32)
+    names, ids = np.array(['A', 'B', 'B', 'C', 'D', 'E']), np.array(['id%d' % i for i in range(6)])
+    reducer = RandomizedPCA(n_components=3, random_state=0).fit(log_transform(normalize_total(X), base=10))
+    path = str(tmpdir.join('reference.npz'))
+    Reference(1, 10000, {'rna': reducer}, features={'rna': names}, ids={'rna': ids}).save(path)
+    reference = load_reference(path)
+    expected = reference.transform({'rna': X})
+    order = rng.permutation(6)
+    query = {'rna': X[:, order]}
+    np.testing.assert_allclose(reference.transform(query, {'rna': names[order]}, ids={'rna': ids[order]}), expected, atol=1e-5)
+    with pytest.raises(ValueError):
+        reference.transform(query, {'rna': names[order]})
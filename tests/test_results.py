@@ -0,0 +1,57 @@
+from __future__ import division
+import numpy as np
+import pytest
+from results import ResultsStore
+
+pytest.importorskip('h5py')
+
+
+#one evaluation step round-trips: float arrays in the store dtype, integer labels unchanged, metrics in the index
+def test_write_read_one_step(tmpdir):
+    store = ResultsStore(str(tmpdir.join('run', 'results.h5')), chunk_rows=16)
+    rng = np.random.RandomState(0)
+    embeds, labels = rng.rand(100, 5), rng.randint(0, 3, 100)
+    store.write(10, metrics={'nmi': 0.5}, embeds=embeds, labels=labels)
+    store.write(20, metrics={'nmi': 0.7}, embeds=embeds[:3])
+    assert store.steps() == [10, 20]
+    assert store.index()[10] == {'metrics': {'nmi': 0.5}, 'arrays': ['embeds', 'labels']}
+    read = store.read(10, 'embeds')
+    assert read.dtype == np.float32
+    np.testing.assert_allclose(read, embeds, rtol=1e-6)
+    np.testing.assert_array_equal(store.read(10, 'labels'), labels)
+    assert store.read(10, 'labels').dtype == labels.dtype
+    np.testing.assert_allclose(store.read(10, 'embeds', rows=slice(40, 50)), embeds[40:50], rtol=1e-6)
+    steps, values = store.curve('nmi')
+    np.testing.assert_array_equal(steps, [10, 20])
+    np.testing.assert_allclose(values, [0.5, 0.7])
+    #a rewritten step replaces its arrays
+    store.write(20, embeds=embeds[:4])
+    assert store.read(20, 'embeds').shape == (4, 5)
+
+
+def test_float16(tmpdir):
+    store = ResultsStore(str(tmpdir.join('results.h5')), dtype='float16')
+    data = np.random.RandomState(1).rand(50, 4)
+    store.write(0, data=data, labels=np.arange(50))
+    read = store.read(0, 'data')
+    assert read.dtype == np.float16
+    np.testing.assert_allclose(read, data, atol=1e-3)
+    assert store.read(0, 'labels').dtype == np.arange(50).dtype
+
+
+#open() maps uncompressed contiguous datasets, compressed (chunked) ones are returned as h5py datasets
+def test_open_memmap_only_when_contiguous(tmpdir):
+    data = np.random.RandomState(2).rand(30, 3)
+    contiguous = ResultsStore(str(tmpdir.join('plain.h5')), compression=None)
+    contiguous.write(0, data=data)
+    array, f = contiguous.open(0, 'data')
+    assert f is None and isinstance(array, np.memmap)
+    np.testing.assert_allclose(array, data, rtol=1e-6)
+    compressed = ResultsStore(str(tmpdir.join('gzip.h5')))
+    compressed.write(0, data=data)
+    dataset, f = compressed.open(0, 'data')
+    try:
+        assert not isinstance(dataset, np.ndarray) and dataset.chunks is not None
+        np.testing.assert_allclose(dataset[5:10], data[5:10], rtol=1e-6)
+    finally:
+        f.close()
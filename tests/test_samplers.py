@@ -0,0 +1,77 @@
+from __future__ import division
+import numpy as np
+from scipy.stats import multivariate_normal
+import util
+
+
+#the vectorized log-likelihood equals the Gaussian log-density of every point under every component
+def test_mixture_log_likelihood_matches_scipy():
+    sampler = util.Mixture_sampler_v2(nb_classes=3, N=50, dim=4, sd=0.7)
+    points = np.vstack([sampler.X_c[:20], np.random.RandomState(0).normal(scale=5, size=(5, 4))])
+    expected = np.column_stack([multivariate_normal(mean, cov).logpdf(points) for mean, cov in zip(sampler.mean, sampler.cov)])
+    np.testing.assert_allclose(sampler.log_likelihood(points), expected, rtol=1e-10, atol=1e-8)
+    np.testing.assert_array_equal(sampler.predict_multipoints(points), expected.argmax(axis=1))
+    assert sampler.predict_onepoint(points[0]) == expected[0].argmax()
+
+
+#the baseline of correlation() is full KMeans unless MiniBatchKMeans is asked for
+def test_correlation_defaults_to_kmeans():
+    from sklearn.cluster import KMeans, MiniBatchKMeans
+    import clustering
+    data = util.Mixture_sampler_v2(nb_classes=3, N=300, dim=5, sd=2.)
+    sampler = util.scATAC_Sampler.__new__(util.scATAC_Sampler)
+    expected = clustering.clustering_scores(data.Y, KMeans(n_clusters=3, random_state=0).fit_predict(data.X_c))
+    assert sampler.correlation(data.X_c, data.Y) == expected
+    minibatch = MiniBatchKMeans(n_clusters=3, batch_size=1024, random_state=0).fit_predict(data.X_c)
+    assert sampler.correlation(data.X_c, data.Y, minibatch=True) == clustering.clustering_scores(data.Y, minibatch)
+
+
+#ARC samplers on given reduced matrices, without reading the datasets
+def arc_sampler(cls, mode, n=60, seed=0):
+    rng = np.random.RandomState(seed)
+    sampler = cls.__new__(cls)
+    sampler.mode = mode
+    sampler.pca_rna_mat, sampler.pca_atac_mat = rng.normal(size=(n, 4)), rng.normal(size=(n, 6))
+    sampler.num_cells = n
+    sampler.ts_labels = np.eye(3)[rng.randint(0, 3, n)]
+    return sampler
+
+#the concatenation get_batch returned before the joint matrix
+def concatenated(sampler):
+    return {1: sampler.pca_rna_mat, 2: sampler.pca_atac_mat, 3: np.hstack((sampler.pca_rna_mat, sampler.pca_atac_mat))}[sampler.mode]
+
+#mode 3 turns the per modality matrices into views of the joint float32 matrix
+def test_joint_feats_views():
+    sampler = arc_sampler(util.ARC_Sampler, 3)
+    rna, atac = sampler.pca_rna_mat.copy(), sampler.pca_atac_mat.copy()
+    feats = sampler.feats
+    assert feats.dtype == np.float32 and feats.flags['C_CONTIGUOUS'] and feats.shape == (60, 10)
+    assert sampler.pca_rna_mat.base is feats and sampler.pca_atac_mat.base is feats
+    np.testing.assert_allclose(sampler.pca_rna_mat, rna, rtol=1e-6)
+    np.testing.assert_allclose(sampler.pca_atac_mat, atac, rtol=1e-6)
+    feats[0, 0], feats[0, 4] = 100., 200.
+    assert sampler.pca_rna_mat[0, 0] == 100. and sampler.pca_atac_mat[0, 0] == 200.
+    assert sampler.feats is feats and sampler.load_all() is feats
+
+#same rows as the former concatenation for the same random state, in float32
+def test_get_batch_matches_concatenation():
+    for mode in [1, 2, 3]:
+        sampler = arc_sampler(util.ARC_Sampler, mode)
+        expected_all = concatenated(sampler)
+        np.random.seed(mode)
+        batch = sampler.get_batch(16)
+        np.random.seed(mode)
+        expected = expected_all[np.random.randint(low=0, high=60, size=16), :]
+        assert batch.dtype == np.float32
+        np.testing.assert_allclose(batch, expected, rtol=1e-6)
+        out = np.empty_like(batch)
+        assert sampler.get_batch(16, out=out) is out
+
+        sampler = arc_sampler(util.ARC_TS_Sampler, mode)
+        expected_all = concatenated(sampler)
+        np.random.seed(mode)
+        batch, labels = sampler.get_batch(16)
+        np.random.seed(mode)
+        idx = np.random.choice(60, size=16, replace=True)
+        np.testing.assert_allclose(batch, expected_all[idx, :], rtol=1e-6)
+        np.testing.assert_array_equal(labels, sampler.ts_labels[idx])
@@ -0,0 +1,55 @@
+from __future__ import division
+import os
+import numpy as np
+import scipy.sparse as sp
+import tenx
+
+N_GENES, N_PEAKS, N_CELLS = 35, 25, 40
+
+
+#10x matrix directory with the entries of the (feats, cells) matrix written in a random order
+def write_mtx(matrix_dir, seed=0):
+    os.makedirs(matrix_dir)
+    rng = np.random.RandomState(seed)
+    mat = sp.random(N_GENES + N_PEAKS, N_CELLS, density=0.3, random_state=seed, format='coo')
+    mat.data = np.ceil(mat.data * 5).astype(np.float32)
+    with open(os.path.join(matrix_dir, 'matrix.mtx'), 'w') as f:
+        f.write('%%MatrixMarket matrix coordinate real general\n%\n')
+        f.write('%d %d %d\n' % (mat.shape[0], mat.shape[1], mat.nnz))
+        for i in rng.permutation(mat.nnz):
+            f.write('%d %d %g\n' % (mat.row[i] + 1, mat.col[i] + 1, mat.data[i]))
+    with open(os.path.join(matrix_dir, 'features.tsv'), 'w') as f:
+        for i in range(mat.shape[0]):
+            feature_type = 'Gene Expression' if i < N_GENES else 'Peaks'
+            f.write('ID%d\tname%d\t%s\n' % (i, i, feature_type))
+    with open(os.path.join(matrix_dir, 'barcodes.tsv'), 'w') as f:
+        f.write(''.join('cell%d\n' % i for i in range(N_CELLS)))
+    return mat.tocsr().T.tocsr()
+
+def test_unsorted_mtx_round_trip(tmpdir):
+    matrix_dir = str(tmpdir.join('filtered_feature_bc_matrix'))
+    expected = write_mtx(matrix_dir)
+    #small chunks split the entries of a cell across chunks
+    tenx.convert_mtx(matrix_dir, str(tmpdir.join('store')), chunk_size=17)
+    mats, features, barcodes = tenx.open_store(str(tmpdir.join('store')))
+    assert mats['rna'].shape == (N_CELLS, N_GENES) and mats['atac'].shape == (N_CELLS, N_PEAKS)
+    assert abs(mats['rna'] - expected[:, :N_GENES]).max() == 0
+    assert abs(mats['atac'] - expected[:, N_GENES:]).max() == 0
+    for mat in mats.values():
+        copy = sp.csr_matrix((np.array(mat.data), np.array(mat.indices), np.array(mat.indptr)), shape=mat.shape)
+        assert copy.has_sorted_indices
+    #operations needing sorted indices work on the read-only memory maps
+    assert (mats['rna'] > 0).nnz == expected[:, :N_GENES].nnz
+    assert list(features['rna'][:2]) == ['name0', 'name1']
+    assert list(barcodes[:2]) == ['cell0', 'cell1']
+    _, _, _, ids = tenx.open_store(str(tmpdir.join('store')), return_ids=True)
+    assert list(ids['atac'][:2]) == ['ID%d' % N_GENES, 'ID%d' % (N_GENES + 1)]
+
+def test_load_10x_converts_once(tmpdir):
+    write_mtx(str(tmpdir.join('filtered_feature_bc_matrix')))
+    tenx.load_10x(str(tmpdir))
+    meta = tmpdir.join('csr_store', 'meta.json')
+    mtime = meta.mtime()
+    mats, _, _ = tenx.load_10x(str(tmpdir))
+    assert meta.mtime() == mtime
+    assert not mats['rna'].data.flags.writeable
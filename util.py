@@ -1,33 +1,31 @@
 from __future__ import division
 import scipy.sparse as sp 
-import scipy.io
 import numpy as np
-import copy
-from scipy import pi
 import sys
-import pandas as pd
 import os
 from os.path import join
-import gzip
-from scipy.io import mmwrite,mmread
-from sklearn.decomposition import PCA,TruncatedSVD
-from sklearn.metrics.pairwise import cosine_similarity
-from sklearn.metrics import pairwise_distances
-from sklearn.cluster import KMeans
-from sklearn.metrics.cluster import normalized_mutual_info_score, adjusted_rand_score
-from sklearn.metrics.cluster import homogeneity_score, adjusted_mutual_info_score
-from sklearn.preprocessing import MinMaxScaler,MaxAbsScaler
-import metric
-import matplotlib
-#matplotlib.use('agg')
-import matplotlib.pyplot as plt
-import seaborn as sns
-sns.set_style("whitegrid", {'axes.grid' : False})
-matplotlib.rc('xtick', labelsize=20) 
-matplotlib.rc('ytick', labelsize=20) 
-matplotlib.rcParams.update({'font.size': 22})
+from preprocess import normalize_total, log_transform, RandomizedPCA, tfidf, read_sc_mat, reduce_incremental, minmax_scale_sparse
+from cache import FeatureCache, reducer_arrays, load_reducer
+from tenx import load_10x, input_files as tenx_input_files
+from gap import gap_statistic
+
+#dependency-light core: samplers, pools and preprocessing need numpy/scipy.sparse only, sklearn, pandas,
+#plotting and the clustering metrics are imported by the functions using them (see benchmark.py --import_budget)
+
+#matplotlib.pyplot with the plotting style of the figures, set up on first use
+def pyplot():
+    import matplotlib
+    #matplotlib.use('agg')
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    sns.set_style("whitegrid", {'axes.grid' : False})
+    matplotlib.rc('xtick', labelsize=20) 
+    matplotlib.rc('ytick', labelsize=20) 
+    matplotlib.rcParams.update({'font.size': 22})
+    return plt
 
 def compute_inertia(a, X, norm=True):
+    from sklearn.metrics import pairwise_distances
     if norm:
         W = [np.sum(pairwise_distances(X[a == c, :]))/(2.*sum(a == c)) for c in np.unique(a)]
         return np.sum(W)
@@ -36,41 +34,41 @@ def compute_inertia(a, X, norm=True):
         return np.mean(W)
 
 
-#gap statistic 
-def compute_gap(clustering, data, k_max=10, n_references=100):
-    if len(data.shape) == 1:
-        data = data.reshape(-1, 1)
-    reference_inertia = []
-    for k in range(2, k_max+1):
-        reference = np.random.rand(*data.shape)
-        mins = np.min(data,axis=0)
-        maxs = np.max(data,axis=0)
-        reference = reference*(maxs-mins)+mins
-        local_inertia = []
-        for _ in range(n_references):
-            clustering.n_clusters = k
-            assignments = clustering.fit_predict(reference)
-            local_inertia.append(compute_inertia(assignments, reference))
-        reference_inertia.append(np.mean(local_inertia))
-    
-    ondata_inertia = []
-    for k in range(2, k_max+1):
-        clustering.n_clusters = k
-        assignments = clustering.fit_predict(data)
-        ondata_inertia.append(compute_inertia(assignments, data))
-        
-    gap = np.log(reference_inertia)-np.log(ondata_inertia)
-    return gap, np.log(reference_inertia), np.log(ondata_inertia)
+#gap statistic, see gap.gap_statistic (squared euclidean dispersion, parallel references, 1-SE rule)
+def compute_gap(clustering, data, k_max=10, n_references=100, n_jobs=1):
+    result = gap_statistic(data, k_max=k_max, n_references=n_references, clustering=clustering, n_jobs=n_jobs, early_stop=False)
+    return result['gap'], result['log_ref'], result['log_wk']
 
 
 
 #scATAC data
 class scATAC_Sampler(object):
-    def __init__(self,name,dim=20,low=0.03,has_label=True):
+    def __init__(self,name,dim=20,low=0.03,has_label=True,cache_dir='datasets/cache',sparse=False):
         self.name = name
         self.dim = dim
         self.has_label = has_label
-        X = pd.read_csv('datasets/%s/sc_mat.txt'%name,sep='\t',header=0,index_col=[0]).values
+        self.sparse = sparse
+        #reuse the reduced features of a previous run on the same inputs and parameters
+        self.cache = FeatureCache(cache_dir) if cache_dir is not None else None
+        cached = None
+        if self.cache is not None:
+            files = ['datasets/%s/sc_mat.txt'%name] + (['datasets/%s/label.txt'%name] if has_label else [])
+            cache_key = self.cache.key(files, {'sampler':'scATAC_Sampler', 'dim':dim, 'low':low, 'has_label':has_label, 'sparse':sparse, 'scaling':'minmax'})
+            cached = self.cache.load(cache_key)
+        if cached is not None:
+            self.X = cached['X']
+            self.reducer = load_reducer(cached, 'pca')
+            if has_label:
+                self.Y = cached['Y']
+            self.total_size = self.X.shape[0]
+            print('Loaded cached features', self.cache.path(cache_key), self.X.shape)
+            return
+
+        if sparse:
+            X, _, _ = read_sc_mat('datasets/%s/sc_mat.txt'%name) #(peaks, cells) CSR
+        else:
+            import pandas as pd
+            X = pd.read_csv('datasets/%s/sc_mat.txt'%name,sep='\t',header=0,index_col=[0]).values
         if has_label:
             labels = [item.strip() for item in open('datasets/%s/label.txt'%name).readlines()]
             uniq_labels = list(np.unique(labels))
@@ -79,36 +77,46 @@ class scATAC_Sampler(object):
             self.Y = Y
         X = self.filter_peaks(X,low)
         #TF-IDF transformation
-        nfreqs = 1.0 * X / np.tile(np.sum(X,axis=0), (X.shape[0],1))
-        X  = nfreqs * np.tile(np.log(1 + 1.0 * X.shape[1] / np.sum(X,axis=1)).reshape(-1,1), (1,X.shape[1]))
+        X = tfidf(X)
         X = X.T #(cells, peaks)
-        X = MinMaxScaler().fit_transform(X)
-        #PCA transformation
-        pca = PCA(n_components=dim, random_state=3456).fit(X)
+        if sparse:
+            #min-max scaling up to a per-peak shift (peaks open in every cell have min > 0), which the
+            #centering of the PCA removes: the projections equal those of the dense path
+            X, _ = minmax_scale_sparse(X)
+            pca = RandomizedPCA(n_components=dim, random_state=3456).fit(X)
+        else:
+            from sklearn.preprocessing import MinMaxScaler
+            from sklearn.decomposition import PCA
+            X = MinMaxScaler().fit_transform(X)
+            #PCA transformation
+            pca = PCA(n_components=dim, random_state=3456).fit(X)
         X = pca.transform(X)
         self.X = X
+        self.reducer = pca
         self.total_size = self.X.shape[0]
+        if self.cache is not None:
+            arrays = dict(X=self.X, Y=self.Y) if has_label else dict(X=self.X)
+            arrays.update(reducer_arrays('pca', pca))
+            self.cache.save(cache_key, **arrays)
 
 
     def filter_peaks(self,X,ratio):
-        ind = np.sum(X>0,axis=1) > X.shape[1]*ratio
+        ind = np.asarray((X>0).sum(axis=1)).ravel() > X.shape[1]*ratio
         return X[ind,:]
 
     def filter_cells(self,X,Y,min_peaks):
         ind = np.sum(X>0,axis=0) > min_peaks
         return X[:,ind], Y[ind]
 
-    def correlation(self,X,Y,heatmap=False):
+    #KMeans baseline on the embedding X, MiniBatchKMeans for large X with minibatch=True, all scores from one contingency table
+    def correlation(self,X,Y,heatmap=False,minibatch=False):
         nb_classes = len(set(Y))
         print(nb_classes)
-        km = KMeans(n_clusters=nb_classes,random_state=0).fit(X)
-        label_kmeans = km.labels_
-        purity = metric.compute_purity(label_kmeans, Y)
-        nmi = normalized_mutual_info_score(Y, label_kmeans)
-        ari = adjusted_rand_score(Y, label_kmeans)
-        homogeneity = homogeneity_score(Y, label_kmeans)
-        ami = adjusted_mutual_info_score(Y, label_kmeans)
-        print('NMI = {}, ARI = {}, Purity = {},AMI = {}, Homogeneity = {}'.format(nmi,ari,purity,ami,homogeneity))
+        import clustering
+        label_kmeans = clustering.kmeans_labels(X, nb_classes, minibatch=minibatch)
+        scores = clustering.clustering_scores(Y, label_kmeans)
+        clustering.print_scores(scores)
+        return scores
  
     def train(self, batch_size):
         indx = np.random.randint(low = 0, high = self.total_size, size = batch_size)
@@ -125,10 +133,44 @@ class scATAC_Sampler(object):
             return self.X 
 
 
+#feature masks, names and 10x ids of the kept features of an ARC sampler as cache arrays, the unset ones are left out
+FEATURE_ARRAYS = ['gene_select', 'locus_select', 'genes', 'peaks', 'gene_ids', 'peak_ids']
+
+def feature_arrays(sampler):
+    return dict((name, getattr(sampler, name)) for name in FEATURE_ARRAYS if getattr(sampler, name, None) is not None)
+
+def load_feature_arrays(sampler, arrays):
+    for name in FEATURE_ARRAYS:
+        if name in arrays or name.endswith('_select'):
+            setattr(sampler, name, arrays.get(name))
+
+#joint (cells, feats) float32 matrix of an ARC sampler for its mode
+#mode: 1 only scRNA-seq, 2 only scATAC-seq, 3 both (the per modality matrices become views into it)
+def joint_feats(sampler):
+    if sampler.mode == 1:
+        mats = [sampler.pca_rna_mat]
+    elif sampler.mode == 2:
+        mats = [sampler.pca_atac_mat]
+    elif sampler.mode == 3:
+        mats = [sampler.pca_rna_mat, sampler.pca_atac_mat]
+    else:
+        print('Wrong mode!')
+        sys.exit()
+    feats = np.empty((mats[0].shape[0], sum(item.shape[1] for item in mats)), dtype=np.float32)
+    offset = 0
+    for item in mats:
+        feats[:, offset:offset+item.shape[1]] = item
+        offset += item.shape[1]
+    if sampler.mode == 3:
+        dim = sampler.pca_rna_mat.shape[1]
+        sampler.pca_rna_mat, sampler.pca_atac_mat = feats[:, :dim], feats[:, dim:]
+    return feats
+
 #load data from 10x Genomic paired ARC technology
 class ARC_Sampler(object):
     def __init__(self,name='D2-1',n_components=50,scale=10000,filter_feat=True,filter_cell=False,random_seed=1234,mode=1, \
-        min_rna_c=0,max_rna_c=None,min_atac_c=0,max_atac_c=None):
+        min_rna_c=0,max_rna_c=None,min_atac_c=0,max_atac_c=None,sparse=False,cache_dir='datasets/cache',incremental=False, \
+        chunk_size=10000,n_jobs=1):
         #c:cell, g:gene, l:locus
         self.name = name
         self.mode = mode
@@ -136,38 +178,102 @@ class ARC_Sampler(object):
         self.max_rna_c = max_rna_c
         self.min_atac_c = min_atac_c
         self.max_atac_c = max_atac_c
+        self.sparse = sparse
+        self.scale = scale
+        #feature masks of the filters, None when all features are kept
+        self.gene_select = self.locus_select = None
+        #unique 10x ids of the kept features, None when the input has none
+        self.gene_ids = self.peak_ids = None
+
+        #reuse the reduced features of a previous run on the same inputs and parameters
+        self.cache = FeatureCache(cache_dir) if cache_dir is not None else None
+        if sparse:
+            files = tenx_input_files('datasets/%s'%name)
+        else:
+            files = ['datasets/rna_combine.npy','datasets/atac_combine.npy']
+        params = {'sampler':'ARC_Sampler', 'n_components':n_components, 'scale':scale, 'filter_feat':filter_feat, 'random_seed':random_seed,
+            'min_rna_c':min_rna_c, 'max_rna_c':max_rna_c, 'min_atac_c':min_atac_c, 'max_atac_c':max_atac_c, 'sparse':sparse,
+            'incremental':incremental, 'chunk_size':chunk_size if incremental else None}
+        cached = None
+        if self.cache is not None:
+            cache_key = self.cache.key(files, params)
+            cached = self.cache.load(cache_key)
+
+        if cached is not None:
+            self.pca_rna_mat, self.pca_atac_mat = cached['pca_rna_mat'], cached['pca_atac_mat']
+            self.rna_reducer = load_reducer(cached, 'rna')
+            self.atac_reducer = load_reducer(cached, 'atac')
+            load_feature_arrays(self, cached)
+            print('Loaded cached features', self.cache.path(cache_key), self.pca_rna_mat.shape, self.pca_atac_mat.shape)
+            return
+
+        if incremental:
+            #out-of-core: blocks of cells are streamed from disk for the feature filter, the fit and the transform
+            if sparse:
+                mats, features, self.cells, ids = load_10x('datasets/%s'%name, return_ids=True)
+                rna_mat, atac_mat = mats['rna'], mats['atac']
+            else:
+                rna_mat = np.load('datasets/rna_combine.npy', mmap_mode='r')
+                atac_mat = np.load('datasets/atac_combine.npy', mmap_mode='r')
+            filter_feat = filter_feat or not sparse
+            self.rna_reducer, self.pca_rna_mat, self.gene_select = reduce_incremental(rna_mat, n_components, scale,
+                self.min_rna_c, self.max_rna_c, filter_feat, chunk_size, n_jobs)
+            self.atac_reducer, self.pca_atac_mat, self.locus_select = reduce_incremental(atac_mat, n_components, scale,
+                self.min_atac_c, self.max_atac_c, filter_feat, chunk_size, n_jobs)
+            if sparse:
+                self.genes, self.gene_ids = [item if item is None or self.gene_select is None else item[self.gene_select]
+                    for item in [features['rna'], ids['rna']]]
+                self.peaks, self.peak_ids = [item if item is None or self.locus_select is None else item[self.locus_select]
+                    for item in [features['atac'], ids['atac']]]
+        elif sparse:
+            #CSR end to end: memory scales with the non-zeros instead of cells x feats
+            self.rna_mat, self.atac_mat, self.genes, self.peaks = self.load_data(filter_feat,filter_cell)
+            self.rna_mat = log_transform(normalize_total(self.rna_mat, scale), base=10)
+            self.atac_mat = log_transform(normalize_total(self.atac_mat, scale), base=10)
+
+            self.rna_reducer = RandomizedPCA(n_components=n_components, random_state=random_seed)
+            self.pca_rna_mat = self.rna_reducer.fit_transform(self.rna_mat)
+            self.atac_reducer = RandomizedPCA(n_components=n_components, random_state=random_seed)
+            self.pca_atac_mat = self.atac_reducer.fit_transform(self.atac_mat)
+        else:
+            #self.rna_mat, self.atac_mat, self.genes, self.peaks = self.load_data(filter_feat,filter_cell)
 
+            #self.rna_mat, self.genes = np.load('datasets/merge_rna.npz')['arr_0'],np.load('datasets/merge_rna.npz')['arr_1']
+            #self.atac_mat, self.tp_labels = np.load('datasets/merge_atac.npz')['arr_0'],np.load('datasets/merge_atac.npz')['arr_1']
+            #self.rna_mat, self.atac_mat  = self.filter_feats_v2(self.rna_mat, self.atac_mat)
 
-        #self.rna_mat, self.atac_mat, self.genes, self.peaks = self.load_data(filter_feat,filter_cell)
+            #self.rna_mat = np.load('datasets/rna_all.npy')
+            #self.atac_mat = np.load('datasets/atac_all.npy')
 
-        #self.rna_mat, self.genes = np.load('datasets/merge_rna.npz')['arr_0'],np.load('datasets/merge_rna.npz')['arr_1']
-        #self.atac_mat, self.tp_labels = np.load('datasets/merge_atac.npz')['arr_0'],np.load('datasets/merge_atac.npz')['arr_1']
-        #self.rna_mat, self.atac_mat  = self.filter_feats_v2(self.rna_mat, self.atac_mat)
-        
-        #self.rna_mat = np.load('datasets/rna_all.npy')
-        #self.atac_mat = np.load('datasets/atac_all.npy')
+            self.rna_mat = np.load('datasets/rna_combine.npy')
+            self.atac_mat = np.load('datasets/atac_combine.npy')
 
-        self.rna_mat = np.load('datasets/rna_combine.npy')
-        self.atac_mat = np.load('datasets/atac_combine.npy')
+            print(self.rna_mat.shape,self.atac_mat.shape)
+            self.rna_mat, self.atac_mat  = self.filter_feats_v2(self.rna_mat, self.atac_mat)
+            print(self.rna_mat.shape,self.atac_mat.shape)
 
-        print(self.rna_mat.shape,self.atac_mat.shape)
-        self.rna_mat, self.atac_mat  = self.filter_feats_v2(self.rna_mat, self.atac_mat)
-        print(self.rna_mat.shape,self.atac_mat.shape)
 
+            self.rna_mat = (self.rna_mat.T*scale/np.sum(self.rna_mat,axis=1)).T
+            self.rna_mat = np.log10(self.rna_mat+1)
+            self.atac_mat = (self.atac_mat.T*scale/np.sum(self.atac_mat,axis=1)).T
+            self.atac_mat = np.log10(self.atac_mat+1)
 
-        self.rna_mat = (self.rna_mat.T*scale/np.sum(self.rna_mat,axis=1)).T
-        self.rna_mat = np.log10(self.rna_mat+1)
-        self.atac_mat = (self.atac_mat.T*scale/np.sum(self.atac_mat,axis=1)).T
-        self.atac_mat = np.log10(self.atac_mat+1)
+            from sklearn.decomposition import PCA
+            self.rna_reducer = PCA(n_components=n_components, random_state=random_seed)
+            self.rna_reducer.fit(self.rna_mat)
+            self.pca_rna_mat = self.rna_reducer.transform(self.rna_mat)
 
-        self.rna_reducer = PCA(n_components=n_components, random_state=random_seed)
-        self.rna_reducer.fit(self.rna_mat)
-        self.pca_rna_mat = self.rna_reducer.transform(self.rna_mat)
-    
-        self.atac_reducer = PCA(n_components=n_components, random_state=random_seed)
-        self.atac_reducer.fit(self.atac_mat)
-        self.pca_atac_mat = self.atac_reducer.transform(self.atac_mat)
+            self.atac_reducer = PCA(n_components=n_components, random_state=random_seed)
+            self.atac_reducer.fit(self.atac_mat)
+            self.pca_atac_mat = self.atac_reducer.transform(self.atac_mat)
         print(self.pca_rna_mat.shape,self.pca_atac_mat.shape)
+
+        if self.cache is not None:
+            arrays = dict(pca_rna_mat=self.pca_rna_mat, pca_atac_mat=self.pca_atac_mat)
+            arrays.update(reducer_arrays('rna', self.rna_reducer))
+            arrays.update(reducer_arrays('atac', self.atac_reducer))
+            arrays.update(feature_arrays(self))
+            self.cache.save(cache_key, **arrays)
         #np.savez('datasets/pca_feats.npz',self.pca_rna_mat,self.pca_atac_mat)
         # gap_rna, _, _ = compute_gap(KMeans(), self.pca_rna_mat, 20)
         # gap_atac, _, _ = compute_gap(KMeans(), self.pca_atac_mat, 20)
@@ -177,20 +283,18 @@ class ARC_Sampler(object):
 
 
     def load_data(self,filter_feat,filter_cell):
-        mtx_file = 'datasets/%s/filtered_feature_bc_matrix/matrix.mtx'%self.name
-        feat_file = 'datasets/%s/filtered_feature_bc_matrix/features.tsv'%self.name
-        barcode_file = 'datasets/%s/filtered_feature_bc_matrix/barcodes.tsv'%self.name
-        combined_mat = mmread(mtx_file).T.tocsr() #(cells, genes+peaks)
-        cells = [item.strip() for item in open(barcode_file).readlines()] 
-        genes = [item.split('\t')[1] for item in open(feat_file).readlines() if item.split('\t')[2]=="Gene Expression"]
-        peaks = [item.split('\t')[1] for item in open(feat_file).readlines() if item.split('\t')[2]=="Peaks"]
-        assert len(genes)+len(peaks) == combined_mat.shape[1]
-        rna_mat = combined_mat[:,:len(genes)]
-        atac_mat = combined_mat[:,len(genes):]
+        #converted once into a memory-mapped CSR store, later runs open it without parsing the matrix
+        mats, features, self.cells, ids = load_10x('datasets/%s'%self.name, return_ids=True)
+        rna_mat, atac_mat = mats['rna'], mats['atac'] #(cells, genes), (cells, peaks)
+        genes, peaks = features['rna'], features['atac']
+        #unique 10x ids of the kept features, used to match the features of new data (see reference.py)
+        self.gene_ids, self.peak_ids = ids['rna'], ids['atac']
         print('scRNA-seq: ', rna_mat.shape, 'scATAC-seq: ', atac_mat.shape)
 
         if filter_feat:
             rna_mat, atac_mat, genes, peaks = self.filter_feats(rna_mat, atac_mat, genes, peaks)
+            if self.gene_ids is not None:
+                self.gene_ids, self.peak_ids = self.gene_ids[self.gene_select], self.peak_ids[self.locus_select]
             print('scRNA-seq filtered: ', rna_mat.shape, 'scATAC-seq filtered: ', atac_mat.shape)
         return rna_mat, atac_mat, genes, peaks
     #sparse data (cells, feats)
@@ -207,6 +311,7 @@ class ARC_Sampler(object):
             locus_select *= np.array((atac_mat_sp>0).sum(axis=0)).squeeze() < self.max_atac_c
         atac_mat_sp = atac_mat_sp[:,locus_select]
         peaks = np.array(peaks)[locus_select]
+        self.gene_select, self.locus_select = gene_select, locus_select
         return rna_mat_sp, atac_mat_sp, genes, peaks
 
     #dense data (cells, feats)
@@ -222,38 +327,37 @@ class ARC_Sampler(object):
         if self.max_atac_c is not None:
             locus_select *= np.array((atac_mat>0).sum(axis=0)) < self.max_atac_c
         atac_mat = atac_mat[:,locus_select]
+        self.gene_select, self.locus_select = gene_select, locus_select
 
         return rna_mat, atac_mat
 
-    def get_batch(self,batch_size):
-        idx = np.random.randint(low = 0, high = self.atac_mat.shape[0], size = batch_size)
-        if self.mode == 1:
-            return self.pca_rna_mat[idx,:]
-        elif self.mode == 2:
-            return self.pca_atac_mat[idx,:]
-        elif self.mode == 3:
-            return np.hstack((self.pca_rna_mat, self.pca_atac_mat))[idx,:]
-        else:
-            print('Wrong mode!')
-            sys.exit()
+    #contiguous float32 (cells, feats) matrix of the selected mode, built once on first use
+    @property
+    def feats(self):
+        if getattr(self, '_feats', None) is None:
+            self._feats = joint_feats(self)
+        return self._feats
+
+    def get_batch(self,batch_size,out=None):
+        idx = np.random.randint(low = 0, high = self.feats.shape[0], size = batch_size)
+        #rows are gathered straight from the joint matrix, optionally into a caller owned buffer
+        return np.take(self.feats, idx, axis=0, out=out)
     
     def load_all(self):
         #mode: 1 only scRNA-seq, 2 only scATAC-seq, 3 both
-        if self.mode == 1:
-            return self.pca_rna_mat
-        elif self.mode == 2:
-            return self.pca_atac_mat
-        elif self.mode == 3:
-            return np.hstack((self.pca_rna_mat, self.pca_atac_mat))
-        else:
-            print('Wrong mode!')
-            sys.exit()
+        return self.feats
+
 
+#time points of the ARC time-series data, one datasets/{rna,atac}_combine_{tp}.npy per time point
+TS_TIME_POINTS = ['d2','d4','d6']
+#number of cells per time point in the legacy datasets/pca_feats_v2.npz
+LEGACY_TS_SIZES = [5400,3408,6897]
 
 #load data from 10x Genomic paired ARC technology time-series data
 class ARC_TS_Sampler(object):
     def __init__(self,name='D2-1',n_components=50,scale=10000,filter_feat=True,filter_cell=False,random_seed=1234,mode=1, \
-        min_rna_c=0,max_rna_c=None,min_atac_c=0,max_atac_c=None):
+        min_rna_c=0,max_rna_c=None,min_atac_c=0,max_atac_c=None,cache_dir='datasets/cache',incremental=False, \
+        chunk_size=10000,n_jobs=1):
         #c:cell, g:gene, l:locus
         self.name = name
         self.mode = mode
@@ -261,36 +365,83 @@ class ARC_TS_Sampler(object):
         self.max_rna_c = max_rna_c
         self.min_atac_c = min_atac_c
         self.max_atac_c = max_atac_c
-        if os.path.exists('datasets/pca_feats_v2.npz'):
+        self.scale = scale
+        #feature masks of the filters, None when all features are kept
+        self.gene_select = self.locus_select = None
+        #unique 10x ids of the kept features, None when the input has none
+        self.gene_ids = self.peak_ids = None
+        files = ['datasets/%s_combine_%s.npy'%(omic,tp) for omic in ['rna','atac'] for tp in TS_TIME_POINTS]
+        if not all(os.path.exists(item) for item in files) and os.path.exists('datasets/pca_feats_v2.npz'):
+            #legacy hand-made features, the time point sizes are not recorded in the file
+            print('Per time point matrices not found, falling back to datasets/pca_feats_v2.npz')
             data = np.load('datasets/pca_feats_v2.npz')
             self.pca_rna_mat,self.pca_atac_mat = data['arr_0'],data['arr_1']
-            ts_labels = np.array([0]*5400+[1]*3408+[2]*6897)
-            self.ts_labels = np.eye(3)[ts_labels]
+            ts_labels = np.repeat(np.arange(len(LEGACY_TS_SIZES)), LEGACY_TS_SIZES)
+            self.ts_labels = np.eye(len(LEGACY_TS_SIZES))[ts_labels]
+            self.num_cells = self.pca_rna_mat.shape[0]
+            return
+
+        #reuse the reduced features of a previous run on the same inputs and parameters
+        self.cache = FeatureCache(cache_dir) if cache_dir is not None else None
+        params = {'sampler':'ARC_TS_Sampler', 'n_components':n_components, 'scale':scale, 'random_seed':random_seed,
+            'min_rna_c':min_rna_c, 'max_rna_c':max_rna_c, 'min_atac_c':min_atac_c, 'max_atac_c':max_atac_c,
+            'incremental':incremental, 'chunk_size':chunk_size if incremental else None}
+        cached = None
+        if self.cache is not None:
+            cache_key = self.cache.key(files, params)
+            cached = self.cache.load(cache_key)
+
+        if cached is not None:
+            self.pca_rna_mat, self.pca_atac_mat = cached['pca_rna_mat'], cached['pca_atac_mat']
+            self.ts_labels = cached['ts_labels']
+            self.rna_reducer = load_reducer(cached, 'rna')
+            self.atac_reducer = load_reducer(cached, 'atac')
+            load_feature_arrays(self, cached)
+            self.num_cells = self.pca_rna_mat.shape[0]
+            print('Loaded cached features', self.cache.path(cache_key), self.pca_rna_mat.shape, self.pca_atac_mat.shape)
+            return
+
+        if incremental:
+            #out-of-core: the per time point matrices are memory-mapped and streamed by blocks of cells
+            rna_mats = [np.load('datasets/rna_combine_%s.npy'%tp, mmap_mode='r') for tp in TS_TIME_POINTS]
+            atac_mats = [np.load('datasets/atac_combine_%s.npy'%tp, mmap_mode='r') for tp in TS_TIME_POINTS]
+            ts_labels = np.repeat(np.arange(len(atac_mats)), [item.shape[0] for item in atac_mats])
+            self.ts_labels = np.eye(len(atac_mats))[ts_labels]
+            self.rna_reducer, self.pca_rna_mat, self.gene_select = reduce_incremental(rna_mats, n_components, scale,
+                self.min_rna_c, self.max_rna_c, True, chunk_size, n_jobs)
+            self.atac_reducer, self.pca_atac_mat, self.locus_select = reduce_incremental(atac_mats, n_components, scale,
+                self.min_atac_c, self.max_atac_c, True, chunk_size, n_jobs)
+            assert self.pca_rna_mat.shape[0] == self.pca_atac_mat.shape[0]
             self.num_cells = self.pca_rna_mat.shape[0]
+        else:
+            self.atac_mat, self.ts_labels = self.get_atac()
+            self.rna_mat, _ = self.get_rna()
+            print(self.rna_mat.shape,self.atac_mat.shape)
+            self.rna_mat, self.atac_mat  = self.filter_feats_v2(self.rna_mat, self.atac_mat)
+            print(self.rna_mat.shape,self.atac_mat.shape)
+            assert self.rna_mat.shape[0] == self.atac_mat.shape[0]
+            self.num_cells = self.rna_mat.shape[0]
+
+            self.rna_mat = (self.rna_mat.T*scale/np.sum(self.rna_mat,axis=1)).T
+            self.rna_mat = np.log10(self.rna_mat+1)
+            self.atac_mat = (self.atac_mat.T*scale/np.sum(self.atac_mat,axis=1)).T
+            self.atac_mat = np.log10(self.atac_mat+1)
+            from sklearn.decomposition import PCA
+            self.rna_reducer = PCA(n_components=n_components, random_state=random_seed)
+            self.rna_reducer.fit(self.rna_mat)
+            self.pca_rna_mat = self.rna_reducer.transform(self.rna_mat)
+
+            self.atac_reducer = PCA(n_components=n_components, random_state=random_seed)
+            self.atac_reducer.fit(self.atac_mat)
+            self.pca_atac_mat = self.atac_reducer.transform(self.atac_mat)
+        print(self.pca_rna_mat.shape,self.pca_atac_mat.shape)
 
-        # self.atac_mat, self.ts_labels = self.get_atac()
-        # self.rna_mat, _ = self.get_rna()
-        # print(self.rna_mat.shape,self.atac_mat.shape)
-        # self.rna_mat, self.atac_mat  = self.filter_feats_v2(self.rna_mat, self.atac_mat)
-        # print(self.rna_mat.shape,self.atac_mat.shape)
-        # assert self.rna_mat.shape[0] == self.atac_mat.shape[0]
-        # self.num_cells = self.rna_mat.shape[0]
-
-        # self.rna_mat = (self.rna_mat.T*scale/np.sum(self.rna_mat,axis=1)).T
-        # self.rna_mat = np.log10(self.rna_mat+1)
-        # self.atac_mat = (self.atac_mat.T*scale/np.sum(self.atac_mat,axis=1)).T
-        # self.atac_mat = np.log10(self.atac_mat+1)
-        # self.rna_reducer = PCA(n_components=n_components, random_state=random_seed)
-        # self.rna_reducer.fit(self.rna_mat)
-        # self.pca_rna_mat = self.rna_reducer.transform(self.rna_mat)
-    
-        # self.atac_reducer = PCA(n_components=n_components, random_state=random_seed)
-        # self.atac_reducer.fit(self.atac_mat)
-        # self.pca_atac_mat = self.atac_reducer.transform(self.atac_mat)
-        # print(self.pca_rna_mat.shape,self.pca_atac_mat.shape)
-        # print(self.pca_rna_mat[:5,0])
-        
-        #np.savez('datasets/pca_feats_v2.npz',self.pca_rna_mat,self.pca_atac_mat)
+        if self.cache is not None:
+            arrays = dict(pca_rna_mat=self.pca_rna_mat, pca_atac_mat=self.pca_atac_mat, ts_labels=self.ts_labels)
+            arrays.update(reducer_arrays('rna', self.rna_reducer))
+            arrays.update(reducer_arrays('atac', self.atac_reducer))
+            arrays.update(feature_arrays(self))
+            self.cache.save(cache_key, **arrays)
 
     def get_atac(self):
         atac_d2 = np.load('datasets/atac_combine_d2.npy')
@@ -322,38 +473,45 @@ class ARC_TS_Sampler(object):
         if self.max_atac_c is not None:
             locus_select *= np.array((atac_mat>0).sum(axis=0)) < self.max_atac_c
         atac_mat = atac_mat[:,locus_select]
+        self.gene_select, self.locus_select = gene_select, locus_select
 
         return rna_mat, atac_mat
 
-    def get_batch(self, batch_size, sd = 1, weights = None):
+    #contiguous float32 (cells, feats) matrix of the selected mode, built once on first use
+    @property
+    def feats(self):
+        if getattr(self, '_feats', None) is None:
+            self._feats = joint_feats(self)
+            self._ts_labels = np.ascontiguousarray(self.ts_labels, dtype=np.float32)
+        return self._feats
+
+    def get_batch(self, batch_size, sd = 1, weights = None, out=None):
         #if weights is None:
         #    weights = np.ones(self.nb_classes, dtype=np.float64) / float(self.nb_classes)
         batch_idx =  np.random.choice(self.num_cells, size=batch_size, replace=True)
-        batch_ts_labels = self.ts_labels[batch_idx]
-
-        batch_ts_labels = batch_ts_labels.astype('float64')# + np.random.normal(scale = sd, size = batch_ts_labels.shape)
-
-        if self.mode == 1:
-            return self.pca_rna_mat[batch_idx,:], batch_ts_labels
-        elif self.mode == 2:
-            return self.pca_atac_mat[batch_idx,:], batch_ts_labels
-        elif self.mode == 3:
-            return np.hstack((self.pca_rna_mat, self.pca_atac_mat))[batch_idx,:], batch_ts_labels
-        else:
-            print('Wrong mode!')
-            sys.exit()
+        feats = self.feats
+        batch_ts_labels = self._ts_labels[batch_idx]# + np.random.normal(scale = sd, size = batch_ts_labels.shape)
+        #rows are gathered straight from the joint matrix, optionally into a caller owned buffer
+        return np.take(feats, batch_idx, axis=0, out=out), batch_ts_labels
     
     def load_all(self):
         #mode: 1 only scRNA-seq, 2 only scATAC-seq, 3 both
-        if self.mode == 1:
-            return self.pca_rna_mat, self.ts_labels
-        elif self.mode == 2:
-            return self.pca_atac_mat, self.ts_labels
-        elif self.mode == 3:
-            return np.hstack((self.pca_rna_mat, self.pca_atac_mat)), self.ts_labels
-        else:
-            print('Wrong mode!')
-            sys.exit()
+        return self.feats, self.ts_labels
+
+#sampler over preprocessed (cells, feats) and one-hot label arrays, possibly memory-mapped,
+#same interface as ARC_TS_Sampler so that processes can share one copy of the data (see sweep.py)
+class ArraySampler(object):
+    def __init__(self, feats, labels):
+        self.feats = feats
+        self.labels = labels
+        self.num_cells = feats.shape[0]
+
+    def get_batch(self, batch_size, sd = 1, weights = None, out=None):
+        batch_idx =  np.random.choice(self.num_cells, size=batch_size, replace=True)
+        return np.take(self.feats, batch_idx, axis=0, out=out), self.labels[batch_idx]
+
+    def load_all(self):
+        return self.feats, self.labels
 
 #sample continuous (Gaussian) and discrete (Catagory) latent variables together
 class Mixture_sampler(object):
@@ -399,11 +557,13 @@ class Mixture_sampler_v2(object):
             else:
                 self.mean = np.zeros((nb_classes,dim))
                 self.mean[:,:2] = np.array([(np.cos(2*np.pi*idx/float(self.nb_classes)),np.sin(2*np.pi*idx/float(self.nb_classes))) for idx in range(self.nb_classes)])
+        self.sd = sd
         self.cov = [sd**2*np.eye(dim) for item in range(nb_classes)]
         if weights is None:
             weights = np.ones(self.nb_classes, dtype=np.float64) / float(self.nb_classes)
         self.Y = np.random.choice(self.nb_classes, size=N, replace=True, p=weights)
-        self.X_c = np.array([np.random.multivariate_normal(mean=self.mean[i],cov=self.cov[i]) for i in self.Y],dtype='float64')
+        #isotropic components: mean + sd * standard normal noise, drawn for all points at once
+        self.X_c = self.mean[self.Y] + sd*np.random.normal(size=(N, dim))
         self.X_d = np.eye(self.nb_classes)[self.Y]
         self.X = np.hstack((self.X_c,self.X_d))
 
@@ -419,38 +579,82 @@ class Mixture_sampler_v2(object):
             weights = np.ones(self.nb_classes, dtype=np.float64) / float(self.nb_classes)
         label_batch_idx =  np.random.choice(self.nb_classes, size=batch_size, replace=True, p=weights)
         return self.X_c[label_batch_idx, :], self.X_d[label_batch_idx, :]
+    #(N, nb_classes) Gaussian log-likelihood of each point under each component
+    def log_likelihood(self,arrays):
+        arrays = np.atleast_2d(arrays)
+        assert arrays.shape[-1] == self.dim
+        #squared distances to all means through one matrix product
+        sq_dist = np.sum(arrays**2, axis=1)[:, None] - 2*arrays.dot(self.mean.T) + np.sum(self.mean**2, axis=1)[None, :]
+        return -0.5*sq_dist/self.sd**2 - 0.5*self.dim*np.log(2*np.pi*self.sd**2)
+
     def predict_onepoint(self,array):#return component index with max likelyhood
-        from scipy.stats import multivariate_normal
         assert len(array) == self.dim
-        return np.argmax([multivariate_normal.pdf(array,self.mean[idx],self.cov[idx]) for idx in range(self.nb_classes)])
+        return np.argmax(self.log_likelihood(array)[0])
 
     def predict_multipoints(self,arrays):
-        assert arrays.shape[-1] == self.dim
-        return map(self.predict_onepoint,arrays)
+        return np.argmax(self.log_likelihood(arrays), axis=1)
     def load_all(self):
         return self.X_c, self.X_d, self.label_idx
 
 #get a batch of data from previous 50 batches, add stochastic
+#replay buffer of generated samples, rows of one or more arrays (e.g. y_ and the x_onehot they were generated from)
+#in preallocated arrays of `capacity` samples, written as a ring until full then at random (replace='random')
+#or over the oldest rows (replace='ring'), sample() gathers random rows into reusable output arrays
 class DataPool(object):
-    def __init__(self, maxsize=50):
-        self.maxsize = maxsize
-        self.nb_batch = 0
-        self.pool = []
-
-    def __call__(self, data):
-        if self.nb_batch < self.maxsize:
-            self.pool.append(data)
-            self.nb_batch += 1
-            return data
-        if np.random.rand() > 0.5:
-            results=[]
-            for i in range(len(data)):
-                idx = int(np.random.rand()*self.maxsize)
-                results.append(copy.copy(self.pool[idx])[i])
-                self.pool[idx][i] = data[i]
-            return results
+    def __init__(self, capacity=5000, replace='random', seed=0):
+        assert replace in ['random', 'ring']
+        self.capacity = capacity
+        self.replace = replace
+        self.rng = np.random.RandomState(seed)
+        self.arrays = None
+        self.size = 0
+        self.head = 0
+        self.outs = {}
+
+    def _allocate(self, data):
+        self.arrays = [np.empty((self.capacity,) + d.shape[1:], dtype=d.dtype) for d in data]
+
+    #store a batch, every array has one row per sample
+    def add(self, *data):
+        if self.arrays is None:
+            self._allocate(data)
+        n = min(len(data[0]), self.capacity)
+        if self.size < self.capacity or self.replace == 'ring':
+            idx = (self.head + np.arange(n)) % self.capacity
+            self.head = (self.head + n) % self.capacity
+            self.size = min(self.size + n, self.capacity)
         else:
+            idx = self.rng.randint(0, self.capacity, size=n)
+        for array, d in zip(self.arrays, data):
+            array[idx] = d[-n:]
+
+    #n random stored samples, written into the pool's output arrays for this n (reused across calls)
+    #or into `out`
+    def sample(self, n, out=None):
+        assert self.size > 0
+        if out is None:
+            if n not in self.outs:
+                self.outs[n] = [np.empty((n,) + array.shape[1:], dtype=array.dtype) for array in self.arrays]
+            out = self.outs[n]
+        idx = self.rng.randint(0, self.size, size=n)
+        for array, o in zip(self.arrays, out):
+            np.take(array, idx, axis=0, out=o)
+        return out
+
+    def __len__(self):
+        return self.size
+
+    #former list based interface: store the batch and, once full, return a stored batch of the
+    #same size instead of it half of the time
+    def __call__(self, data):
+        if self.size < self.capacity:
+            self.add(*data)
             return data
+        if self.rng.rand() > 0.5:
+            replayed = [o.copy() for o in self.sample(len(data[0]))]
+            self.add(*data)
+            return replayed
+        return data
 
 if __name__ == '__main__':
     y = ARC_Sampler(name='D2-1')